@@ -108,6 +108,14 @@ class AssessmentView(DetailView):
         if self.thread_content:
             allow_solution_buttons = self.thread_content.allow_solution_buttons
 
+        # if question_only is set, then render and view only that question
+        if self.kwargs.get('question_only'):
+            question_only = int(self.kwargs['question_only'])
+            questions_to_render = [question_only-1]
+        else:
+            question_only = None
+            questions_to_render = None
+
         from micourses.render_assessments import render_question_list
         rendered_list=render_question_list(
             self.assessment, self.question_list, rng=rng, 
@@ -118,12 +126,11 @@ class AssessmentView(DetailView):
             show_post_user_errors=show_post_user_errors,
             show_correctness=show_response_correctness,
             no_links=self.no_links,
-            allow_solution_buttons=allow_solution_buttons
+            allow_solution_buttons=allow_solution_buttons,
+            questions_to_render=questions_to_render,
         )
 
-        # if question_only is set, then view only that question
-        if self.kwargs.get('question_only'):
-            question_only = int(self.kwargs['question_only'])
+        if question_only:
             rendered_list=rendered_list[question_only-1:question_only]
             context['question_only'] = question_only
         context['rendered_list'] = rendered_list
@@ -1304,6 +1311,18 @@ class GenerateAssessmentAttempts(SingleObjectMixin, View):
         if not user_can_administer_assessment(request.user, course=self.course):
             return JsonResponse({})
 
+        # generate attempts for all students, or just a single student
+        # if enrollment_id is specified
         enrollment_id = request.POST.get("enrollment_id")
+        enrollment_ids = None
         if enrollment_id:
-            pass
+            try:
+                enrollment_ids = [int(enrollment_id)]
+            except ValueError:
+                return JsonResponse({})
+
+        from micourses.utils import ensure_open_assessment_attempt_all_students
+        result = ensure_open_assessment_attempt_all_students(
+            self.thread_content, enrollment_ids=enrollment_ids)
+
+        return JsonResponse(result)
@@ -0,0 +1,270 @@
+from django.conf import settings
+from django.utils import timezone
+from bisect import bisect_left, bisect_right
+import datetime
+import pytz
+
+
+def as_attendance_date(value):
+    """
+    Convert value to a date the same way a DateField does
+    when a datetime is used in a query lookup,
+    i.e., aware datetimes are converted to the default time zone.
+    """
+    if isinstance(value, datetime.datetime):
+        if settings.USE_TZ and timezone.is_aware(value):
+            value = timezone.make_naive(value,
+                                        timezone.get_default_timezone())
+        return value.date()
+    return value
+
+
+class AttendanceIndex(object):
+    """
+    Attendance of a course, loaded once so that percent attendance
+    and the ends of previous weeks can be found for many dates
+    and many enrollments without further queries.
+
+    The attendance dates of the course are stored as a sorted list.
+    For each enrollment, the dates of its student attendance
+    are stored along with cumulative arrays of the number of
+    excused absences, the number of other attendance entries and the
+    sum of their present values.
+    The attendance over any range of dates is then a difference
+    of two cumulative values, found by bisecting the dates.
+
+    If enrollment_ids is given, only attendance of those enrollments
+    is loaded.  Data are loaded the first time they are needed,
+    so an index that is never used costs no queries.
+
+    """
+
+    def __init__(self, course, enrollment_ids=None, skipdate_dict=None):
+        self.course = course
+        self.enrollment_ids = enrollment_ids
+        self._skipdate_dict = skipdate_dict
+        self._attendance_dates = None
+        self._student_attendance = None
+        self._previous_week_ends = {}
+
+    @property
+    def skipdate_dict(self):
+        if self._skipdate_dict is None:
+            self._skipdate_dict = {
+                sd.date: sd.id for sd in self.course.courseskipdate_set.all()}
+        return self._skipdate_dict
+
+    @property
+    def attendance_dates(self):
+        if self._attendance_dates is None:
+            self._attendance_dates = list(
+                self.course.attendancedate_set.order_by('date')
+                .values_list('date', flat=True))
+        return self._attendance_dates
+
+    @property
+    def student_attendance(self):
+        """
+        Dictionary, keyed by enrollment id, of tuples
+        (dates, excused, other, present), where dates is the sorted list
+        of dates of student attendance and excused, other and present
+        are the cumulative arrays, with a leading zero,
+        of excused absences, other entries and present values.
+        """
+        if self._student_attendance is None:
+            from micourses.models import StudentAttendance, EXCUSED
+
+            attendance = StudentAttendance.objects.filter(
+                enrollment__course=self.course)
+            if self.enrollment_ids is not None:
+                attendance = attendance.filter(
+                    enrollment_id__in=self.enrollment_ids)
+
+            self._student_attendance = {}
+            for (enrollment_id, date, present) in attendance\
+                    .order_by('enrollment_id', 'date')\
+                    .values_list('enrollment_id', 'date', 'present'):
+                try:
+                    (dates, excused, other, present_sum) = \
+                        self._student_attendance[enrollment_id]
+                except KeyError:
+                    (dates, excused, other, present_sum) = \
+                        self._student_attendance[enrollment_id] = \
+                        ([], [0], [0], [0])
+                dates.append(date)
+                if present == EXCUSED:
+                    excused.append(excused[-1]+1)
+                    other.append(other[-1])
+                    present_sum.append(present_sum[-1])
+                else:
+                    excused.append(excused[-1])
+                    other.append(other[-1]+1)
+                    present_sum.append(present_sum[-1]+present)
+
+        return self._student_attendance
+
+
+    def previous_week_end(self, date=None):
+        """
+        Return course.previous_week_end(date),
+        using the skip dates of the index.
+        """
+        try:
+            return self._previous_week_ends[date]
+        except KeyError:
+            pass
+        previous_week_end = self.course.previous_week_end(
+            date, skipdate_dict=self.skipdate_dict)
+        self._previous_week_ends[date] = previous_week_end
+        return previous_week_end
+
+    def last_attendance_day_previous_week(self):
+        if not self.course.last_attendance_date:
+            return None
+        return min(self.course.last_attendance_date, self.previous_week_end())
+
+    def percent_attendance(self, enrollment, date=None):
+        """
+        Return the percent attendance of enrollment through date,
+        with the same result as enrollment.percent_attendance(date).
+        """
+
+        if date:
+            tz = pytz.timezone(self.course.attendance_time_zone)
+            try:
+                date= tz.normalize(date.astimezone(tz)).date()
+            except AttributeError:
+                pass
+        else:
+            date = self.last_attendance_day_previous_week()
+            if not date:
+                return None
+
+        start_date = enrollment.date_enrolled or self.course.start_date
+        if not start_date:
+            return 0
+        start_date = as_attendance_date(start_date)
+
+        dates = self.attendance_dates
+        course_days = max(0, bisect_right(dates, date)
+                             - bisect_left(dates, start_date))
+
+        if not course_days:
+            return 0
+
+        try:
+            (dates, excused, other, present_sum) = \
+                self.student_attendance[enrollment.id]
+        except KeyError:
+            return 0
+
+        begin = bisect_left(dates, start_date)
+        end = max(begin, bisect_right(dates, date))
+        n_excused_absenses = excused[end]-excused[begin]
+
+        # with no entries that aren't excused, days attended is undefined
+        if other[end] == other[begin]:
+            return 0
+        days_attended = present_sum[end]-present_sum[begin]
+
+        try:
+            return 100.0*days_attended/float(course_days-n_excused_absenses)
+        except ZeroDivisionError:
+            return 0
+
+
+def record_attendance(course, attendance_by_date, chunk_size=500):
+    """
+    Record attendance of students of course for one or more dates.
+
+    attendance_by_date is a dictionary, keyed by date, 
+    of dictionaries of present values keyed by enrollment id.
+    Dates that are not attendance dates of course are skipped.
+
+    Existing attendance for the dates is loaded with one query.
+    New attendance is inserted with bulk_create and changed attendance
+    is updated with one query per present value, chunk_size objects
+    per query.  As when recording attendance individually,
+    an excused absence is not changed to an absence.
+    All new and changed attendance is saved in a single revision.
+
+    Course's last attendance date is advanced to the latest date recorded.
+
+    Return dictionary with
+    - n_created: number of attendance entries created
+    - n_updated: number of attendance entries changed
+    - dates: sorted list of dates recorded
+    - invalid_dates: sorted list of dates skipped
+
+    """
+
+    from micourses.models import StudentAttendance, ABSENT, EXCUSED
+    from django.db import transaction
+    from django.db.models.signals import post_save
+    import reversion
+
+    valid_dates = set(course.attendancedate_set.filter(
+        date__in=list(attendance_by_date.keys()))
+                      .values_list('date', flat=True))
+    dates = sorted(valid_dates)
+    invalid_dates = sorted(set(attendance_by_date.keys()) - valid_dates)
+
+    result = {'n_created': 0, 'n_updated': 0, 'dates': dates,
+              'invalid_dates': invalid_dates}
+
+    if not dates:
+        return result
+
+    existing = {}
+    for sa in StudentAttendance.objects.filter(
+            enrollment__course=course, date__in=dates):
+        existing[(sa.enrollment_id, sa.date)] = sa
+
+    new_attendance = []
+    updated_ids_by_present = {}
+    changed_keys = set()
+    for date in dates:
+        for (enrollment_id, present) in attendance_by_date[date].items():
+            sa = existing.get((enrollment_id, date))
+            if sa is None:
+                new_attendance.append(StudentAttendance(
+                    enrollment_id=enrollment_id, date=date, present=present))
+                changed_keys.add((enrollment_id, date))
+            # don't override an excused absence with an absence
+            elif sa.present != present and \
+                 not (sa.present == EXCUSED and present==ABSENT):
+                sa.present = present
+                updated_ids_by_present.setdefault(present, []).append(sa.id)
+                changed_keys.add((enrollment_id, date))
+
+    with transaction.atomic(), reversion.create_revision():
+        StudentAttendance.objects.bulk_create(new_attendance,
+                                              batch_size=chunk_size)
+
+        for (present, ids) in updated_ids_by_present.items():
+            for start in range(0, len(ids), chunk_size):
+                StudentAttendance.objects.filter(
+                    id__in=ids[start:start+chunk_size]).update(present=present)
+
+        # bulk_create and update don't send post_save signals,
+        # so send them for the new and changed attendance
+        # in order that reversion adds them to the revision
+        if changed_keys:
+            for sa in StudentAttendance.objects.filter(
+                    enrollment__course=course, date__in=dates):
+                key = (sa.enrollment_id, sa.date)
+                if key in changed_keys:
+                    post_save.send(sender=StudentAttendance, instance=sa,
+                                   created=key not in existing, raw=False,
+                                   using=sa._state.db, update_fields=None)
+
+        if not course.last_attendance_date \
+           or dates[-1] > course.last_attendance_date:
+            course.last_attendance_date = dates[-1]
+            course.save()
+
+    result['n_created'] = len(new_attendance)
+    result['n_updated'] = sum(len(ids) for ids in 
+                              updated_ids_by_present.values())
+
+    return result
@@ -77,37 +77,25 @@ class UpdateAttendance(CourseBaseView):
             attendance_date = date_form.cleaned_data['date']
 
             # check if date is a class day
-            for class_day in self.course.attendancedate_set.all():
-                if attendance_date == class_day.date:
-                    valid_day = True
-                    break
+            valid_day = self.course.attendancedate_set.filter(
+                date=attendance_date).exists()
             
         else:
             attendance_date = None
 
         if valid_day:
-            with transaction.atomic(), reversion.create_revision():
-
-                for ce in self.course.courseenrollment_set.filter(withdrew=False):
-                    present=request.POST.get('student_%s' % ce.id, ABSENT)
-                    try:
-                        present = int(present)
-                    except ValueError:
-                        present = ABSENT
-
-                    sa, created = ce.studentattendance_set.get_or_create(
-                        date=attendance_date,
-                        defaults = {'present': present})
-                    # don't override an excused absence with an absence
-                    if not created and \
-                       not (sa.present == EXCUSED and present==ABSENT):
-                        sa.present = present
-                        sa.save()
+            attendance = {}
+            for ce_id in self.course.courseenrollment_set.filter(
+                    withdrew=False).values_list('id', flat=True):
+                present=request.POST.get('student_%s' % ce_id, ABSENT)
+                try:
+                    present = int(present)
+                except ValueError:
+                    present = ABSENT
+                attendance[ce_id] = present
 
-                if not self.course.last_attendance_date \
-                        or attendance_date > self.course.last_attendance_date:
-                    self.course.last_attendance_date = attendance_date
-                    self.course.save()
+            from micourses.attendance import record_attendance
+            record_attendance(self.course, {attendance_date: attendance})
 
 
             message = "Attendance updated for %s" % \
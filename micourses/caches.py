@@ -0,0 +1,20 @@
+from django.conf import settings
+from mitesting.caches import LRUCache
+
+
+# Question sets, question ids, weights and groups of assessments
+# from return_assessment_structure,
+# keyed by (assessment id, assessment revision).
+# Size can be changed by adding to settings.py:
+# MICOURSES_ASSESSMENT_STRUCTURE_CACHE_SIZE = 1000
+assessment_structure_cache = LRUCache(
+    getattr(settings, 'MICOURSES_ASSESSMENT_STRUCTURE_CACHE_SIZE', 500))
+
+
+def invalidate_assessment_caches(assessment_ids):
+    """
+    Remove all cached data for the assessments with ids in assessment_ids.
+    """
+    assessment_ids = set(assessment_ids)
+    assessment_structure_cache.invalidate(
+        lambda key: key[0] in assessment_ids)
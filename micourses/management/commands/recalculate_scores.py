@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from micourses.models import Course
+from micourses.scores import recalculate_course_scores
+
+
+class Command(BaseCommand):
+    help = "Recalculate the credit of all question attempts and the scores of all content attempts and content records of a course"
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_code')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            dest='chunk_size',
+                            help='Number of objects to update per query')
+
+    def handle(self, *args, **options):
+        try:
+            course = Course.objects.get(code=options['course_code'])
+        except Course.DoesNotExist:
+            raise CommandError('Course "%s" does not exist' 
+                               % options['course_code'])
+
+        def progress(n_done, n_total, content, changed):
+            self.stdout.write(
+                "[%s/%s] %s: changed %s question attempts, %s content attempts, %s content records" % (n_done, n_total, content.get_title(), changed['question_attempts'], changed['content_attempts'], changed['content_records']))
+
+        totals = recalculate_course_scores(course,
+                                           chunk_size=options['chunk_size'],
+                                           progress=progress)
+
+        self.stdout.write(self.style.MIGRATE_SUCCESS(
+            "Recalculated scores for %s: changed %s question attempts, %s content attempts, %s content records" % (course, totals['question_attempts'], totals['content_attempts'], totals['content_records'])))
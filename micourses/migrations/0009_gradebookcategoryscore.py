@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('micourses', '0008_course_skip_assessment_overview'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GradebookCategoryScore',
+            fields=[
+                ('id', models.AutoField(auto_created=True, serialize=False, verbose_name='ID', primary_key=True)),
+                ('score', models.FloatField(default=0)),
+                ('course_grade_category', models.ForeignKey(related_name='student_scores', to='micourses.CourseGradeCategory')),
+                ('enrollment', models.ForeignKey(related_name='category_scores', to='micourses.CourseEnrollment')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='gradebookcategoryscore',
+            unique_together=set([('enrollment', 'course_grade_category')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('micourses', '0010_assessment_revision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='course',
+            name='thread_order',
+            field=models.TextField(blank=True, null=True, editable=False),
+        ),
+    ]
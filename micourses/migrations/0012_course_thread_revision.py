@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('micourses', '0011_course_thread_order'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='course',
+            name='thread_revision',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+    ]
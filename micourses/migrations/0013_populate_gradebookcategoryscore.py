@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+def populate_gradebook_category_scores(apps, schema_editor):
+
+    ContentRecord = apps.get_model('micourses', 'ContentRecord')
+    CourseGradeCategory = apps.get_model('micourses', 'CourseGradeCategory')
+    GradebookCategoryScore = apps.get_model('micourses',
+                                            'GradebookCategoryScore')
+
+    # same records as micourses.scores.gradebook_records for each course
+    records = ContentRecord.objects.exclude(enrollment=None) \
+        .exclude(content__points=None).exclude(content__points=0) \
+        .exclude(content__grade_category=None) \
+        .filter(content__grade_category__course=models.F('content__course'))\
+        .filter(content__deleted=False)
+
+    scores = {}
+    for (enrollment_id, cgc_id, score) in records.values_list(
+            'enrollment_id', 'content__grade_category_id', 'score'):
+        scores.setdefault((enrollment_id, cgc_id), []).append(score or 0)
+
+    cgcs = CourseGradeCategory.objects.in_bulk(
+        list({cgc_id for (enrollment_id, cgc_id) in scores}))
+
+    # as in micourses.scores.calculate_category_score
+    category_scores = []
+    for ((enrollment_id, cgc_id), cgc_scores) in scores.items():
+        cgc = cgcs[cgc_id]
+        n_count = cgc.number_count_for_grade
+        if n_count is not None and n_count < len(cgc_scores):
+            category_score = sum(sorted(cgc_scores)[-n_count:])
+        else:
+            category_score = sum(cgc_scores)
+        category_scores.append(GradebookCategoryScore(
+            enrollment_id=enrollment_id, course_grade_category_id=cgc_id,
+            score=category_score*cgc.rescale_factor))
+
+    GradebookCategoryScore.objects.all().delete()
+    GradebookCategoryScore.objects.bulk_create(category_scores,
+                                               batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('micourses', '0012_course_thread_revision'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_gradebook_category_scores,
+                             reverse_code=migrations.RunPython.noop),
+    ]
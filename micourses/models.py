@@ -1,5 +1,6 @@
 from django.db import models, transaction
-from django.db.models import Sum, Max, Avg
+from django.db.models import Max, Avg, F
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.contrib.auth.models import User, Group
 from django.core.exceptions import ValidationError, ObjectDoesNotExist, MultipleObjectsReturned
 from django.contrib.contenttypes.models import ContentType
@@ -11,6 +12,7 @@ from django.conf import settings
 from math import ceil
 import pytz
 import reversion
+import json
 
 AUDITOR_ROLE = 'A'
 STUDENT_ROLE = 'S'
@@ -220,6 +222,10 @@ class CourseGradeCategory(models.Model):
                 self.sort_order = 1
         super(CourseGradeCategory, self).save(*args, **kwargs)
 
+        from micourses.scores import refresh_gradebook_category_scores
+        refresh_gradebook_category_scores(
+            self.course, course_grade_category_ids=[self.id])
+
 
 
 class AttendanceDate(models.Model):
@@ -265,6 +271,14 @@ class Course(models.Model):
     active = models.BooleanField(default=True, db_index=True)
     sort_order = models.FloatField(blank=True)
 
+    # JSON list of [section id, depth] of thread sections in thread order,
+    # from compute_thread_order.  Null if must be recomputed.
+    thread_order = models.TextField(blank=True, null=True, editable=False)
+
+    # incremented whenever thread sections or thread contents change,
+    # so that cached renderings of the thread can be discarded
+    thread_revision = models.IntegerField(default=0, editable=False)
+
     objects = models.Manager()
     active_courses = ActiveCourseManager()
 
@@ -276,21 +290,147 @@ class Course(models.Model):
         ordering = ['sort_order','id']
         unique_together = ['name', 'semester']
 
-    def all_thread_section_generator(self):
-        ts = self.thread_sections.first()
-        # since could have infinite loop if data is corrupted
-        # (and have circular dependence in sections) 
-        # limit to 10000
-        for i in range(10000):
-            yield ts
-            ts = ts.find_next()
-            if not ts:
+    def compute_thread_order(self):
+        """
+        Return list of (section id, depth) of all sections of thread,
+        in the order they appear in the thread (a preorder traversal),
+        where depth is 0 for top level sections.
+
+        Sections are loaded with one query per level of the thread.
+        Since data could be corrupted, limit to 10 levels.
+        """
+
+        children = {None: list(self.thread_sections.values_list(
+            'id', flat=True))}
+        level = children[None]
+        for depth in range(10):
+            if not level:
                 break
+            next_level = []
+            for (section_id, parent_id) in ThreadSection.objects.filter(
+                    parent_id__in=level).values_list('id', 'parent_id'):
+                children.setdefault(parent_id, []).append(section_id)
+                next_level.append(section_id)
+            level = next_level
+
+        thread_order = []
+        stack = [(section_id, 0) for section_id in reversed(children[None])]
+        while stack:
+            (section_id, depth) = stack.pop()
+            thread_order.append((section_id, depth))
+            stack.extend((child_id, depth+1) for child_id
+                         in reversed(children.get(section_id, [])))
+
+        return thread_order
+
+    def return_thread_order(self):
+        """
+        Return list of (section id, depth) of all sections of thread,
+        in thread order, computing and storing the thread order
+        if it isn't already stored.
+        """
+        try:
+            return self._thread_order_list
+        except AttributeError:
+            pass
+
+        if self.thread_order is None:
+            # store thread order only if thread revision hasn't changed
+            # since course was loaded, as otherwise sections may have
+            # changed while computing the thread order
+            revision = self.thread_revision
+            thread_order = self.compute_thread_order()
+            self.thread_order = json.dumps(thread_order)
+            Course.objects.filter(id=self.id, thread_revision=revision,
+                                  thread_order=None)\
+                          .update(thread_order=self.thread_order)
+        else:
+            thread_order = [tuple(item) for item 
+                            in json.loads(self.thread_order)]
+
+        self._thread_order_list = thread_order
+        return thread_order
+
+    def return_thread_positions(self):
+        """
+        Return dictionary, keyed by section id, of
+        (index in thread order, previous sibling id, next sibling id).
+        """
+        try:
+            return self._thread_positions
+        except AttributeError:
+            pass
+
+        positions = {}
+        # last section seen at each depth, 
+        # truncated whenever move up to a lower depth
+        last_at_depth = []
+        for (i, (section_id, depth)) in enumerate(self.return_thread_order()):
+            del last_at_depth[depth+1:]
+            if len(last_at_depth) > depth:
+                previous_id = last_at_depth[depth]
+                (j, previous_previous_id, next_id) = positions[previous_id]
+                positions[previous_id] = (j, previous_previous_id, section_id)
+                last_at_depth[depth] = section_id
+            else:
+                previous_id = None
+                last_at_depth.append(section_id)
+            positions[section_id] = (i, previous_id, None)
+
+        self._thread_positions = positions
+        return positions
+
+    def invalidate_thread_order(self):
+        """
+        Mark thread order as needing to be recomputed,
+        as thread sections have changed,
+        and increment thread revision.
+        """
+        Course.objects.filter(id=self.id).update(
+            thread_order=None, thread_revision=F('thread_revision')+1)
+        self.thread_order = None
+        self.thread_revision += 1
+        self.__dict__.pop('_thread_order_list', None)
+        self.__dict__.pop('_thread_positions', None)
+
+    def all_thread_section_generator(self):
+        section_ids = [section_id for (section_id, depth)
+                       in self.return_thread_order()]
+        sections = ThreadSection.objects.in_bulk(section_ids)
+        for section_id in section_ids:
+            try:
+                yield sections[section_id]
+            except KeyError:
+                pass
 
     def reset_thread_section_sort_order(self):
-        for (i,ts) in enumerate(list(self.all_thread_section_generator())):
-            ts.sort_order=i
-            ts.save()
+        """
+        Recompute and store thread order, and set the sort_order of
+        each section to its index in the thread order, 
+        so that ordering all sections by sort_order gives the thread order.
+        Only sections whose sort_order changed are updated, with one query.
+        """
+        from django.db.models import Case, When, Value, FloatField
+
+        with transaction.atomic():
+            self.invalidate_thread_order()
+            thread_order = self.return_thread_order()
+            new_sort_orders = {section_id: float(i) for (i, (section_id, depth))
+                               in enumerate(thread_order)}
+            changed = [(section_id, new_sort_orders[section_id])
+                       for (section_id, sort_order) in
+                       ThreadSection.objects.filter(id__in=list(new_sort_orders))
+                       .values_list('id', 'sort_order')
+                       if sort_order != new_sort_orders[section_id]]
+            if changed:
+                ThreadSection.objects.filter(
+                    id__in=[section_id for (section_id, sort_order) 
+                            in changed])\
+                    .update(sort_order=Case(
+                        *[When(id=section_id, then=Value(
+                            sort_order, output_field=FloatField()))
+                          for (section_id, sort_order) in changed],
+                        output_field=FloatField()))
 
     def save(self, *args, **kwargs):
         # if sort_order is null, make it one more than the max
@@ -301,6 +441,19 @@ class Course(models.Model):
                 self.sort_order = ceil(max_sort_order+1)
             else:
                 self.sort_order = 1
+
+        # thread_order and thread_revision are changed only by
+        # return_thread_order, invalidate_thread_order and
+        # update_thread_revisions, so don't write back the values
+        # of an existing course, which may be out of date
+        # if its thread has changed
+        if self.pk is not None and not self._state.adding \
+           and kwargs.get('update_fields') is None \
+           and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name 
+                not in ('thread_order', 'thread_revision')]
         super(Course, self).save(*args, **kwargs)
 
     # save course as a new course
@@ -316,6 +469,8 @@ class Course(models.Model):
         new_course.code = code
         new_course.name = name
         new_course.last_attendance_date = None
+        new_course.thread_order = None
+        new_course.thread_revision = 0
 
         new_course.save()
 
@@ -384,7 +539,8 @@ class Course(models.Model):
 
 
     def thread_content_select_related_content_objects(self, thread_content_queryset=None,
-                                                      as_dictionary=False):
+                                                      as_dictionary=False,
+                                                      select_related=False):
         """
         Effectively selects related content objects for thread content queryset,
         using only one query per content type in the query set.
@@ -392,6 +548,10 @@ class Course(models.Model):
         If as_dictionary, returns a dictionary keyed by thread_content id,
         else returns the queryset itself with the content_objects cached using _content_object_cache
 
+        If select_related, the non-null foreign keys of the content objects
+        (such as page_type or assessment_type, used to create links)
+        are selected in the same queries.
+
         Based on http://stackoverflow.com/questions/2939552/django-select-related-and-genericrelation
 
         """
@@ -412,7 +572,10 @@ class Course(models.Model):
         relations = {}
         for ct, fk_list in generics.items():
             ct_model = content_types[ct].model_class()
-            relations[ct] = ct_model.objects.in_bulk(list(fk_list))
+            content_objects = ct_model.objects.all()
+            if select_related:
+                content_objects = content_objects.select_related()
+            relations[ct] = content_objects.in_bulk(list(fk_list))
 
         if as_dictionary:
             # return dictionary of content_objects keyed on thread_content id
@@ -506,27 +669,90 @@ class Course(models.Model):
  
 
     def student_scores_by_grade_category(self, student=None, section=None):
-        student_scores = []
-
-        enrollment=None
-        cgc = None
-        student_categories = []
-        total_student_score = 0
-        category_score_results = []
-        category_scores=[]
-        
+        """
+        Return gradebook scores of students, by grade category,
+        as calculated by generate_student_scores_by_grade_category.
+
+        If student is specified, return a dictionary with items
+        - categories: list of results for each grade category
+        - total_points
+        - total_score
+        - total_percent
+        where results of each grade category include points and percents.
+        Return an empty list if student has no scores.
+
+        Otherwise, return a list with a dictionary for each student 
+        (of section, if specified) with items
+        - enrollment
+        - total_score
+        - categories: list of results for each grade category
+
+        """
+
+        student_scores = list(self.generate_student_scores_by_grade_category(
+            student=student, section=section))
+
+        if not student_scores:
+            return []
+
+        # if specified student, then return results as just
+        # a dictionary, with percent and points included
+        if student:
+            total_student_score = student_scores[0]['total_score']
+            total_points = self.total_points()
+            if total_points and total_student_score:
+                total_percent = total_student_score/total_points*100
+            else:
+                total_percent = 0
+            return {'categories': student_scores[0]['categories'],
+                    'total_points': total_points,
+                    'total_score': total_student_score,
+                    'total_percent': total_percent,
+                }
+
+        else:
+            return student_scores
+
+
+    def generate_student_scores_by_grade_category(self, student=None,
+                                                  section=None,
+                                                  score_category_ids=None):
+        """
+        Generate gradebook scores of students, by grade category,
+        yielding a dictionary for each student with items
+        - enrollment
+        - total_score
+        - categories: list of results for each grade category
+
+        If student is specified, yield results for just that student,
+        with points and percents included in the results 
+        of each grade category.
+        Otherwise, yield results for each student (of section, if specified).
+
+        Scores of each content come from the content records,
+        which are read from the database as they are needed.
+        If score_category_ids is given, only the content records of the
+        course grade categories with those ids are read, and the results
+        of the other grade categories include just their scores.
+        The score of each grade category is read from GradebookCategoryScore.
+        Any missing scores of grade categories whose content records
+        were read are calculated from the content records and, 
+        once all students have been generated, saved with 
+        refresh_gradebook_category_scores.
+
+        """
+
+        from micourses.scores import gradebook_records, \
+            calculate_category_score, refresh_gradebook_category_scores
+        from itertools import groupby
+
         include_details = student is not None
 
 
         def summarize_category(cgc, category_scores, category_score_results,
-                               include_details=False):
+                               category_student_score, include_details=False):
             n_count = cgc.number_count_for_grade
             n_assessments = len(category_scores)
-            if n_count is not None and n_count < n_assessments:
-                category_student_score = sum(sorted(category_scores)[-n_count:])
-            else:
-                category_student_score = sum(category_scores)
-            category_student_score *= cgc.rescale_factor
             category_results = {
                 'category': cgc.grade_category,
                 'cgc': cgc,
@@ -565,129 +791,137 @@ class Course(models.Model):
             return category_results
 
 
-        records = ContentRecord.objects.filter(content__course=self) \
-            .exclude(content__points=None).exclude(content__points=0) \
-            .exclude(content__grade_category=None)
-
-        # in case data gets messed up and have content
-        # with grade category from other course,
-        # make sure have only grade categories from coursex
-        records = records.filter(content__grade_category__course = self)
+        records = gradebook_records(self)
+        enrollments = self.courseenrollment_set.select_related(
+            'student__user')
+        stored_scores = GradebookCategoryScore.objects.filter(
+            course_grade_category__course=self)
 
-        # since starting with ContentRecord, could have records
-        # associated with content that was deleted
-        records = records.filter(content__deleted=False)
         if student:
-            records = records.filter(enrollment__student=student) \
-                .order_by('content__grade_category', 'content')
-
+            records = records.filter(enrollment__student=student)
+            enrollments = enrollments.filter(student=student)
+            stored_scores = stored_scores.filter(enrollment__student=student)
         else:
             if section:
                 records = records.filter(enrollment__section=section)
-            records = records.filter(enrollment__role=STUDENT_ROLE) \
-                .order_by('enrollment__student', 'content__grade_category',
-                          'content')\
- 
+                enrollments = enrollments.filter(section=section)
+                stored_scores = stored_scores.filter(
+                    enrollment__section=section)
+            records = records.filter(enrollment__role=STUDENT_ROLE)
+            enrollments = enrollments.filter(role=STUDENT_ROLE)
+            stored_scores = stored_scores.filter(
+                enrollment__role=STUDENT_ROLE)
+
+        if score_category_ids is not None:
+            score_category_ids = set(score_category_ids)
+            records = records.filter(
+                content__grade_category_id__in=score_category_ids)
+
+        # order by student, like enrollments, so that the records 
+        # of each enrollment can be read along with the enrollment
+        records = records.order_by(
+            'enrollment__student', 'content__grade_category',
+            'content').values_list(
+                'enrollment_id', 'content_id',
+                'content__grade_category_id', 'score').iterator()
+        enrollment_records = groupby(records, key=lambda r: r[0])
+
+        stored_scores_by_enrollment = {}
+        for (enrollment_id, cgc_id, score) in stored_scores.values_list(
+                'enrollment_id', 'course_grade_category_id', 'score'):
+            stored_scores_by_enrollment.setdefault(
+                enrollment_id, {})[cgc_id] = score
+
         thread_content_with_related = self.thread_content_select_related_content_objects()
-        content_dict = {tc.id: {'assessment': tc.content_object,
+        content_dict = {tc.id: {'content': tc,
+                                'assessment': tc.content_object,
                                 'title': tc.get_title()} for tc in thread_content_with_related }
 
-        records = records.select_related(
-            'enrollment__student__user',
-            'content__grade_category__grade_category')
+        cgcs = list(self.coursegradecategory_set.select_related(
+            'grade_category'))
+        missing_enrollment_ids = set()
+
+        enrollments = list(enrollments.order_by('student'))
+        enrollment_ids = {ce.id for ce in enrollments}
+        next_records = next(enrollment_records, None)
+
+        for enrollment in enrollments:
+
+            # skip any records whose enrollment isn't listed,
+            # then take the records of enrollment, if any
+            while next_records is not None and \
+                  next_records[0] not in enrollment_ids:
+                next_records = next(enrollment_records, None)
+            records_by_category = {}
+            if next_records is not None and next_records[0] == enrollment.id:
+                for (cgc_id, cgc_records) in groupby(
+                        next_records[1], key=lambda r: r[2]):
+                    records_by_category[cgc_id] = list(cgc_records)
+                next_records = next(enrollment_records, None)
+
+            stored_category_scores = stored_scores_by_enrollment.get(
+                enrollment.id, {})
+
+            student_categories=[]
+            total_student_score=0
+
+            for cgc in cgcs:
+                if score_category_ids is None or cgc.id in score_category_ids:
+                    if cgc.id not in records_by_category:
+                        continue
+                elif cgc.id not in stored_category_scores:
+                    continue
 
-        if not records:
-            return []
+                category_score_results=[]
+                category_scores=[]
 
+                for (e_id, content_id, c_id, score) in \
+                    records_by_category.get(cgc.id, []):
+                    tc=content_dict[content_id]['content']
+                    tc_points = tc.points
+                    assessment_results = {
+                        'content': tc,
+                        'assessment': content_dict[content_id]['assessment'],
+                        'title': content_dict[content_id]['title'],
+                        'score': score,}
+                    score_or_zero = score
+                    if not score_or_zero:
+                        score_or_zero=0
+                    if include_details:
+                        percent = score_or_zero/tc_points*100
+                        assessment_results['points'] = tc_points
+                        assessment_results['percent'] = percent
+
+                    category_scores.append(score_or_zero)
+                    category_score_results.append(assessment_results)
 
-        for cr in records \
-            .select_related('enrollment__student__user', 'content__grade_category__grade_category'):
+                try:
+                    category_student_score = stored_category_scores[cgc.id]
+                except KeyError:
+                    category_student_score = calculate_category_score(
+                        cgc, category_scores)
+                    missing_enrollment_ids.add(enrollment.id)
 
-            if enrollment != cr.enrollment:
-                # if have previous student, then record student results
-                if enrollment:
+                category_results = summarize_category(
+                    cgc, category_scores, category_score_results,
+                    category_student_score, include_details=include_details)
+                student_categories.append(category_results)
+                total_student_score += category_results['student_score']
 
-                    category_results = summarize_category(
-                        cgc, category_scores, category_score_results,
-                        include_details=include_details)
-                    student_categories.append(category_results)
-                    total_student_score += category_results['student_score']
+            if not student_categories:
+                continue
 
-                    student_scores.append(
-                        {'enrollment': enrollment,
-                         'total_score': total_student_score,
-                         'categories': student_categories
-                     })
-                category_score_results=[]
-                category_scores=[]
-                cgc = cr.content.grade_category
-                student_categories=[]
-                total_student_score=0
-                enrollment=cr.enrollment
-                
-            elif cgc != cr.content.grade_category:
-                # if have previous cgc, then compute totals
-                if cgc:
-                    category_results = summarize_category(
-                        cgc, category_scores, category_score_results,
-                        include_details=include_details)
-                    student_categories.append(category_results)
-                    total_student_score += category_results['student_score']
+            yield {'enrollment': enrollment,
+                   'total_score': total_student_score,
+                   'categories': student_categories
+               }
 
-                category_score_results=[]
-                category_scores=[]
-                cgc = cr.content.grade_category
-            
-            tc=cr.content
-            tc_points = tc.points
-            if tc_points:
-                assessment_results = {
-                    'content': tc,
-                    'assessment': content_dict[tc.id]['assessment'],
-                    'title': content_dict[tc.id]['title'],
-                    'score': cr.score,}
-                score_or_zero = cr.score
-                if not score_or_zero:
-                    score_or_zero=0
-                if include_details:
-                    percent = score_or_zero/tc_points*100
-                    assessment_results['points'] = tc_points
-                    assessment_results['percent'] = percent
-
-                category_scores.append(score_or_zero)
-                category_score_results.append(assessment_results)
-
-
-
-        # compute totals for last student and cgc
-        category_results = summarize_category(
-            cgc, category_scores, category_score_results,
-                        include_details=include_details)
-        student_categories.append(category_results)
-        total_student_score += category_results['student_score']
+        # save any category scores that were missing
+        if missing_enrollment_ids:
+            refresh_gradebook_category_scores(
+                self, enrollment_ids=list(missing_enrollment_ids))
 
-        # if specified student, then return results as just
-        # a dictionary, with percent and points included
-        if student:
-            total_points = self.total_points()
-            if total_points and total_student_score:
-                total_percent = total_student_score/total_points*100
-            else:
-                total_percent = 0
-            return {'categories': student_categories,
-                    'total_points': total_points,
-                    'total_score': total_student_score,
-                    'total_percent': total_percent,
-                }
 
-        else:
-            student_scores.append(
-                {'enrollment': enrollment,
-                 'total_score': total_student_score,
-                 'categories': student_categories
-             })
-            return student_scores    
-                    
     def total_points(self):
         total_points=0
         for cgc in self.coursegradecategory_set.all():
@@ -918,16 +1152,18 @@ class Course(models.Model):
             .select_related('content')
         }
 
-        # for each of content, calculate adjusted due date
+        # for each of content, calculate adjusted due date,
+        # loading attendance of enrollment just once
         content_with_dates = []
-        skipdate_dict = {sd.date: sd.id for sd in self.courseskipdate_set.all() }
+        from micourses.attendance import AttendanceIndex
+        attendance_index = AttendanceIndex(self, enrollment_ids=[enrollment.id])
 
         for content in content_list:
             cr = content_records.get(content.id)
 
             initial_due = content.get_initial_due(content_record=cr)
-            adjusted_due = content.get_adjusted_due(content_record=cr,
-                                                    skipdate_dict=skipdate_dict)
+            adjusted_due = content.get_adjusted_due(
+                content_record=cr, attendance_index=attendance_index)
             assigned = content.get_assigned()
 
             if exclude_completed:
@@ -1048,6 +1284,46 @@ class Course(models.Model):
                     ce.group=row[6]
                     ce.save()
 
+    def import_attendance(self, filename):
+        """
+        Import attendance from csv file.
+        Assume the first row is a header row with Internet ID
+        in the first column followed by one column per date,
+        with dates in the format YYYY-MM-DD.
+        Each subsequent row has a student's Internet ID (username)
+        followed by the student's attendance on each date, 
+        as 1 for present, 0 for absent, or -1 for excused.
+        Blank entries are ignored.
+
+        Attendance for all dates is recorded at once with record_attendance.
+        Return the result of record_attendance.
+
+        """
+
+        import csv
+        from micourses.attendance import record_attendance
+
+        enrollment_ids = dict(self.courseenrollment_set.values_list(
+            'student__user__username', 'id'))
+
+        with open(filename) as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            dates = [timezone.datetime.strptime(item.strip(), "%Y-%m-%d")
+                     .date() for item in header[1:]]
+            attendance_by_date = {date: {} for date in dates}
+            for row in reader:
+                try:
+                    enrollment_id = enrollment_ids[row[0].strip()]
+                except (KeyError, IndexError):
+                    continue
+                for (date, item) in zip(dates, row[1:]):
+                    item = item.strip()
+                    if item:
+                        attendance_by_date[date][enrollment_id] = int(item)
+
+        return record_attendance(self, attendance_by_date)
+
 
 
 
@@ -1122,38 +1398,11 @@ class CourseEnrollment(models.Model):
 
 
     def percent_attendance(self, date=None):
-
-        if date:
-            tz = pytz.timezone(self.course.attendance_time_zone)
-            try:
-                date= tz.normalize(date.astimezone(tz)).date()
-            except AttributeError:
-                pass
-        else:
-            date = self.course.last_attendance_day_previous_week()
-            if not date:
-                return None
-
-
-        date_enrolled = self.date_enrolled
-        course_days = self.course.to_date_attendance_days(date, 
-                                                     start_date=date_enrolled)
-        
-        attendance_data = self.studentattendance_set\
-            .filter(date__lte = date).filter(date__gte = date_enrolled)
-        
-        n_excused_absenses = attendance_data.filter(present = EXCUSED).count()
-        
-        days_attended = attendance_data.exclude(present = EXCUSED)\
-            .aggregate(Sum('present'))['present__sum']
-
-        if course_days:
-            try:
-                return 100.0*days_attended/float(course_days-n_excused_absenses)
-            except (TypeError, ZeroDivisionError):
-                return 0
-        else:
-            return 0
+        # to calculate for many dates or enrollments,
+        # use an AttendanceIndex directly, which loads attendance once
+        from micourses.attendance import AttendanceIndex
+        return AttendanceIndex(self.course, enrollment_ids=[self.id])\
+            .percent_attendance(self, date=date)
     
 
 
@@ -1226,20 +1475,69 @@ class ThreadSection(models.Model):
         else:
             return self.parent.child_sections.all()
 
-    def find_next_sibling(self, siblings=None):
+    def return_thread_position(self, course=None):
+        """
+        Return (thread order, index in thread order, 
+        previous sibling id, next sibling id) of section,
+        from the stored thread order of course.
+
+        If course isn't specified, it is found from get_course().
+        """
+        if course is None:
+            course = self.get_course()
+        try:
+            position = course.return_thread_positions()[self.id]
+        except KeyError:
+            # thread order is stale, so recompute
+            course.invalidate_thread_order()
+            try:
+                position = course.return_thread_positions()[self.id]
+            except KeyError:
+                return (course.return_thread_order(), None, None, None)
+        return (course.return_thread_order(),) + position
+
+    def find_thread_section(self, find_id, course=None):
+        """
+        Return the section with id find_id(position), where position is
+        the thread position of section from return_thread_position,
+        or None if find_id returns None.
+
+        If the section no longer exists (e.g., it was deleted),
+        the stored thread order is stale, so recompute it and try again.
+        """
+        if course is None:
+            course = self.get_course()
+        for recomputed in (False, True):
+            section_id = find_id(self.return_thread_position(course))
+            if section_id is None:
+                return None
+            try:
+                return ThreadSection.objects.get(id=section_id)
+            except ThreadSection.DoesNotExist:
+                if recomputed:
+                    return None
+                course.invalidate_thread_order()
+
+    def find_next_sibling(self, siblings=None, course=None):
         if siblings is None:
-            siblings = self.return_siblings()
+            return self.find_thread_section(
+                lambda position: position[3], course)
+
+        siblings = list(siblings)
         for (i,ts) in enumerate(siblings):
             if ts == self:
                 break
-        if i < siblings.count()-1:
+        if i < len(siblings)-1:
             return siblings[i+1]
         else:
             return None
 
-    def find_previous_sibling(self, siblings=None):
+    def find_previous_sibling(self, siblings=None, course=None):
         if siblings is None:
-            siblings = self.return_siblings()
+            return self.find_thread_section(
+                lambda position: position[2], course)
+
+        siblings = list(siblings)
         for (i,ts) in enumerate(siblings):
             if ts == self:
                 break
@@ -1248,43 +1546,21 @@ class ThreadSection(models.Model):
         else:
             return None
 
-    def find_next(self):
-        first_child = self.child_sections.first()
-        if first_child:
-            return first_child
-        
-        ancestor = self
-        for i in range(10):
-            next_sibling = ancestor.find_next_sibling()
-            if next_sibling:
-                return next_sibling
-            else:
-                if ancestor.course is None:
-                    ancestor = ancestor.parent
-                else:
-                    return None
-        return None
-
-    def find_previous(self):
-        previous_sibling = self.find_previous_sibling()
-
-        if not previous_sibling:
-            if self.course:
+    def find_next(self, course=None):
+        def find_next_id(position):
+            (thread_order, i, previous_id, next_id) = position
+            if i is None or i+1 >= len(thread_order):
                 return None
-            else:
-                return self.parent
+            return thread_order[i+1][0]
+        return self.find_thread_section(find_next_id, course)
 
-        # find last descendant of previous sibling
-        # (or sibling if no descendants)
-        descendant = previous_sibling
-        for i in range(10):
-            last_child = descendant.child_sections.last()
-            if last_child:
-                descendant = last_child
-            else:
-                return descendant
-
-        return None
+    def find_previous(self, course=None):
+        def find_previous_id(position):
+            (thread_order, i, previous_id, next_id) = position
+            if not i:
+                return None
+            return thread_order[i-1][0]
+        return self.find_thread_section(find_previous_id, course)
 
     def reset_thread_content_sort_order(self):
         for (i,tc) in enumerate(list(self.thread_contents.all())):
@@ -1312,7 +1588,17 @@ class ThreadSection(models.Model):
                 self.sort_order = ceil(max_sort_order+1)
             else:
                 self.sort_order = 1
-        super(ThreadSection, self).save(*args, **kwargs)
+
+        with transaction.atomic():
+            super(ThreadSection, self).save(*args, **kwargs)
+
+            # thread order of course must be recomputed
+            try:
+                course = self.get_course()
+            except ObjectDoesNotExist:
+                course = None
+            if course:
+                course.invalidate_thread_order()
 
 
     def mark_deleted(self):
@@ -1466,8 +1752,8 @@ class ThreadContent(models.Model):
         set_n_of_objects(self.course, self.content_object)
 
         if points_changed:
-            for record in self.contentrecord_set.all():
-                record.recalculate_score(total_recalculation=True)
+            from micourses.scores import recalculate_thread_content_scores
+            recalculate_thread_content_scores(self)
 
         if newly_with_points:
             for ce in self.course.courseenrollment_set.all():
@@ -1551,7 +1837,8 @@ class ThreadContent(models.Model):
             self.save()
 
 
-    def return_availability(self, content_record=None, skipdate_dict=None):
+    def return_availability(self, content_record=None, skipdate_dict=None,
+                            attendance_index=None):
         """
         Returns availablity of ThreadContent based on
         when assigned and initially due
@@ -1579,7 +1866,8 @@ class ThreadContent(models.Model):
                 return NOT_YET_AVAILABLE
 
         due = self.get_adjusted_due(content_record=content_record,
-                                    skipdate_dict=skipdate_dict)
+                                    skipdate_dict=skipdate_dict,
+                                    attendance_index=attendance_index)
 
         if not due or now <= due:
             return AVAILABLE
@@ -1767,10 +2055,14 @@ class ThreadContent(models.Model):
 
 
     def get_adjusted_due(self, content_record=None, skipdate_dict=None,
-                         student=None):
+                         student=None, attendance_index=None):
         # adjust when due in increments of weeks
         # based on percent attendance at end of each previous week
 
+        # attendance is looked up in attendance_index, if given,
+        # so that the same AttendanceIndex can be used for many
+        # contents and students
+
         # if only one of initial due or final due is specified,
         # use that one
         
@@ -1807,17 +2099,22 @@ class ThreadContent(models.Model):
         now = timezone.now()
         
         course = self.course        
+        if attendance_index is None:
+            from micourses.attendance import AttendanceIndex
+            attendance_index = AttendanceIndex(
+                course, enrollment_ids=[content_record.enrollment_id],
+                skipdate_dict=skipdate_dict)
+
         while due < now + timezone.timedelta(days=7):
-            previous_week_end = \
-                course.previous_week_end(due, skipdate_dict=skipdate_dict)
+            previous_week_end = attendance_index.previous_week_end(due)
 
             # only update if have attendance through previous_week_end
             if not course.last_attendance_date \
                     or course.last_attendance_date < previous_week_end:
                 break
 
-            if content_record.enrollment.percent_attendance \
-                    (date=previous_week_end) \
+            if attendance_index.percent_attendance(
+                    content_record.enrollment, date=previous_week_end) \
                     < course.attendance_threshold_percent:
                 break
             
@@ -1831,7 +2128,7 @@ class ThreadContent(models.Model):
 
 
     def adjusted_due_calculation(self, content_record=None, skipdate_dict=None,
-                                 enrollment=None):
+                                 enrollment=None, attendance_index=None):
         # return data for calculation of adjusted due date
         # adjust due date in increments of weeks
         # based on percent attendance at end of each previous week
@@ -1858,12 +2155,17 @@ class ThreadContent(models.Model):
         now = timezone.now()
 
         course = self.course
+
+        if attendance_index is None:
+            from micourses.attendance import AttendanceIndex
+            attendance_index = AttendanceIndex(
+                course, enrollment_ids=[enrollment.id],
+                skipdate_dict=skipdate_dict)
         
         calculation_list = []
         while due < now + timezone.timedelta(days=7):
 
-            previous_week_end = \
-                course.previous_week_end(due, skipdate_dict=None)
+            previous_week_end = attendance_index.previous_week_end(due)
 
             calculation = {'initial_date': due,
                            'previous_week_end': previous_week_end,
@@ -1882,8 +2184,8 @@ class ThreadContent(models.Model):
 
             calculation['attendance_data']=True
 
-            attendance_percent = enrollment.percent_attendance \
-                    (date=previous_week_end)
+            attendance_percent = attendance_index.percent_attendance(
+                enrollment, date=previous_week_end)
             calculation['attendance_percent'] = round(attendance_percent,1)
 
             if attendance_percent < course.attendance_threshold_percent:
@@ -1969,8 +2271,12 @@ class ContentRecord(models.Model):
         with transaction.atomic(), reversion.create_revision():
             super(ContentRecord, self).save(*args, **kwargs)
 
+        # recalculate_score saves record again, refreshing gradebook then
         if score_override_changed:
             self.recalculate_score()
+        elif new_record or old_cr.score != self.score:
+            from micourses.scores import refresh_gradebook_for_record
+            refresh_gradebook_for_record(self)
 
         action=None
         if new_record:
@@ -2060,6 +2366,34 @@ class ContentRecord(models.Model):
         return self.score
 
 
+class GradebookCategoryScore(models.Model):
+    """
+    Score of an enrollment for a course grade category,
+    materialized from the scores of the content records of the category
+    so that the gradebook need not recompute it on each view.
+
+    Kept up to date by refresh_gradebook_category_scores whenever
+    the score of a content record changes, a content record is deleted,
+    a course grade category is changed, or thread content is deleted
+    or changes its grade category, points or deleted status.
+    Scores that existed before this model was added are created
+    by migration 0013.
+    """
+
+    enrollment = models.ForeignKey(CourseEnrollment,
+                                   related_name="category_scores")
+    course_grade_category = models.ForeignKey(CourseGradeCategory,
+                                              related_name="student_scores")
+    score = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = ['enrollment', 'course_grade_category']
+
+    def __str__(self):
+        return "Score of %s for %s" % (self.enrollment.student,
+                                       self.course_grade_category)
+
+
 @reversion.register
 class ContentAttempt(models.Model):
     record = models.ForeignKey(ContentRecord, related_name="attempts")
@@ -2535,9 +2869,16 @@ class QuestionAttempt(models.Model):
         If have no valid responses, then credit is None
 
         If propagate, also recalculate score for content attempt
+        and content record, using propagate_question_attempt_credit,
+        which updates only the scores that change.
 
         """
 
+        if propagate:
+            from micourses.scores import propagate_question_attempt_credit
+            self.credit = propagate_question_attempt_credit(self)
+            return self.credit
+
         responses = self.responses.filter(valid=True)
 
         content_attempt = self.content_attempt_question_set.content_attempt
@@ -2562,9 +2903,6 @@ class QuestionAttempt(models.Model):
                          ['credit']
 
         self.save()
-        
-        if propagate:
-            content_attempt.recalculate_score()
 
         return self.credit
 
@@ -2656,6 +2994,10 @@ class Assessment(models.Model):
     resample_question_sets = models.BooleanField(default=False)
     handwritten = models.BooleanField(default=False)
 
+    # incremented whenever questions assigned or question set details
+    # change, so that cached assessment structures are not reused
+    revision = models.PositiveIntegerField(default=0, editable=False)
+
 
     class Meta:
         ordering = ["code",]
@@ -2961,18 +3303,23 @@ class Assessment(models.Model):
         min_penalty=1000000
         best_seed=None
 
-        from .render_assessments import get_question_list
+        from .render_assessments import get_question_list, \
+            return_assessment_structure
         from mitesting.utils import get_new_seed
 
         import time
         t0=time.process_time()
 
+        # load question sets once rather than for each seed tried
+        assessment_structure = return_assessment_structure(self)
+
         for iter in range(1000):
 
             seed = get_new_seed(rng)
 
-            question_list=get_question_list(self, seed=seed, rng=rng, 
-                                            questions_only=True)
+            question_list=get_question_list(
+                self, seed=seed, rng=rng, questions_only=True,
+                assessment_structure=assessment_structure)
 
             penalty = n_include
 
@@ -3118,3 +3465,132 @@ class QuestionAssigned(models.Model):
                 self.assessment.course)
 
         super(QuestionAssigned, self).save(*args, **kwargs)
+
+
+def update_assessment_revisions(assessment_ids):
+    """
+    Increment the revision of the assessments with ids in assessment_ids
+    and discard any of their structures cached in this process.
+    """
+    assessment_ids = [aid for aid in assessment_ids if aid is not None]
+    if not assessment_ids:
+        return
+    Assessment.objects.filter(id__in=assessment_ids)\
+                      .update(revision=F('revision')+1)
+    from micourses.caches import invalidate_assessment_caches
+    invalidate_assessment_caches(assessment_ids)
+
+def assessment_component_changed(sender, **kwargs):
+    assessment_id = kwargs['instance'].assessment_id
+    if kwargs.get('raw'):
+        from micourses.caches import invalidate_assessment_caches
+        invalidate_assessment_caches([assessment_id])
+    else:
+        update_assessment_revisions([assessment_id])
+
+
+for model in (QuestionAssigned, QuestionSetDetail):
+    post_save.connect(assessment_component_changed, sender=model,
+                      dispatch_uid='assessment-revision-save-signal')
+    post_delete.connect(assessment_component_changed, sender=model,
+                        dispatch_uid='assessment-revision-delete-signal')
+
+
+def update_thread_revisions(course_ids):
+    """
+    Increment the thread revision of the courses with ids in course_ids,
+    so that cached renderings of their threads are no longer used.
+    """
+    course_ids = [cid for cid in course_ids if cid is not None]
+    if not course_ids:
+        return
+    Course.objects.filter(id__in=course_ids)\
+                  .update(thread_revision=F('thread_revision')+1)
+
+def thread_content_changed(sender, **kwargs):
+    update_thread_revisions([kwargs['instance'].course_id])
+
+def thread_section_deleted(sender, **kwargs):
+    section = kwargs['instance']
+    try:
+        course = section.get_course()
+    except ObjectDoesNotExist:
+        return
+    if course:
+        course.invalidate_thread_order()
+
+post_save.connect(thread_content_changed, sender=ThreadContent,
+                  dispatch_uid='thread-revision-save-signal')
+post_delete.connect(thread_content_changed, sender=ThreadContent,
+                    dispatch_uid='thread-revision-delete-signal')
+post_delete.connect(thread_section_deleted, sender=ThreadSection,
+                    dispatch_uid='thread-order-delete-signal')
+# titles of assessments appear in threads
+post_save.connect(thread_content_changed, sender=Assessment,
+                  dispatch_uid='thread-revision-assessment-signal')
+
+
+def gradebook_content_pre_save(sender, **kwargs):
+    content = kwargs['instance']
+    content._old_gradebook_values = None
+    if content.pk is not None and not kwargs.get('raw'):
+        content._old_gradebook_values = ThreadContent.objects.filter(
+            pk=content.pk).values_list(
+                'grade_category_id', 'points', 'deleted').first()
+
+def gradebook_content_saved(sender, **kwargs):
+    """
+    Refresh gradebook scores of the old and new grade categories
+    of thread content if its grade category, points 
+    or deleted status changed.
+    """
+    content = kwargs['instance']
+    old_values = content.__dict__.pop('_old_gradebook_values', None)
+    if old_values is None or old_values == (
+            content.grade_category_id, content.points, content.deleted):
+        return
+    course_grade_category_ids = {old_values[0], content.grade_category_id}
+    course_grade_category_ids.discard(None)
+    if course_grade_category_ids:
+        from micourses.scores import refresh_gradebook_category_scores
+        refresh_gradebook_category_scores(
+            content.course,
+            course_grade_category_ids=list(course_grade_category_ids))
+
+def gradebook_content_deleted(sender, **kwargs):
+    content = kwargs['instance']
+    if content.grade_category_id is None:
+        return
+    # course may have been deleted along with content
+    course = Course.objects.filter(id=content.course_id).first()
+    if course:
+        from micourses.scores import refresh_gradebook_category_scores
+        refresh_gradebook_category_scores(
+            course, course_grade_category_ids=[content.grade_category_id])
+
+def gradebook_record_deleted(sender, **kwargs):
+    """
+    Refresh gradebook score of the enrollment and grade category 
+    of deleted content record.
+    """
+    record = kwargs['instance']
+    if record.enrollment_id is None:
+        return
+    # content may have been deleted along with record
+    content = ThreadContent.objects.select_related('course')\
+                                   .filter(id=record.content_id).first()
+    if content is None or content.grade_category_id is None:
+        return
+    from micourses.scores import refresh_gradebook_category_scores
+    refresh_gradebook_category_scores(
+        content.course, enrollment_ids=[record.enrollment_id],
+        course_grade_category_ids=[content.grade_category_id])
+
+pre_save.connect(gradebook_content_pre_save, sender=ThreadContent,
+                 dispatch_uid='gradebook-content-pre-save-signal')
+post_save.connect(gradebook_content_saved, sender=ThreadContent,
+                  dispatch_uid='gradebook-content-save-signal')
+post_delete.connect(gradebook_content_deleted, sender=ThreadContent,
+                    dispatch_uid='gradebook-content-delete-signal')
+post_delete.connect(gradebook_record_deleted, sender=ContentRecord,
+                    dispatch_uid='gradebook-record-delete-signal')
@@ -1,8 +1,113 @@
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from mitesting.render_questions import render_question
+from copy import deepcopy
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class AssessmentStructure(object):
+    """
+    The question sets of an assessment, along with the questions
+    assigned to each question set and the weight and group
+    of any question set detail.
+
+    Structures are created by return_assessment_structure,
+    which loads the question assignments and question set details 
+    with two queries and caches the results per assessment revision.
+    The questions themselves are loaded with a single query the first
+    time they are needed, so that each structure has current questions.
+
+    Questions of each question set are in the order of the 
+    question assignments, so that choosing a question with
+    rng.choice gives the same result as choosing from the queryset
+    questionassigned_set.filter(question_set=question_set).
+    """
+
+    def __init__(self, assessment, question_set_info):
+        """
+        question_set_info should be a tuple, ordered by question set, of
+        (question_set, question_ids, weight, group)
+        """
+        self.assessment = assessment
+        self.question_set_info = question_set_info
+        self._details = dict((question_set, (weight, group)) for 
+                             (question_set, question_ids, weight, group)
+                             in question_set_info)
+        self._questions_by_id = None
+
+    @classmethod
+    def load_question_set_info(cls, assessment):
+        question_details = {}
+        for (question_set, weight, group) in \
+            assessment.questionsetdetail_set.values_list(
+                'question_set', 'weight', 'group'):
+            question_details[question_set] = (weight, group)
+
+        question_set_info = []
+        question_ids = None
+        for (question_set, question_id) in assessment.questionassigned_set\
+                .order_by('question_set', 'id')\
+                .values_list('question_set', 'question_id'):
+            if not question_set_info or \
+               question_set_info[-1][0] != question_set:
+                (weight, group) = question_details.get(question_set, (1, ""))
+                question_ids = []
+                question_set_info.append((question_set, question_ids,
+                                          weight, group))
+            question_ids.append(question_id)
+
+        return tuple((question_set, tuple(question_ids), weight, group)
+                     for (question_set, question_ids, weight, group)
+                     in question_set_info)
+
+    def question_sets(self):
+        return [info[0] for info in self.question_set_info]
+
+    def weight_and_group(self, question_set):
+        """
+        Return weight and group of question_set, 
+        which are 1 and blank if question set has no detail.
+        """
+        return self._details.get(question_set, (1, ""))
+
+    def questions(self, question_set_index):
+        """
+        Return list of questions assigned to the question set
+        with index question_set_index.
+        """
+        if self._questions_by_id is None:
+            from mitesting.models import Question
+            question_ids = set()
+            for info in self.question_set_info:
+                question_ids.update(info[1])
+            self._questions_by_id = Question.objects.in_bulk(
+                list(question_ids))
+        return [self._questions_by_id[question_id] for question_id
+                in self.question_set_info[question_set_index][1]]
+
+
+def return_assessment_structure(assessment):
+    """
+    Return AssessmentStructure of assessment, 
+    using question set information from assessment_structure_cache,
+    keyed by assessment id and assessment revision.
+    """
+    from micourses.caches import assessment_structure_cache
+
+    cache_key = (assessment.id, assessment.revision)
+    question_set_info = assessment_structure_cache.get(cache_key)
+    if question_set_info is None:
+        question_set_info = AssessmentStructure.load_question_set_info(
+            assessment)
+        assessment_structure_cache.set(cache_key, question_set_info)
+
+    return AssessmentStructure(assessment, question_set_info)
+
 
 def get_question_list(assessment, seed, rng=None, thread_content=None,
-                      questions_only=False):
+                      questions_only=False, assessment_structure=None):
     """
     Return list of questions for assessment, one for each question_set,
     along with additional information about each question.
@@ -17,6 +122,10 @@ def get_question_list(assessment, seed, rng=None, thread_content=None,
     generate the question and/or solution, ensuring that question
     and solution will match.
 
+    Question sets are drawn from assessment_structure, if given,
+    or else from the cached return_assessment_structure(assessment),
+    so that question lists for many seeds can be generated
+    from a single load.
 
     Return a list of dictionaries, one for each question. 
     Each dictionary contains the following:
@@ -41,11 +150,13 @@ def get_question_list(assessment, seed, rng=None, thread_content=None,
 
     from mitesting.utils import get_new_seed
 
-    for question_set in assessment.question_sets():
-        questions_in_set = assessment.questionassigned_set.filter(
-            question_set=question_set)
+    if assessment_structure is None:
+        assessment_structure = return_assessment_structure(assessment)
 
-        the_question=rng.choice(questions_in_set).question
+    for (i, (question_set, question_ids, weight, group)) in \
+        enumerate(assessment_structure.question_set_info):
+
+        the_question=rng.choice(assessment_structure.questions(i))
 
         # generate a seed for the question
         # so that can have link to this version of question and solution
@@ -58,20 +169,6 @@ def get_question_list(assessment, seed, rng=None, thread_content=None,
                               })
             continue
 
-        # find question set detail, if it exists
-        try:
-            question_detail=assessment.questionsetdetail_set.get(
-                question_set=question_set)
-        except ObjectDoesNotExist:
-            question_detail = None
-        
-        if question_detail:
-            weight=question_detail.weight
-            group=question_detail.group
-        else:
-            weight=1
-            group=""
-
         total_weight += weight
 
         question_list.append({'question_set': question_set,
@@ -179,7 +276,8 @@ def get_question_list_from_attempt(assessment, content_attempt, question_attempt
     if content_attempt.record.content.content_object != assessment:
         return []
 
-    question_sets=assessment.question_sets()
+    assessment_structure = return_assessment_structure(assessment)
+    question_sets=assessment_structure.question_sets()
     question_list = []
     total_weight=0
 
@@ -189,23 +287,14 @@ def get_question_list_from_attempt(assessment, content_attempt, question_attempt
 
         for qa in question_attempts:
             ca_question_set = qa.content_attempt_question_set
-            if cq_question_set.content_attempt != content_attempt:
+            if ca_question_set.content_attempt != content_attempt:
                 ca_qs_list=[]
                 break
 
-            # find question set detail, if it exists
-            try:
-                question_detail=assessment.questionsetdetail_set.get(
-                    question_set=question_set)
-            except ObjectDoesNotExist:
-                question_detail = None
+            question_set = ca_question_set.question_set
 
-            if question_detail:
-                weight=question_detail.weight
-                group=question_detail.group
-            else:
-                weight=1
-                group=""
+            (weight, group) = assessment_structure.weight_and_group(
+                question_set)
 
             total_weight += weight
 
@@ -250,19 +339,8 @@ def get_question_list_from_attempt(assessment, content_attempt, question_attempt
 
             question_set = ca_question_set.question_set
 
-            # find question set detail, if it exists
-            try:
-                question_detail=assessment.questionsetdetail_set.get(
-                    question_set=question_set)
-            except ObjectDoesNotExist:
-                question_detail = None
-
-            if question_detail:
-                weight=question_detail.weight
-                group=question_detail.group
-            else:
-                weight=1
-                group=""
+            (weight, group) = assessment_structure.weight_and_group(
+                question_set)
 
             total_weight += weight
 
@@ -325,7 +403,9 @@ def render_question_list(assessment, question_list, assessment_seed, rng=None,
                          show_post_user_errors=False,
                          show_correctness=True,
                          no_links=False,
-                         allow_solution_buttons=True
+                         allow_solution_buttons=True,
+                         questions_to_render=None,
+                         processes=None,
                      ):
 
     """
@@ -358,6 +438,16 @@ def render_question_list(assessment, question_list, assessment_seed, rng=None,
     - no_links: if True, then should suppress links in feedback to responses
     - allow_solution_buttons: if True, allow a solution button to be displayed
       on computer graded questions
+    - questions_to_render: if not None, a collection of the indices
+      in question_list of the questions to render.  The remaining questions
+      keep their numbering and identifiers but are not rendered, 
+      i.e., their expressions and templates are not evaluated
+      and no question_data is added to their dictionaries.
+    - processes: if greater than one, render the questions in parallel in
+      a pool of that many worker processes.  If None, use the setting
+      MICOURSES_RENDER_QUESTION_PROCESSES (default 0, i.e., render
+      sequentially).  Questions that modify auxiliary_data are rendered
+      again sequentially, so the results are the same in either case.
 
     Outputs:
     - seed that used to generate assessment (the input seed unless it was None)
@@ -405,29 +495,158 @@ def render_question_list(assessment, question_list, assessment_seed, rng=None,
         import random
         rng=random.Random()
 
-    for (i, question_dict) in enumerate(question_list):
+    if processes is None:
+        processes = getattr(settings, 'MICOURSES_RENDER_QUESTION_PROCESSES', 0)
+
+    indices_to_render = [i for i in range(len(question_list)) 
+                         if questions_to_render is None
+                         or i in questions_to_render]
+
+    # render_question options that are the same for all questions
+    render_kwargs = {
+        'solution': solution,
+        'user': user, 'show_help': not solution,
+        'assessment': assessment,
+        'assessment_seed': assessment_seed, 
+        'record_response': True,
+        'allow_solution_buttons': allow_solution_buttons,
+        'show_post_user_errors': show_post_user_errors,
+        'show_correctness': show_correctness,
+        'no_links': no_links,
+    }
+
+    # If rendering in parallel, start rendering all questions in
+    # worker processes, each with its own copy of the initial auxiliary_data.
+    # A question whose seed is not set depends on the state of rng
+    # left by previous questions, so it is not sent to a worker.
+    worker_results = {}
+    if processes and processes > 1 and len(indices_to_render) > 1:
+        pool = return_render_pool(processes)
+        initial_auxiliary_data = deepcopy(auxiliary_data)
+        for i in indices_to_render:
+            question_dict = question_list[i]
+            if question_dict.get('seed') is None:
+                continue
+            worker_kwargs = dict(render_kwargs)
+            worker_kwargs['question_identifier'] = "qa%s" % i
+            worker_kwargs['auxiliary_data'] = initial_auxiliary_data
+            worker_results[i] = pool.apply_async(
+                render_question_in_worker, (question_dict, worker_kwargs))
+
+    # Collect results in order.
+    # Rendering a question that contains applets or hidden sections 
+    # updates the counters in auxiliary_data, which must be shared
+    # by all questions on the page.  If the auxiliary data returned
+    # from a worker was changed, discard the worker results and
+    # render the question here, with the shared auxiliary_data, 
+    # so that the counters are exactly those of rendering sequentially.
+    for i in indices_to_render:
+        question_dict = question_list[i]
 
         # use qa for identifier since coming from assessment
         identifier="qa%s" % i
 
-
-        question_data = render_question(
-            question_dict,
-            rng=rng, solution=solution,
-            question_identifier=identifier,
-            user=user, show_help=not solution,
-            assessment=assessment,
-            assessment_seed=assessment_seed, 
-            record_response=True,
-            allow_solution_buttons=allow_solution_buttons,
-            auxiliary_data=auxiliary_data,
-            show_post_user_errors=show_post_user_errors,
-            show_correctness=show_correctness,
-            no_links=no_links)
+        question_data = None
+        if i in worker_results:
+            try:
+                (question_data, worker_question_dict, worker_auxiliary_data) \
+                    = worker_results[i].get()
+            except Exception as e:
+                logger.warning("Error rendering question %s in worker: %s"
+                               % (question_dict['question'], e))
+            else:
+                if worker_auxiliary_data != initial_auxiliary_data:
+                    question_data = None
+                else:
+                    copy_worker_question_state(question_dict, 
+                                               worker_question_dict)
+
+        if question_data is None:
+            question_data = render_question(
+                question_dict,
+                rng=rng, question_identifier=identifier,
+                auxiliary_data=auxiliary_data,
+                **render_kwargs)
         
         question_dict['question_data']=question_data
 
 
+    return question_list
 
 
-    return question_list
+# pools of worker processes used by render_question_list,
+# created on first use by return_render_pool.
+# Pools are keyed by the number of processes and the database names
+# given to the workers.  A pool is never terminated while the server
+# is running, as other threads may be waiting on its results.
+_render_pools = {}
+_render_pool_lock = threading.Lock()
+
+def initialize_render_worker(database_names=None):
+    """
+    Set up Django in a newly spawned worker process.
+
+    If database_names is given, it should be a dictionary of 
+    database names keyed by database alias, which replace the names
+    from the settings, so that workers use the same databases
+    as the process that created the pool (e.g., the test database).
+    """
+    if database_names:
+        for (alias, name) in database_names.items():
+            settings.DATABASES[alias]['NAME'] = name
+    import django
+    django.setup()
+
+def return_render_pool(processes):
+    """
+    Return pool of worker processes for rendering questions.
+    A pool is created on the first call with each number of processes
+    and reused by later calls with the same number of processes.
+    Pools are created while holding a lock so that threads 
+    serving concurrent requests share the same pool.
+
+    Workers are spawned rather than forked so that they don't 
+    share database connections or locks with the web server process.
+    """
+    database_names = dict((alias, database['NAME']) for (alias, database)
+                          in settings.DATABASES.items())
+    key = (processes, tuple(sorted(database_names.items())))
+
+    with _render_pool_lock:
+        pool = _render_pools.get(key)
+        if pool is None:
+            import multiprocessing
+            pool = multiprocessing.get_context('spawn').Pool(
+                processes, initializer=initialize_render_worker,
+                initargs=(database_names,))
+            _render_pools[key] = pool
+
+    return pool
+
+def render_question_in_worker(question_dict, render_kwargs):
+    """
+    Render question from question_dict in a worker process.
+
+    Return a tuple of the question_data from render_question,
+    question_dict (which render_question may modify)
+    and the auxiliary_data after rendering.
+    """
+    import random
+    question_data = render_question(question_dict, rng=random.Random(),
+                                    **render_kwargs)
+    return (question_data, question_dict, render_kwargs['auxiliary_data'])
+
+def copy_worker_question_state(question_dict, worker_question_dict):
+    """
+    Copy to question_dict the changes that render_question made
+    to the copy of question_dict in the worker process.
+    render_question records the seed actually used and 
+    may update the seed and random outcomes of the question attempt.
+    """
+    question_dict['seed'] = worker_question_dict['seed']
+    question_attempt = question_dict.get('question_attempt')
+    if question_attempt:
+        worker_question_attempt = worker_question_dict['question_attempt']
+        question_attempt.seed = worker_question_attempt.seed
+        question_attempt.random_outcomes \
+            = worker_question_attempt.random_outcomes
@@ -0,0 +1,537 @@
+from django.db import transaction
+from django.utils import timezone
+from django.contrib.contenttypes.models import ContentType
+
+
+def aggregate_values(values, aggregation):
+    """
+    Aggregate values, which is a list of tuples (order_key, value),
+    ignoring any value that is None.
+
+    Aggregation determines the calculation:
+    - 'Avg': average of values
+    - 'Las': value (even if None) with the largest order_key
+    - otherwise: maximum of values
+
+    Return None if values is empty or no values are not None
+    (except in the case of 'Las', where the last value is returned).
+
+    """
+
+    if not values:
+        return None
+
+    if aggregation == 'Las':
+        return max(values, key=lambda v: v[0])[1]
+
+    nonblank = [v[1] for v in values if v[1] is not None]
+    if not nonblank:
+        return None
+
+    if aggregation == 'Avg':
+        return sum(nonblank)/len(nonblank)
+    else:
+        return max(nonblank)
+
+
+def return_question_aggregation(content):
+    """
+    Return the aggregation used for combining question attempts or
+    question responses of content, based on question_attempt_aggregation
+    or, if set to 'Sam', on assessment_attempt_aggregation.
+    """
+    attempt_aggregation = content.question_attempt_aggregation
+    if attempt_aggregation=='Sam':
+        attempt_aggregation = content.assessment_attempt_aggregation
+    return attempt_aggregation
+
+
+def return_question_set_weights(content):
+    """
+    Return a dictionary of the weights of the question sets of the
+    assessment of content, keyed by question set.
+    Question sets without a question set detail are omitted,
+    and should be given a weight of 1.
+    """
+    from micourses.models import QuestionSetDetail
+    return dict(QuestionSetDetail.objects.filter(assessment_id=content.object_id)
+                .values_list('question_set', 'weight'))
+
+
+def calculate_content_attempt_score(content, question_sets, question_attempts,
+                                    weights):
+    """
+    Calculate the score of a content attempt without score_override,
+    using the same rules as ContentAttempt.recalculate_score,
+    from data that has already been loaded.
+
+    - content: the thread content of the attempt,
+      which must be an assessment with points
+    - question_sets: list of tuples (id, question_set, credit_override)
+      of the content attempt question sets
+    - question_attempts: list of tuples
+      (question set id, attempt_began, credit)
+      of the valid question attempts
+    - weights: dictionary of question set weights of assessment
+
+    """
+
+    if not question_sets:
+        return None
+
+    attempt_aggregation = return_question_aggregation(content)
+
+    attempts_by_set = {}
+    for (qs_id, attempt_began, credit) in question_attempts:
+        attempts_by_set.setdefault(qs_id, []).append((attempt_began, credit))
+
+    total_weight = 0.0
+    score = 0.0
+    found_non_blank_credit = False
+    for (qs_id, question_set, credit_override) in question_sets:
+        weight = weights.get(question_set, 1)
+
+        if credit_override:
+            qs_credit = credit_override
+        else:
+            set_attempts = attempts_by_set.get(qs_id)
+            if not set_attempts:
+                qs_credit = None
+            else:
+                # since have valid question attempts, make credit 0
+                # rather than None
+                qs_credit = aggregate_values(set_attempts,
+                                             attempt_aggregation) or 0
+
+        if qs_credit is None:
+            qs_credit = 0
+        else:
+            found_non_blank_credit = True
+        score += qs_credit*weight
+        total_weight += weight
+
+    if not found_non_blank_credit:
+        return None
+
+    if total_weight:
+        score *= content.points/total_weight
+    return score
+
+
+def propagate_question_attempt_credit(question_attempt):
+    """
+    Recalculate the credit of question_attempt from its valid responses
+    and propagate the change to the score of its content attempt
+    and content record.
+
+    Gives the same results as QuestionAttempt.recalculate_credit
+    followed by ContentAttempt.recalculate_score and
+    ContentRecord.recalculate_score, but
+    - loads the question sets, question attempts and question set weights
+      of the content attempt once, with one query each,
+    - stops propagating as soon as a score does not change,
+    - updates the record score from the change in the attempt score
+      when the aggregation is the maximum and the attempt score increased,
+    - writes the changed scores with single updates in one transaction.
+
+    If the record score changes, the gradebook category score
+    of the student is refreshed.
+
+    Since scores are written with updates rather than saves,
+    no revisions are created for these computed scores.
+
+    Return the credit of question_attempt.
+
+    """
+
+    from micourses.models import QuestionAttempt, ContentAttempt, \
+        ContentRecord, ContentAttemptQuestionSet, Assessment
+
+    question_attempt = QuestionAttempt.objects.select_related(
+        'content_attempt_question_set__content_attempt__record__content')\
+        .get(id=question_attempt.id)
+
+    content_attempt = question_attempt.content_attempt_question_set\
+                                      .content_attempt
+    record = content_attempt.record
+    content = record.content
+
+    with transaction.atomic():
+
+        # credit of question attempt
+        responses = question_attempt.responses.filter(valid=True)\
+            .values_list('response_submitted', 'credit')
+        credit = aggregate_values(list(responses),
+                                  return_question_aggregation(content))
+
+        if credit == question_attempt.credit:
+            return credit
+        QuestionAttempt.objects.filter(id=question_attempt.id)\
+                               .update(credit=credit)
+
+
+        # score of content attempt
+        if content_attempt.score_override is not None:
+            return credit
+
+        assessment_ct = ContentType.objects.get_for_model(Assessment)
+        if content.content_type_id != assessment_ct.id or \
+           content.points is None:
+            attempt_score = None
+        else:
+            question_sets = list(ContentAttemptQuestionSet.objects.filter(
+                content_attempt=content_attempt)
+                .values_list('id', 'question_set', 'credit_override'))
+            question_attempts = list(QuestionAttempt.objects.filter(
+                content_attempt_question_set__content_attempt=content_attempt,
+                valid=True).values_list('content_attempt_question_set',
+                                        'attempt_began', 'credit'))
+            attempt_score = calculate_content_attempt_score(
+                content, question_sets, question_attempts,
+                return_question_set_weights(content))
+
+        old_attempt_score = content_attempt.score
+        if attempt_score == old_attempt_score:
+            return credit
+        ContentAttempt.objects.filter(id=content_attempt.id)\
+                              .update(score=attempt_score)
+
+        # score of content record, which depends only on valid attempts
+        if record.score_override is not None or not content_attempt.valid \
+           or content.content_type_id != assessment_ct.id:
+            return credit
+
+        if content.assessment_attempt_aggregation not in ('Avg', 'Las') \
+           and attempt_score is not None and record.score is not None \
+           and attempt_score >= record.score:
+            # maximum can only increase to new score of this attempt
+            record_score = attempt_score
+        else:
+            attempts = ContentAttempt.objects.filter(record=record, valid=True)\
+                .values_list('attempt_created', 'score')
+            record_score = aggregate_values(
+                list(attempts), content.assessment_attempt_aggregation)
+
+        if record_score != record.score:
+            ContentRecord.objects.filter(id=record.id).update(
+                score=record_score, last_modified=timezone.now())
+            refresh_gradebook_for_record(record)
+
+    return credit
+
+
+def bulk_update_scores(model, field, values, chunk_size=500, **extra_updates):
+    """
+    Set field of the objects of model to new values,
+    where values is a dictionary of the new values keyed by object id.
+
+    Objects are updated with one query per chunk of chunk_size objects,
+    using a conditional expression to assign each object its value.
+    Any extra_updates are applied to all updated objects.
+
+    """
+
+    from django.db.models import Case, When, Value, FloatField
+
+    items = list(values.items())
+    for start in range(0, len(items), chunk_size):
+        chunk = items[start:start+chunk_size]
+        new_values = Case(
+            *[When(id=obj_id, then=Value(value, output_field=FloatField()))
+              for (obj_id, value) in chunk],
+            output_field=FloatField())
+        extra_updates[field] = new_values
+        model.objects.filter(id__in=[obj_id for (obj_id, value) in chunk])\
+                     .update(**extra_updates)
+
+
+def recalculate_thread_content_scores(content, chunk_size=500):
+    """
+    Recalculate the credit of all question attempts and
+    the scores of all content attempts and content records of content,
+    giving the same results as calling
+    recalculate_score(total_recalculation=True) on each content record.
+
+    Responses, question attempts, content attempt question sets,
+    content attempts, content records and question set weights 
+    are each loaded with a single query.
+    Credits and scores are calculated in memory
+    and only those that changed are written back, 
+    chunk_size objects per query.
+    The gradebook category scores of students whose record scores
+    changed are then refreshed.
+    Since scores are written with updates rather than saves,
+    no revisions are created for these computed scores.
+
+    Return dictionary with the number of changed
+    - question_attempts
+    - content_attempts
+    - content_records
+
+    """
+
+    from micourses.models import QuestionResponse, QuestionAttempt, \
+        ContentAttemptQuestionSet, ContentAttempt, ContentRecord, Assessment
+
+    assessment_ct = ContentType.objects.get_for_model(Assessment)
+    is_assessment = content.content_type_id == assessment_ct.id
+    has_points = is_assessment and content.points is not None
+    question_aggregation = return_question_aggregation(content)
+    if has_points:
+        weights = return_question_set_weights(content)
+
+    # credit of question attempts
+    responses_by_qa = {}
+    for (qa_id, submitted, credit) in QuestionResponse.objects.filter(
+            question_attempt__content_attempt_question_set__content_attempt__record__content=content,
+            valid=True)\
+            .values_list('question_attempt', 'response_submitted', 'credit'):
+        responses_by_qa.setdefault(qa_id, []).append((submitted, credit))
+
+    new_qa_credits = {}
+    valid_qas_by_attempt = {}
+    for (qa_id, qs_id, attempt_id, valid, attempt_began, credit) in \
+        QuestionAttempt.objects.filter(
+            content_attempt_question_set__content_attempt__record__content=content)\
+            .values_list('id', 'content_attempt_question_set',
+                         'content_attempt_question_set__content_attempt',
+                         'valid', 'attempt_began', 'credit'):
+        new_credit = aggregate_values(responses_by_qa.get(qa_id),
+                                      question_aggregation)
+        if new_credit != credit:
+            new_qa_credits[qa_id] = new_credit
+        if valid:
+            valid_qas_by_attempt.setdefault(attempt_id, []).append(
+                (qs_id, attempt_began, new_credit))
+
+    # scores of content attempts
+    question_sets_by_attempt = {}
+    for (qs_id, attempt_id, question_set, credit_override) in \
+        ContentAttemptQuestionSet.objects.filter(
+            content_attempt__record__content=content)\
+            .values_list('id', 'content_attempt', 'question_set',
+                         'credit_override'):
+        question_sets_by_attempt.setdefault(attempt_id, []).append(
+            (qs_id, question_set, credit_override))
+
+    new_attempt_scores = {}
+    valid_attempts_by_record = {}
+    for (attempt_id, record_id, score_override, valid, created, score) in \
+        ContentAttempt.objects.filter(record__content=content)\
+            .values_list('id', 'record', 'score_override', 'valid',
+                         'attempt_created', 'score'):
+        if score_override is not None:
+            new_score = score_override
+        elif not has_points:
+            new_score = None
+        else:
+            new_score = calculate_content_attempt_score(
+                content, question_sets_by_attempt.get(attempt_id),
+                valid_qas_by_attempt.get(attempt_id, []), weights)
+        if new_score != score:
+            new_attempt_scores[attempt_id] = new_score
+        if valid:
+            valid_attempts_by_record.setdefault(record_id, []).append(
+                (created, new_score))
+
+    # scores of content records
+    new_record_scores = {}
+    changed_enrollment_ids = []
+    for (record_id, enrollment_id, score_override, score) in \
+        ContentRecord.objects.filter(content=content).values_list(
+            'id', 'enrollment', 'score_override', 'score'):
+        if score_override is not None:
+            new_score = score_override
+        elif not is_assessment:
+            new_score = None
+        else:
+            attempts = valid_attempts_by_record.get(record_id, [])
+            if all(a[1] is None for a in attempts):
+                new_score = None
+            else:
+                new_score = aggregate_values(
+                    attempts, content.assessment_attempt_aggregation)
+        if new_score != score:
+            new_record_scores[record_id] = new_score
+            if enrollment_id is not None:
+                changed_enrollment_ids.append(enrollment_id)
+
+    with transaction.atomic():
+        bulk_update_scores(QuestionAttempt, 'credit', new_qa_credits,
+                           chunk_size=chunk_size)
+        bulk_update_scores(ContentAttempt, 'score', new_attempt_scores,
+                           chunk_size=chunk_size)
+        bulk_update_scores(ContentRecord, 'score', new_record_scores,
+                           chunk_size=chunk_size,
+                           last_modified=timezone.now())
+        if changed_enrollment_ids and content.grade_category_id is not None:
+            refresh_gradebook_category_scores(
+                content.course, enrollment_ids=changed_enrollment_ids,
+                course_grade_category_ids=[content.grade_category_id])
+
+    return {'question_attempts': len(new_qa_credits),
+            'content_attempts': len(new_attempt_scores),
+            'content_records': len(new_record_scores)}
+
+
+def recalculate_course_scores(course, chunk_size=500, progress=None):
+    """
+    Recalculate the credit of all question attempts and the scores of all 
+    content attempts and content records of course,
+    one thread content at a time, 
+    using recalculate_thread_content_scores.
+
+    If progress is given, it is called after each thread content as
+    progress(n_done, n_total, content, changed),
+    where changed is the dictionary returned by 
+    recalculate_thread_content_scores.
+
+    Return dictionary with the total number of changed
+    - question_attempts
+    - content_attempts
+    - content_records
+
+    """
+
+    contents = list(course.thread_contents.all())
+    totals = {'question_attempts': 0, 'content_attempts': 0,
+              'content_records': 0}
+    for (i, content) in enumerate(contents):
+        changed = recalculate_thread_content_scores(content,
+                                                    chunk_size=chunk_size)
+        for key in totals:
+            totals[key] += changed[key]
+        if progress:
+            progress(i+1, len(contents), content, changed)
+    return totals
+
+
+def calculate_category_score(course_grade_category, scores):
+    """
+    Calculate the score for course_grade_category from the list scores
+    of the content record scores in the category (with None as zero),
+    keeping only the top number_count_for_grade scores, if set,
+    and multiplying by rescale_factor.
+    """
+
+    scores = [score or 0 for score in scores]
+    n_count = course_grade_category.number_count_for_grade
+    if n_count is not None and n_count < len(scores):
+        category_score = sum(sorted(scores)[-n_count:])
+    else:
+        category_score = sum(scores)
+    return category_score*course_grade_category.rescale_factor
+
+
+def gradebook_records(course):
+    """
+    Return queryset of the content records of course that count 
+    toward the gradebook, i.e., those of undeleted content 
+    with nonzero points and a grade category of course.
+    """
+
+    from micourses.models import ContentRecord
+
+    records = ContentRecord.objects.filter(content__course=course) \
+        .exclude(content__points=None).exclude(content__points=0) \
+        .exclude(content__grade_category=None)
+
+    # in case data gets messed up and have content
+    # with grade category from other course,
+    # make sure have only grade categories from course
+    records = records.filter(content__grade_category__course = course)
+
+    # since starting with ContentRecord, could have records
+    # associated with content that was deleted
+    return records.filter(content__deleted=False)
+
+
+def refresh_gradebook_category_scores(course, enrollment_ids=None,
+                                      course_grade_category_ids=None,
+                                      chunk_size=500):
+    """
+    Recalculate the GradebookCategoryScores of course, 
+    restricted to the enrollments with ids in enrollment_ids
+    and the course grade categories with ids in course_grade_category_ids,
+    if given.
+
+    Loads the content record scores and the affected 
+    GradebookCategoryScores with one query each.
+    Only scores that changed are written back, chunk_size per query,
+    scores of enrollments that no longer have content records
+    for a category are deleted, and new scores are inserted together.
+    An enrollment gets a score for a category only if it has 
+    content records for the category.
+
+    """
+
+    from micourses.models import GradebookCategoryScore
+
+    records = gradebook_records(course).exclude(enrollment=None)
+    category_scores = GradebookCategoryScore.objects.filter(
+        course_grade_category__course=course)
+    course_grade_categories = course.coursegradecategory_set.all()
+    if enrollment_ids is not None:
+        records = records.filter(enrollment_id__in=enrollment_ids)
+        category_scores = category_scores.filter(
+            enrollment_id__in=enrollment_ids)
+    if course_grade_category_ids is not None:
+        records = records.filter(
+            content__grade_category_id__in=course_grade_category_ids)
+        category_scores = category_scores.filter(
+            course_grade_category_id__in=course_grade_category_ids)
+        course_grade_categories = course_grade_categories.filter(
+            id__in=course_grade_category_ids)
+    course_grade_categories = {cgc.id: cgc for cgc in course_grade_categories}
+
+    scores = {}
+    for (enrollment_id, cgc_id, score) in records.values_list(
+            'enrollment_id', 'content__grade_category_id', 'score'):
+        scores.setdefault((enrollment_id, cgc_id), []).append(score)
+
+    new_scores = {
+        (enrollment_id, cgc_id): calculate_category_score(
+            course_grade_categories[cgc_id], cgc_scores)
+        for ((enrollment_id, cgc_id), cgc_scores) in scores.items()}
+
+    changed_scores = {}
+    removed_ids = []
+    for (score_id, enrollment_id, cgc_id, score) in \
+        category_scores.values_list('id', 'enrollment_id',
+                                    'course_grade_category_id', 'score'):
+        try:
+            new_score = new_scores.pop((enrollment_id, cgc_id))
+        except KeyError:
+            removed_ids.append(score_id)
+        else:
+            if new_score != score:
+                changed_scores[score_id] = new_score
+
+    with transaction.atomic():
+        if removed_ids:
+            GradebookCategoryScore.objects.filter(id__in=removed_ids).delete()
+        bulk_update_scores(GradebookCategoryScore, 'score', changed_scores,
+                           chunk_size=chunk_size)
+        if new_scores:
+            GradebookCategoryScore.objects.bulk_create([
+                GradebookCategoryScore(
+                    enrollment_id=enrollment_id,
+                    course_grade_category_id=cgc_id,
+                    score=score)
+                for ((enrollment_id, cgc_id), score) in new_scores.items()])
+
+
+def refresh_gradebook_for_record(record):
+    """
+    Recalculate the GradebookCategoryScore for the enrollment and
+    grade category of content record record.
+    """
+
+    if record.enrollment_id is None:
+        return
+    content = record.content
+    if content.grade_category_id is None:
+        return
+    refresh_gradebook_category_scores(
+        content.course, enrollment_ids=[record.enrollment_id],
+        course_grade_category_ids=[content.grade_category_id])
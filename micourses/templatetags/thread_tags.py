@@ -12,10 +12,16 @@ register=Library()
 @register.inclusion_tag('micourses/threads/thread_section.html', takes_context=True)
 def thread_section(context, section):
     course=context['course']
-    thread_contents = section.thread_contents.all()
-    thread_contents = course.thread_content_select_related_content_objects(thread_contents)
 
-    child_sections = section.child_sections.all()
+    # use thread contents and child sections from a ThreadTree, if loaded
+    try:
+        thread_contents = section.tree_thread_contents
+        child_sections = section.tree_child_sections
+    except AttributeError:
+        thread_contents = section.thread_contents.all()
+        thread_contents = course.thread_content_select_related_content_objects(thread_contents)
+
+        child_sections = section.child_sections.all()
     
     return {'thread_section': section, 
             'id': section.id,
@@ -124,9 +130,9 @@ def thread_content_edit(context, content):
     
     move_up=False
     move_down=False
-    if content.find_previous(thread_contents=all_thread_contents) or content.section.find_previous():
+    if content.find_previous(thread_contents=all_thread_contents) or content.section.find_previous(course=content.course):
         move_up=True
-    if content.find_next(thread_contents=all_thread_contents) or content.section.find_next():
+    if content.find_next(thread_contents=all_thread_contents) or content.section.find_next(course=content.course):
         move_down=True
 
     app_label = content.content_object._meta.app_label
@@ -227,6 +227,72 @@ def set_up_attempts(tcase):
     question_attempt2.responses.create(response = json.dumps(response),
                                        credit=1)
 
+class TestBulkAttemptGeneration(TestCase):
+    def setUp(self):
+        set_up_data(self)
+        self.assessment.fixed_order=False
+        self.assessment.save()
+        self.thread_content.available_before_assigned=True
+        self.thread_content.save()
+
+        u=User.objects.create_user("student2", password="pass")
+        self.student2 = u.courseuser
+        self.student2_enrollment = self.course.courseenrollment_set.create(
+            student=self.student2, date_enrolled=timezone.now())
+
+    def test_matches_single_attempt_creation(self):
+        from micourses.utils import create_new_assessment_attempts, \
+            create_new_assessment_attempt
+
+        record1 = self.thread_content.contentrecord_set.get(
+            enrollment=self.student_enrollment)
+        record2 = self.thread_content.contentrecord_set.get(
+            enrollment=self.student2_enrollment)
+
+        for i in range(4):
+            new_attempts = create_new_assessment_attempts([record1])
+            attempt1 = new_attempts[0]
+            attempt2 = create_new_assessment_attempt(record2)['new_attempt']
+
+            self.assertEqual(attempt1.seed, attempt2.seed)
+            self.assertEqual(attempt1.version, attempt2.version)
+            self.assertEqual(attempt1.valid, attempt2.valid)
+
+            record1.refresh_from_db()
+            self.assertEqual(record1.latest_attempt, attempt1)
+
+            question_sets1 = [
+                (qs.question_number, qs.question_set, qa.question, qa.seed)
+                for qs in attempt1.question_sets.all()
+                for qa in qs.question_attempts.all()]
+            question_sets2 = [
+                (qs.question_number, qs.question_set, qa.question, qa.seed)
+                for qs in attempt2.question_sets.all()
+                for qa in qs.question_attempts.all()]
+            self.assertEqual(len(question_sets1), 2)
+            self.assertEqual(question_sets1, question_sets2)
+
+        self.assertEqual(record1.attempts.count(), 4)
+
+    def test_ensure_open_attempts_all_students(self):
+        from micourses.utils import ensure_open_assessment_attempt_all_students
+
+        result = ensure_open_assessment_attempt_all_students(
+            self.thread_content)
+        self.assertEqual(result, {'n_created': 2, 'n_students': 2,
+                                  'assessment_available': True})
+        for enrollment in [self.student_enrollment, self.student2_enrollment]:
+            record = self.thread_content.contentrecord_set.get(
+                enrollment=enrollment)
+            self.assertEqual(record.attempts.count(), 1)
+            self.assertIsNone(record.latest_attempt.attempt_began)
+            self.assertEqual(record.latest_attempt.question_sets.count(), 2)
+
+        result = ensure_open_assessment_attempt_all_students(
+            self.thread_content)
+        self.assertEqual(result['n_created'], 0)
+
+
 class SeleniumTests(StaticLiveServerTestCase):
 
     @classmethod
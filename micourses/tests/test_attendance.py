@@ -0,0 +1,148 @@
+from django.test import TestCase
+from micourses.tests.test_assessment_attempts import set_up_data
+from micourses.models import PRESENT, ABSENT, EXCUSED
+from micourses.attendance import AttendanceIndex
+import datetime
+import pytz
+
+
+class TestAttendanceIndex(TestCase):
+    def setUp(self):
+        set_up_data(self)
+        self.tz = pytz.timezone(self.course.attendance_time_zone)
+
+        self.course.start_date = datetime.date(2016,9,5)
+        self.course.end_date = datetime.date(2016,12,16)
+        self.course.days_of_week = "M, W, F"
+        self.course.attendance_end_of_week = "F"
+        self.course.adjust_due_attendance = True
+        self.course.last_attendance_date = datetime.date(2016,9,16)
+        self.course.save()
+        self.course.generate_attendance_dates()
+
+        self.student_enrollment.date_enrolled = self.tz.localize(
+            datetime.datetime(2016,9,1))
+        self.student_enrollment.save()
+
+        # two weeks of attendance, absent for all of second week
+        # except for an excused absence
+        presents = [PRESENT, PRESENT, PRESENT, ABSENT, EXCUSED, ABSENT]
+        for (attendance_date, present) in zip(
+                self.course.attendancedate_set.all(), presents):
+            self.student_enrollment.studentattendance_set.create(
+                date=attendance_date.date, present=present)
+
+        self.thread_content.initial_due = self.tz.localize(
+            datetime.datetime(2016,9,16,23,0))
+        self.thread_content.final_due = self.tz.localize(
+            datetime.datetime(2016,9,30,23,0))
+        self.thread_content.save()
+
+        # reload so that thread content has updated course
+        self.thread_content = self.course.thread_contents.get(
+            id=self.thread_content.id)
+
+    def test_percent_attendance(self):
+        enrollment = self.student_enrollment
+
+        dates_percents = [(datetime.date(2016,9,2), 0),
+                          (datetime.date(2016,9,9), 100),
+                          (datetime.date(2016,9,12), 75),
+                          (datetime.date(2016,9,16), 60)]
+
+        for (date, percent) in dates_percents:
+            self.assertEqual(enrollment.percent_attendance(date), percent)
+
+        # index loads attendance dates and student attendance just once
+        attendance_index = AttendanceIndex(self.course)
+        with self.assertNumQueries(2):
+            for (date, percent) in dates_percents:
+                self.assertEqual(
+                    attendance_index.percent_attendance(enrollment, date),
+                    percent)
+
+        # no attendance for instructor
+        self.assertEqual(attendance_index.percent_attendance(
+            self.instructor_enrollment, datetime.date(2016,9,16)), 0)
+
+    def test_adjusted_due(self):
+        record = self.thread_content.contentrecord_set.get(
+            enrollment=self.student_enrollment)
+
+        # full attendance first week extends due date by a week
+        attendance_index = AttendanceIndex(self.course)
+        due = self.thread_content.get_adjusted_due(
+            record, attendance_index=attendance_index)
+        self.assertEqual(due, self.tz.localize(
+            datetime.datetime(2016,9,23,23,0)))
+        self.assertEqual(self.thread_content.get_adjusted_due(record), due)
+
+        calculation = self.thread_content.adjusted_due_calculation(
+            record, attendance_index=attendance_index)
+        self.assertEqual([c['attendance_percent'] for c in calculation],
+                         [100, 60])
+        self.assertEqual(calculation[-1]['resulting_date'], due)
+
+        # content_by_date uses a single index for all content
+        content_list = self.course.content_by_date(self.student_enrollment)
+        self.assertEqual(content_list[0]['adjusted_due'], due)
+
+
+class TestRecordAttendance(TestCase):
+    def setUp(self):
+        set_up_data(self)
+        self.course.start_date = datetime.date(2016,9,5)
+        self.course.end_date = datetime.date(2016,12,16)
+        self.course.days_of_week = "M, W, F"
+        self.course.save()
+        self.course.generate_attendance_dates()
+
+    def test_record_attendance(self):
+        from micourses.attendance import record_attendance
+        from reversion.models import Revision, Version
+
+        student_id = self.student_enrollment.id
+        instructor_id = self.instructor_enrollment.id
+        self.student_enrollment.studentattendance_set.create(
+            date=datetime.date(2016,9,7), present=EXCUSED)
+
+        n_revisions = Revision.objects.count()
+        result = record_attendance(self.course, {
+            datetime.date(2016,9,5): {student_id: PRESENT,
+                                      instructor_id: ABSENT},
+            datetime.date(2016,9,6): {student_id: PRESENT},
+            datetime.date(2016,9,7): {student_id: ABSENT,
+                                      instructor_id: PRESENT},
+        })
+
+        self.assertEqual(result['n_created'], 3)
+        self.assertEqual(result['n_updated'], 0)
+        self.assertEqual(result['invalid_dates'], [datetime.date(2016,9,6)])
+        self.assertEqual(Revision.objects.count(), n_revisions+1)
+        from django.contrib.contenttypes.models import ContentType
+        from micourses.models import StudentAttendance
+        self.assertEqual(Version.objects.filter(
+            revision=Revision.objects.latest('date_created'),
+            content_type=ContentType.objects.get_for_model(StudentAttendance))
+                         .count(), 3)
+
+        attendance = {(sa.enrollment_id, sa.date): sa.present for sa in
+                      self.student_enrollment.studentattendance_set.all()}
+        # excused absence is not changed to absence
+        self.assertEqual(attendance, {
+            (student_id, datetime.date(2016,9,5)): PRESENT,
+            (student_id, datetime.date(2016,9,7)): EXCUSED})
+
+        self.course.refresh_from_db()
+        self.assertEqual(self.course.last_attendance_date,
+                         datetime.date(2016,9,7))
+
+        result = record_attendance(self.course, {
+            datetime.date(2016,9,5): {student_id: ABSENT,
+                                      instructor_id: ABSENT},
+            datetime.date(2016,9,7): {student_id: PRESENT},
+        })
+        self.assertEqual(result['n_created'], 0)
+        self.assertEqual(result['n_updated'], 2)
+        self.assertEqual(self.student_enrollment.studentattendance_set.get(
+            date=datetime.date(2016,9,7)).present, PRESENT)
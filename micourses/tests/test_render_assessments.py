@@ -1,4 +1,4 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from mitesting.models import Question, QuestionType
 from micourses.models import Course, Assessment, AssessmentType
 from midocs.models import Page, PageType
@@ -175,6 +175,46 @@ class TestGetQuestionList(TestCase):
             self.assertEqual(ql['relative_weight'], 0)
 
 
+    def test_assessment_structure(self):
+        from micourses.render_assessments import return_assessment_structure
+
+        self.qsa4.question_set=3
+        self.qsa4.save()
+        self.asmt.questionsetdetail_set.create(question_set=3, weight=2,
+                                               group="g")
+        asmt = Assessment.objects.get(id=self.asmt.id)
+
+        structure = return_assessment_structure(asmt)
+        self.assertEqual(structure.question_sets(), [1,2,3])
+        self.assertEqual(structure.weight_and_group(1), (1,""))
+        self.assertEqual(structure.weight_and_group(3), (2,"g"))
+        self.assertEqual(structure.questions(2), [self.q3, self.q4])
+
+        # choices and seeds are the same as choosing from question assigned
+        for i in range(10):
+            seed = get_new_seed(self.rng)
+            question_list = get_question_list(asmt, rng=self.rng, seed=seed,
+                                              questions_only=True)
+            rng = random.Random()
+            rng.seed(seed)
+            for (ql, question_set) in zip(question_list, [1,2,3]):
+                question_assigned = rng.choice(
+                    self.asmt.questionassigned_set.filter(
+                        question_set=question_set))
+                self.assertEqual(ql['question'], question_assigned.question)
+                self.assertEqual(ql['seed'], get_new_seed(rng))
+
+        # structure is cached, just loading questions
+        with self.assertNumQueries(1):
+            return_assessment_structure(asmt).questions(0)
+
+        # changing questions assigned gives new structure
+        self.asmt.questionassigned_set.create(question=self.q2, question_set=1)
+        asmt = Assessment.objects.get(id=self.asmt.id)
+        self.assertEqual(return_assessment_structure(asmt).questions(0),
+                         [self.q1, self.q2])
+
+
 class TestRenderQuestionList(TestCase):
     
     def setUp(self):
@@ -545,3 +585,161 @@ class TestRenderQuestionList(TestCase):
                     "Question number %i solution."
                     % (qs.index(question_dict['question'])+1))
             
+
+
+    def test_questions_to_render(self):
+        self.asmt.fixed_order=True
+        self.asmt.save()
+
+        question_list = get_question_list(self.asmt, rng=self.rng,
+                                          seed=get_new_seed(self.rng))
+        question_list = render_question_list(
+            self.asmt, rng=self.rng, question_list = question_list,
+            assessment_seed=get_new_seed(self.rng), questions_to_render=[2])
+
+        self.assertEqual(len(question_list), 4)
+        for (i,question_dict) in enumerate(question_list):
+            self.assertEqual(question_dict['question_set'], i+1)
+            if i==2:
+                question_data = question_dict['question_data']
+                self.assertEqual(question_data['rendered_text'],
+                                 "Question number 3 text.")
+                self.assertEqual(question_data['identifier'], "qa2")
+            else:
+                self.assertFalse('question_data' in question_dict)
+
+
+class TestRenderQuestionListInWorkers(TransactionTestCase):
+    """
+    Render question list in a pool of worker processes.
+    Data must be committed so that the spawned workers see it,
+    and workers cannot share an in-memory database.
+    """
+
+    def setUp(self):
+        from django.db import connection
+        database_name = connection.settings_dict['NAME']
+        if connection.vendor == 'sqlite' and (
+                database_name == ':memory:' or 'mode=memory' in database_name):
+            self.skipTest("worker processes cannot use in-memory database")
+
+        from django.contrib.contenttypes.models import ContentType
+        from micourses.models import STUDENT_ROLE
+        from mitesting.models import Expression
+        from midocs.models import Applet, AppletType
+        from django.utils import timezone
+
+        self.course = Course.objects.create(name="course", code="course")
+        qt = QuestionType.objects.create(name="question type")
+        at = AssessmentType.objects.create(
+            code="a", name="a", assessment_privacy=0, solution_privacy=0)
+        self.asmt = Assessment.objects.create(
+            code="the_test", name="The test", assessment_type=at,
+            course=self.course, fixed_order=True)
+
+        # question whose seed changes if random numbers fail condition
+        self.q1 = Question.objects.create(
+            name="a question", question_type=qt, course=self.course,
+            question_text="m={{m}}, n={{n}}")
+        self.q1.expression_set.create(
+            name="m", expression="(-4,4)",
+            expression_type=Expression.RANDOM_NUMBER)
+        self.q1.expression_set.create(
+            name="n", expression="(-4,4)",
+            expression_type=Expression.RANDOM_NUMBER)
+        self.q1.expression_set.create(
+            name="m_greater_than_n", expression="m > n",
+            expression_type=Expression.CONDITION)
+
+        # question with an applet, which modifies auxiliary_data
+        applet_type = AppletType.objects.create(
+            code="Geogebra", name="Geogebra", description="a",
+            help_text="b", error_string="c")
+        Applet.objects.create(title="applet", code="the_applet",
+                              applet_type=applet_type, highlight=False,
+                              hidden=False)
+        self.q2 = Question.objects.create(
+            name="a question", question_type=qt, course=self.course,
+            question_text="{% applet 'the_applet' %} k={{k}}")
+        self.q2.expression_set.create(
+            name="k", expression="(1,100)",
+            expression_type=Expression.RANDOM_NUMBER)
+
+        self.q3 = Question.objects.create(
+            name="a question", question_type=qt, course=self.course,
+            question_text="j={{j}}")
+        self.q3.expression_set.create(
+            name="j", expression="(1,100)",
+            expression_type=Expression.RANDOM_NUMBER)
+
+        for q in [self.q1, self.q2, self.q3]:
+            self.asmt.questionassigned_set.create(question=q)
+
+        section = self.course.thread_sections.create(name='The section')
+        thread_content = section.thread_contents.create(
+            content_type=ContentType.objects.get_for_model(Assessment),
+            object_id=self.asmt.id, available_before_assigned=True)
+
+        u = User.objects.create_user("the_student", password="pass")
+        enrollment = self.course.courseenrollment_set.create(
+            student=u.courseuser, date_enrolled=timezone.now(),
+            role=STUDENT_ROLE)
+        record = thread_content.contentrecord_set.get(enrollment=enrollment)
+
+        from micourses.utils import create_new_assessment_attempt
+        self.content_attempt = create_new_assessment_attempt(
+            student_record=record)['new_attempt']
+
+    def render_from_attempt(self, processes):
+        from micourses.render_assessments import \
+            get_question_list_from_attempt
+        from midocs.functions import return_new_auxiliary_data
+        auxiliary_data = return_new_auxiliary_data()
+        question_list = get_question_list_from_attempt(
+            self.asmt, self.content_attempt)
+        question_list = render_question_list(
+            self.asmt, question_list=question_list,
+            assessment_seed=self.content_attempt.seed,
+            rng=random.Random(1), auxiliary_data=auxiliary_data,
+            processes=processes)
+        return (question_list, auxiliary_data)
+
+    def test_matches_serial_rendering(self):
+        from micourses.models import QuestionAttempt
+        initial_state = list(QuestionAttempt.objects.values_list(
+            'id', 'seed', 'random_outcomes'))
+
+        def reset_question_attempts():
+            for (qa_id, seed, random_outcomes) in initial_state:
+                QuestionAttempt.objects.filter(id=qa_id).update(
+                    seed=seed, random_outcomes=random_outcomes)
+
+        (serial_list, serial_auxiliary_data) = self.render_from_attempt(0)
+        serial_state = list(QuestionAttempt.objects.values_list(
+            'id', 'seed', 'random_outcomes'))
+
+        for i in range(3):
+            reset_question_attempts()
+            (question_list, auxiliary_data) = self.render_from_attempt(2)
+
+            self.assertEqual(auxiliary_data, serial_auxiliary_data)
+            self.assertEqual(list(QuestionAttempt.objects.values_list(
+                'id', 'seed', 'random_outcomes')), serial_state)
+            self.assertEqual(len(question_list), len(serial_list))
+            for (question_dict, serial_dict) in zip(question_list,
+                                                    serial_list):
+                self.assertEqual(question_dict['question'],
+                                 serial_dict['question'])
+                self.assertEqual(question_dict['seed'], serial_dict['seed'])
+                question_attempt = question_dict['question_attempt']
+                serial_attempt = serial_dict['question_attempt']
+                self.assertEqual(question_attempt.seed, serial_attempt.seed)
+                self.assertEqual(question_attempt.random_outcomes,
+                                 serial_attempt.random_outcomes)
+                question_data = question_dict['question_data']
+                serial_data = serial_dict['question_data']
+                self.assertTrue(question_data['success'])
+                self.assertEqual(question_data['rendered_text'],
+                                 serial_data['rendered_text'])
+                self.assertEqual(question_data['error_message'],
+                                 serial_data['error_message'])
@@ -8,3 +8,303 @@ Verify that get link to view content attempt details if have a question set with
 Check if have assessment with total weight zero.
 
 """
+
+from django.test import TestCase
+from micourses.tests.test_assessment_attempts import set_up_data, \
+    set_up_attempts
+from micourses.scores import aggregate_values
+import json
+
+
+class TestScorePropagation(TestCase):
+    def setUp(self):
+        set_up_data(self)
+        set_up_attempts(self)
+
+    def add_response(self, content_attempt, question_number, credit):
+        question_attempt = content_attempt.question_sets.get(
+            question_number=question_number).question_attempts.first()
+        question_attempt.responses.create(response=json.dumps([]),
+                                          credit=credit)
+
+    def check_against_total_recalculation(self):
+        self.record.refresh_from_db()
+        self.content_attempt_1.refresh_from_db()
+        self.content_attempt_2.refresh_from_db()
+        scores = (self.record.score, self.content_attempt_1.score,
+                  self.content_attempt_2.score)
+        self.record.recalculate_score(total_recalculation=True)
+        self.record.refresh_from_db()
+        self.content_attempt_1.refresh_from_db()
+        self.content_attempt_2.refresh_from_db()
+        self.assertEqual(scores,
+                         (self.record.score, self.content_attempt_1.score,
+                          self.content_attempt_2.score))
+
+    def test_aggregate_values(self):
+        values = [(1, 0.5), (3, None), (2, 1)]
+        self.assertEqual(aggregate_values(values, 'Max'), 1)
+        self.assertEqual(aggregate_values(values, 'Avg'), 0.75)
+        self.assertEqual(aggregate_values(values, 'Las'), None)
+        self.assertEqual(aggregate_values([], 'Max'), None)
+        self.assertEqual(aggregate_values([(1, None)], 'Avg'), None)
+
+    def test_maximum(self):
+        self.record.refresh_from_db()
+        self.assertEqual(self.record.score, 5)
+        self.check_against_total_recalculation()
+
+        self.add_response(self.content_attempt_1, 2, 0.5)
+        self.content_attempt_1.refresh_from_db()
+        self.assertEqual(self.content_attempt_1.score, 7.5)
+        self.check_against_total_recalculation()
+        self.assertEqual(self.record.score, 7.5)
+
+        self.add_response(self.content_attempt_2, 1, 1)
+        self.check_against_total_recalculation()
+        self.assertEqual(self.record.score, 10)
+
+    def test_average_and_last(self):
+        self.thread_content.assessment_attempt_aggregation = 'Avg'
+        self.thread_content.save()
+        self.record.recalculate_score(total_recalculation=True)
+
+        self.add_response(self.content_attempt_1, 2, 0.5)
+        self.check_against_total_recalculation()
+        self.assertEqual(self.content_attempt_1.score, 6.25)
+        self.assertEqual(self.record.score, (6.25+5)/2)
+
+        self.thread_content.assessment_attempt_aggregation = 'Las'
+        self.thread_content.save()
+        self.record.recalculate_score(total_recalculation=True)
+
+        self.add_response(self.content_attempt_1, 2, 0)
+        self.check_against_total_recalculation()
+        self.assertEqual(self.content_attempt_1.score, 5)
+        self.assertEqual(self.record.score, 5)
+
+        self.add_response(self.content_attempt_2, 1, 0.2)
+        self.check_against_total_recalculation()
+        self.assertEqual(self.content_attempt_2.score, 6)
+        self.assertEqual(self.record.score, 6)
+
+    def test_overrides(self):
+        self.content_attempt_1.score_override = 2
+        self.content_attempt_1.save()
+        self.add_response(self.content_attempt_1, 2, 1)
+        self.check_against_total_recalculation()
+        self.assertEqual(self.content_attempt_1.score, 2)
+        self.assertEqual(self.record.score, 5)
+
+        self.record.score_override = 1
+        self.record.save()
+        self.add_response(self.content_attempt_2, 1, 1)
+        self.check_against_total_recalculation()
+        self.assertEqual(self.content_attempt_2.score, 10)
+        self.assertEqual(self.record.score, 1)
+
+
+class TestBulkRecalculation(TestCase):
+    def setUp(self):
+        set_up_data(self)
+        set_up_attempts(self)
+
+    def test_recalculate_course_scores(self):
+        from micourses.models import ContentRecord, ContentAttempt, \
+            QuestionAttempt
+        from micourses.scores import recalculate_course_scores
+
+        self.content_attempt_2.score_override = 3
+        self.content_attempt_2.save()
+
+        def current_scores():
+            return (
+                sorted(QuestionAttempt.objects.values_list('id','credit')),
+                sorted(ContentAttempt.objects.values_list('id','score')),
+                sorted(ContentRecord.objects.values_list('id','score')),
+            )
+
+        scores = current_scores()
+        self.assertEqual(ContentRecord.objects.get(id=self.record.id).score,
+                         5)
+        
+        QuestionAttempt.objects.update(credit=None)
+        ContentAttempt.objects.update(score=None)
+        ContentRecord.objects.update(score=None)
+
+        progress_calls = []
+        totals = recalculate_course_scores(
+            self.course, chunk_size=1,
+            progress=lambda *args: progress_calls.append(args))
+
+        self.assertEqual(current_scores(), scores)
+        self.assertEqual(totals, {'question_attempts': 4,
+                                  'content_attempts': 2,
+                                  'content_records': 1})
+        self.assertEqual(len(progress_calls), 1)
+        self.assertEqual(progress_calls[0][:3], (1, 1, self.thread_content))
+
+        # no changes on second run
+        totals = recalculate_course_scores(self.course)
+        self.assertEqual(totals, {'question_attempts': 0,
+                                  'content_attempts': 0,
+                                  'content_records': 0})
+
+    def test_management_command(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from micourses.models import ContentRecord
+        from django.utils.six import StringIO
+
+        ContentRecord.objects.update(score=None)
+        out = StringIO()
+        call_command('recalculate_scores', self.course.code, stdout=out)
+        self.assertIn("changed 0 question attempts, 0 content attempts, 1 content records", out.getvalue())
+        self.record.refresh_from_db()
+        self.assertEqual(self.record.score, 5)
+
+        with self.assertRaises(CommandError):
+            call_command('recalculate_scores', 'no_such_course')
+
+
+class TestGradebookCategoryScores(TestCase):
+    def setUp(self):
+        from micourses.models import GradeCategory
+        set_up_data(self)
+        grade_category = GradeCategory.objects.create(name="Quizzes")
+        self.cgc = self.course.coursegradecategory_set.create(
+            grade_category=grade_category)
+        self.thread_content.grade_category = self.cgc
+        self.thread_content.save()
+        set_up_attempts(self)
+
+    def stored_score(self):
+        from micourses.models import GradebookCategoryScore
+        return GradebookCategoryScore.objects.get(
+            enrollment=self.student_enrollment,
+            course_grade_category=self.cgc).score
+
+    def test_incremental_refresh(self):
+        self.assertEqual(self.stored_score(), 5)
+
+        question_attempt = self.content_attempt_2.question_sets.get(
+            question_number=1).question_attempts.first()
+        question_attempt.responses.create(response="[]", credit=1)
+        self.assertEqual(self.stored_score(), 10)
+
+        self.cgc.rescale_factor = 0.5
+        self.cgc.save()
+        self.assertEqual(self.stored_score(), 5)
+
+        self.record.refresh_from_db()
+        self.record.score_override = 3
+        self.record.save()
+        self.assertEqual(self.stored_score(), 1.5)
+
+        self.thread_content.grade_category = None
+        self.thread_content.save()
+        from micourses.models import GradebookCategoryScore
+        self.assertFalse(GradebookCategoryScore.objects.filter(
+            course_grade_category=self.cgc).exists())
+
+    def test_gradebook_reads_stored_scores(self):
+        from micourses.models import GradebookCategoryScore
+
+        results = self.course.student_scores_by_grade_category(self.student)
+        self.assertEqual(results['total_score'], 5)
+        self.assertEqual(results['total_points'], 10)
+        self.assertEqual(results['categories'][0]['scores'][0]['score'], 5)
+
+        # gradebook uses stored category score
+        GradebookCategoryScore.objects.update(score=7)
+        student_scores = self.course.student_scores_by_grade_category()
+        self.assertEqual(len(student_scores), 1)
+        self.assertEqual(student_scores[0]['enrollment'],
+                         self.student_enrollment)
+        self.assertEqual(student_scores[0]['total_score'], 7)
+
+        # missing category scores are calculated and saved
+        GradebookCategoryScore.objects.all().delete()
+        student_scores = self.course.student_scores_by_grade_category()
+        self.assertEqual(student_scores[0]['total_score'], 5)
+        self.assertEqual(self.stored_score(), 5)
+
+    def test_refresh_updates_existing_score(self):
+        from micourses.models import GradebookCategoryScore
+        score_id = GradebookCategoryScore.objects.get(
+            enrollment=self.student_enrollment,
+            course_grade_category=self.cgc).id
+
+        self.record.refresh_from_db()
+        self.record.score_override = 8
+        self.record.save()
+        category_score = GradebookCategoryScore.objects.get(
+            enrollment=self.student_enrollment,
+            course_grade_category=self.cgc)
+        self.assertEqual(category_score.id, score_id)
+        self.assertEqual(category_score.score, 8)
+
+    def test_refresh_on_delete(self):
+        from micourses.models import GradebookCategoryScore
+        self.assertEqual(self.stored_score(), 5)
+
+        self.record.delete()
+        self.assertFalse(GradebookCategoryScore.objects.filter(
+            enrollment=self.student_enrollment).exists())
+
+        self.record = self.thread_content.contentrecord_set.create(
+            enrollment=self.student_enrollment, score_override=4)
+        self.assertEqual(self.stored_score(), 4)
+
+        self.thread_content.delete()
+        self.assertFalse(GradebookCategoryScore.objects.filter(
+            course_grade_category=self.cgc).exists())
+
+    def test_points_change_refreshes(self):
+        self.assertEqual(self.stored_score(), 5)
+        self.thread_content.points = 0
+        self.thread_content.save()
+        from micourses.models import GradebookCategoryScore
+        self.assertFalse(GradebookCategoryScore.objects.filter(
+            course_grade_category=self.cgc).exists())
+
+    def test_category_totals_without_records(self):
+        from micourses.models import GradebookCategoryScore
+        GradebookCategoryScore.objects.update(score=7)
+
+        # only stored score is read if content scores not requested
+        student_scores = list(
+            self.course.generate_student_scores_by_grade_category(
+                score_category_ids=[]))
+        self.assertEqual(len(student_scores), 1)
+        self.assertEqual(student_scores[0]['total_score'], 7)
+        self.assertEqual(student_scores[0]['categories'][0]['scores'], [])
+
+        student_scores = list(
+            self.course.generate_student_scores_by_grade_category(
+                score_category_ids=[self.cgc.id]))
+        self.assertEqual(student_scores[0]['total_score'], 7)
+        self.assertEqual(
+            student_scores[0]['categories'][0]['scores'][0]['score'], 5)
+
+    def test_csv_exports(self):
+        from django.core.urlresolvers import reverse
+        self.client.login(username="the_instructor", password="pass")
+
+        response = self.client.get(reverse(
+            'micourses:latest_attempt_csv',
+            kwargs={'course_code': self.course.code,
+                    'content_id': self.thread_content.id}))
+        self.assertTrue(response.streaming)
+        rows = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].split(",")[1:], ["z", "x+y"])
+
+        response = self.client.post(reverse(
+            'micourses:gradebookcsv',
+            kwargs={'course_code': self.course.code}),
+            {'category_%s' % self.cgc.id: 'i', 'course_total': 't'})
+        self.assertTrue(response.streaming)
+        content = b"".join(response.streaming_content).decode()
+        self.assertIn("The Assessment", content)
+        self.assertIn("5.0", content)
@@ -163,6 +163,155 @@ class TestThreadConstruction(TestCase):
 
 
 
+    def test_thread_order(self):
+        course = Course.objects.get(id=self.course.id)
+        A, AA, B, BA, C, CA = (self.sectionA, self.sectionAA, self.sectionB,
+                               self.sectionBA, self.sectionC, self.sectionCA)
+        self.assertEqual(course.return_thread_order(),
+                         [(A.id,0), (AA.id,1), (B.id,0), (BA.id,1),
+                          (C.id,0), (CA.id,1)])
+        self.assertEqual(list(course.all_thread_section_generator()),
+                         [A, AA, B, BA, C, CA])
+
+        # thread order is stored, so navigation just loads the section
+        with self.assertNumQueries(1):
+            self.assertEqual(AA.find_next(course=course), B)
+        self.assertEqual(B.find_previous(course=course), AA)
+        self.assertEqual(A.find_previous(course=course), None)
+        self.assertEqual(CA.find_next(course=course), None)
+        self.assertEqual(A.find_next_sibling(course=course), B)
+        self.assertEqual(C.find_previous_sibling(course=course), B)
+        self.assertEqual(BA.find_previous_sibling(course=course), None)
+        self.assertEqual(AA.find_next_sibling(course=course), None)
+
+        # moving a section updates the thread order
+        self.client.login(username="designer",password="pass")
+        self.client.post(edit_section_url, {'action': 'inc_level',
+                                            'section_id': B.id})
+        course = Course.objects.get(id=self.course.id)
+        self.assertEqual(course.return_thread_order(),
+                         [(A.id,0), (AA.id,1), (B.id,1), (BA.id,2),
+                          (C.id,0), (CA.id,1)])
+        sort_orders = [ts.sort_order for ts in 
+                       course.all_thread_section_generator()]
+        self.assertEqual(sort_orders, sorted(sort_orders))
+        self.assertEqual(C.find_previous(), BA)
+        self.assertEqual(C.find_previous_sibling(), A)
+
+    def test_thread_order_not_stored_if_thread_changed(self):
+        from django.db.models import F
+        course = Course.objects.get(id=self.course.id)
+        course.invalidate_thread_order()
+
+        # thread changed by another process while computing thread order
+        Course.objects.filter(id=self.course.id).update(
+            thread_revision=F('thread_revision')+1)
+        thread_order = course.return_thread_order()
+        self.assertEqual(Course.objects.get(id=self.course.id).thread_order,
+                         None)
+
+        # but is stored when revision is current
+        course = Course.objects.get(id=self.course.id)
+        self.assertEqual(course.return_thread_order(), thread_order)
+        self.assertNotEqual(
+            Course.objects.get(id=self.course.id).thread_order, None)
+
+    def test_navigation_skips_deleted_sections(self):
+        courses = [Course.objects.get(id=self.course.id) for i in range(2)]
+        for course in courses:
+            course.return_thread_order()
+        self.sectionBA.mark_deleted()
+
+        # thread order of course instances still includes deleted section
+        self.assertEqual(self.sectionB.find_next(course=courses[0]),
+                         self.sectionC)
+        self.assertEqual(self.sectionC.find_previous(course=courses[1]),
+                         self.sectionB)
+
+    def test_thread_tree(self):
+        from micourses.thread_tree import ThreadTree
+        course = Course.objects.get(id=self.course.id)
+        course.return_thread_order()
+        A, AA, B, BA, C, CA = (self.sectionA, self.sectionAA, self.sectionB,
+                               self.sectionBA, self.sectionC, self.sectionCA)
+
+        # sections, thread contents, content types,
+        # and one query for each of the four content types
+        links = [tc.return_link() for tc in self.contentlist]
+        tree = ThreadTree(course)
+        with self.assertNumQueries(7):
+            self.assertEqual(tree.sections, [A, B, C])
+        self.assertEqual(tree.all_sections, [A, AA, B, BA, C, CA])
+
+        with self.assertNumQueries(0):
+            (treeA, treeB, treeC) = tree.sections
+            self.assertEqual(treeA.tree_child_sections, [AA])
+            self.assertEqual(treeA.tree_thread_contents, [])
+            self.assertEqual(treeB.tree_child_sections[0].tree_thread_contents,
+                             self.contentlist[1:4])
+            self.assertEqual(treeC.tree_thread_contents,
+                             self.contentlist[4:])
+            # content objects are loaded with what their links need
+            self.assertEqual(
+                [tc.return_link() for tc in
+                 treeB.tree_child_sections[0].tree_thread_contents],
+                links[1:4])
+
+    def test_thread_cache(self):
+        from django.core.cache import cache
+        cache.clear()
+
+        response = self.client.get(self.thread_url)
+        self.assertContains(response, "Section BA")
+
+        # thread revision changes when thread content changes
+        revision = Course.objects.get(id=self.course.id).thread_revision
+        tc = self.contentlist[3]
+        tc.substitute_title = "Renamed assessment"
+        tc.save()
+        self.assertEqual(Course.objects.get(id=self.course.id).thread_revision,
+                         revision+1)
+        response = self.client.get(self.thread_url)
+        self.assertContains(response, "Renamed assessment")
+
+        # and when section changes
+        self.sectionBA.name = "Renamed section"
+        self.sectionBA.save()
+        response = self.client.get(self.thread_url)
+        self.assertContains(response, "Renamed section")
+        self.assertNotContains(response, "Section BA")
+
+        # completion of content is shown to enrolled students
+        self.client.login(username="student",password="pass")
+        response = self.client.get(self.thread_url)
+        self.assertContains(response, 'id="completed_%s" hidden' % tc.id)
+        record = tc.contentrecord_set.get_or_create(
+            enrollment=self.course.courseenrollment_set.get(
+                student=self.student))[0]
+        record.complete = True
+        record.save()
+        response = self.client.get(self.thread_url)
+        self.assertNotContains(response, 'id="completed_%s" hidden' % tc.id)
+
+    def test_save_keeps_thread_revision(self):
+        course = Course.objects.get(id=self.course.id)
+        thread_order = course.return_thread_order()
+        revision = course.thread_revision
+
+        # change thread while course instance is out of date
+        self.contentlist[3].substitute_title = "Renamed assessment"
+        self.contentlist[3].save()
+        section = self.course.thread_sections.create(name="New section")
+
+        course.name = "New name"
+        course.save()
+        course = Course.objects.get(id=self.course.id)
+        self.assertEqual(course.name, "New name")
+        self.assertTrue(course.thread_revision >= revision+2)
+        self.assertEqual(course.return_thread_order(),
+                         thread_order + [(section.id, 0)])
+
+
 class SeleniumTests(StaticLiveServerTestCase):
 
     @classmethod
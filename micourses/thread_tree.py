@@ -0,0 +1,119 @@
+from django.conf import settings
+
+
+class ThreadTree(object):
+    """
+    The sections and thread contents of a course thread,
+    loaded together so that the thread can be rendered
+    without a query per section or per content object.
+
+    Sections are obtained from the stored thread order of the course
+    and loaded with one query.  All thread contents are loaded with
+    one query, and their content objects with one query per content type,
+    including the foreign keys needed for their links.
+
+    Each section is given the attributes
+    - tree_child_sections: list of child sections
+    - tree_thread_contents: list of thread contents of section
+    which the thread_section tag uses in place of querying.
+
+    Data are loaded the first time they are needed,
+    so a tree whose rendering is found in the cache costs no queries.
+
+    """
+
+    def __init__(self, course):
+        self.course = course
+        self._sections = None
+        self._all_sections = None
+
+    @property
+    def sections(self):
+        """
+        List of the top level sections of the thread.
+        """
+        if self._sections is None:
+            self.load()
+        return self._sections
+
+    @property
+    def all_sections(self):
+        """
+        List of all sections of the thread, in thread order.
+        """
+        if self._all_sections is None:
+            self.load()
+        return self._all_sections
+
+    def load(self):
+        from micourses.models import ThreadSection, ThreadContent
+
+        course = self.course
+        thread_order = course.return_thread_order()
+        sections = ThreadSection.objects.in_bulk(
+            [section_id for (section_id, depth) in thread_order])
+
+        self._sections = []
+        self._all_sections = []
+
+        # ancestors[depth] is the last section included at that depth
+        ancestors = []
+        for (section_id, depth) in thread_order:
+            del ancestors[depth:]
+            section = sections.get(section_id)
+            # skip sections missing from the thread, along with descendants
+            if section is None or len(ancestors) < depth:
+                continue
+            section.tree_child_sections = []
+            section.tree_thread_contents = []
+            if depth == 0:
+                self._sections.append(section)
+            else:
+                ancestors[-1].tree_child_sections.append(section)
+            ancestors.append(section)
+            self._all_sections.append(section)
+
+        thread_contents = list(ThreadContent.objects.filter(
+            course=course, section_id__in=list(sections))
+                               .order_by('sort_order', 'id'))
+        course.thread_content_select_related_content_objects(
+            thread_contents, select_related=True)
+
+        for thread_content in thread_contents:
+            section = sections[thread_content.section_id]
+            # avoid queries for the section and course of the content
+            thread_content._section_cache = section
+            thread_content._course_cache = course
+            try:
+                section.tree_thread_contents.append(thread_content)
+            except AttributeError:
+                pass
+
+
+def return_thread_cache_variant(enrollment, content_records):
+    """
+    Return string identifying the parts of a rendered thread
+    that depend on the user viewing it: whether or not
+    the user is enrolled and which thread contents are complete.
+    """
+    if not enrollment:
+        return "none"
+    completed = sorted(content_id for (content_id, record)
+                       in (content_records or {}).items() if record.complete)
+    return "enrolled:" + ",".join(str(content_id) for content_id in completed)
+
+
+def return_thread_cache_timeout():
+    """
+    Return the number of seconds that rendered threads are cached.
+
+    Changes to thread sections, thread contents and assessments
+    discard cached threads immediately, but changes to other content
+    objects, such as the titles of pages, are shown only once
+    the cached thread expires.
+
+    Can be changed by adding to settings.py:
+    MICOURSES_THREAD_CACHE_TIMEOUT = 600
+    A timeout of zero disables caching.
+    """
+    return getattr(settings, 'MICOURSES_THREAD_CACHE_TIMEOUT', 300)
@@ -67,13 +67,21 @@ class ThreadView(DetailView):
 
         if self.enrollment:
             context['content_records'] = \
-            {cr.content.id: cr for cr in self.enrollment.contentrecord_set.filter(content__deleted=False) }
+            {cr.content_id: cr for cr in self.enrollment.contentrecord_set.filter(content__deleted=False) }
         
         if self.object.numbered:
             context['ltag'] = "ol"
         else:
             context['ltag'] = "ul"
 
+        # thread is loaded only if its rendering isn't cached
+        from micourses.thread_tree import ThreadTree, \
+            return_thread_cache_variant, return_thread_cache_timeout
+        context['thread_tree'] = ThreadTree(self.object)
+        context['thread_cache_timeout'] = return_thread_cache_timeout()
+        context['thread_cache_variant'] = return_thread_cache_variant(
+            self.enrollment, context.get('content_records'))
+
         context['course_list'] = Course.active_courses.all()
 
         return context
@@ -516,7 +524,7 @@ class EditContentView(View):
                 # if thread_content is first in section, then move up to
                 # end of previous section
 
-                previous_section = thread_section.find_previous()
+                previous_section = thread_section.find_previous(course=course)
                 try:
                     thread_content.sort_order = previous_section\
                                   .thread_contents.last().sort_order+1
@@ -549,7 +557,7 @@ class EditContentView(View):
                 # if thread_content is last in section, then move down to
                 # beginning of next section
 
-                next_section = thread_section.find_next()
+                next_section = thread_section.find_next(course=course)
                 try:
                     thread_content.sort_order = next_section\
                                   .thread_contents.first().sort_order-1
@@ -111,42 +111,71 @@ def set_n_of_objects(course, content_object):
             super(ThreadContent,tc).save()
 
         
+def return_new_attempt_availability(thread_content, student_record,
+                                    attendance_index=None):
+    from micourses.models import NOT_YET_AVAILABLE
+    
+    # treat assessment not set up for recording as not available
+    if not thread_content.record_scores:
+        return NOT_YET_AVAILABLE
+
+    return thread_content.return_availability(
+        student_record, attendance_index=attendance_index)
+
+
+def return_new_attempt_seed_version(thread_content, assessment, student_record,
+                                    valid_attempt, n_valid_attempts,
+                                    n_invalid_attempts):
+    """
+    Return the seed and version for a new attempt of student_record 
+    on assessment, given the number of valid and invalid attempts
+    student_record already has.
+    
+    """
+    if assessment.single_version:
+       return ('1', '')
+
+    if valid_attempt:
+        attempt_number = n_valid_attempts+1
+        version = str(attempt_number)
+    else:
+        attempt_number = n_invalid_attempts+1
+        version = "x%s" % attempt_number
+
+    total_number_of_attempts = n_valid_attempts + n_invalid_attempts + 1
+
+    if thread_content.individualize_by_student:
+        version = "%s_%s" % \
+                (student_record.enrollment.student.user.username, version)
+
+    seed = "sd%s_%s_%s" % (thread_content.id, version, 
+                           total_number_of_attempts)
+    version = re.sub("_", " ", version)
+
+    return (seed, version)
+
+
 def create_new_assessment_attempt(student_record, begin_attempt=True):
 
     thread_content = student_record.content
     assessment = thread_content.content_object
 
-    from micourses.models import AVAILABLE, NOT_YET_AVAILABLE
-    assessment_availability = thread_content.return_availability(student_record)
-
-    # treat assessment not set up for recording as not available
-    if not thread_content.record_scores:
-        assessment_availability = NOT_YET_AVAILABLE
+    from micourses.models import AVAILABLE
+    assessment_availability = return_new_attempt_availability(
+        thread_content, student_record)
 
     valid_attempt=assessment_availability==AVAILABLE
 
     if assessment.single_version:
-       seed='1'
-       version = ''
+        n_valid_attempts = n_invalid_attempts = 0
     else:
-        if valid_attempt:
-            attempt_number = student_record.attempts.filter(valid=True)\
-                                                    .count()+1
-            version = str(attempt_number)
-        else:
-            attempt_number = student_record.attempts.filter(valid=False)\
-                                                    .count()+1
-            version = "x%s" % attempt_number
-
-        total_number_of_attempts = student_record.attempts.count()+1
-
-        if thread_content.individualize_by_student:
-            version = "%s_%s" % \
-                    (student_record.enrollment.student.user.username, version)
+        n_valid_attempts = student_record.attempts.filter(valid=True).count()
+        n_invalid_attempts = student_record.attempts.filter(valid=False)\
+                                                    .count()
         
-        seed = "sd%s_%s_%s" % (thread_content.id, version, 
-                               total_number_of_attempts)
-        version = re.sub("_", " ", version)
+    (seed, version) = return_new_attempt_seed_version(
+        thread_content, assessment, student_record, valid_attempt,
+        n_valid_attempts, n_invalid_attempts)
 
     # create the new attempt
     with transaction.atomic(), reversion.create_revision():
@@ -179,22 +208,167 @@ def create_new_assessment_attempt(student_record, begin_attempt=True):
             'assessment_availability': assessment_availability }
             
 
-def ensure_open_assessment_attempt(student_record):
+def create_new_assessment_attempts(student_records, begin_attempt=True,
+                                   chunk_size=500, attendance_index=None):
+    """
+    Create a new attempt for each of student_records, 
+    which must all be records of the same assessment thread content.
+
+    Gives the same attempts, question sets and question attempts
+    as calling create_new_assessment_attempt on each record,
+    but the assessment structure is loaded once, each question list
+    is computed in memory from the attempt seed,
+    and attempts, question sets, question attempts and change logs
+    are inserted with bulk_create, chunk_size objects per query.
+    Since objects are inserted in bulk rather than saved,
+    no revisions are created for them.
+
+    If attendance_index is given, it is used to determine
+    the availability of the assessment for each student.
+
+    Return list of the new attempts.
+
+    """
+
+    student_records = list(student_records)
+    if not student_records:
+        return []
+
+    from micourses.models import AVAILABLE, ContentRecord, ContentAttempt, \
+        ContentAttemptQuestionSet, QuestionAttempt, ChangeLog
+    from micourses.render_assessments import get_question_list, \
+        return_assessment_structure
+    from django.contrib.contenttypes.models import ContentType
+    from django.db.models import Count, Max, Case, When, Value, IntegerField
+    import random
+
+    thread_content = student_records[0].content
+    assessment = thread_content.content_object
+    record_ids = [record.id for record in student_records]
+
+    if attendance_index is None:
+        from micourses.attendance import AttendanceIndex
+        attendance_index = AttendanceIndex(
+            thread_content.course,
+            enrollment_ids=[record.enrollment_id for record in student_records])
+
+    attempt_counts = {}
+    if not assessment.single_version:
+        # clear default ordering so that it isn't added to the grouping
+        for row in ContentAttempt.objects.filter(record_id__in=record_ids)\
+                .order_by().values('record_id', 'valid')\
+                .annotate(n=Count('id')):
+            attempt_counts[(row['record_id'], row['valid'])] = row['n']
+
+    assessment_structure = return_assessment_structure(assessment)
+    rng = random.Random()
+    now = timezone.now()
+
+    new_attempts = []
+    question_lists = {}
+    for record in student_records:
+        valid_attempt = return_new_attempt_availability(
+            thread_content, record, attendance_index=attendance_index) \
+            == AVAILABLE
+        (seed, version) = return_new_attempt_seed_version(
+            thread_content, assessment, record, valid_attempt,
+            attempt_counts.get((record.id, True), 0),
+            attempt_counts.get((record.id, False), 0))
+
+        new_attempts.append(ContentAttempt(
+            record=record, seed=seed, valid=valid_attempt, version=version,
+            attempt_began=now if begin_attempt else None))
+
+        question_lists[record.id] = get_question_list(
+            assessment, seed=seed, rng=rng, thread_content=thread_content,
+            assessment_structure=assessment_structure)
+
+    with transaction.atomic():
+        ContentAttempt.objects.bulk_create(new_attempts, batch_size=chunk_size)
+
+        # bulk_create doesn't set ids, so look up the new attempts,
+        # which are the latest attempts of each record
+        new_attempt_ids = dict(
+            ContentAttempt.objects.filter(record_id__in=record_ids)
+            .order_by().values('record_id').annotate(latest_id=Max('id'))
+            .values_list('record_id', 'latest_id'))
+        for attempt in new_attempts:
+            attempt.id = new_attempt_ids[attempt.record_id]
+
+        new_question_sets = []
+        for attempt in new_attempts:
+            for (i,q_dict) in enumerate(question_lists[attempt.record_id]):
+                new_question_sets.append(ContentAttemptQuestionSet(
+                    content_attempt_id=attempt.id, question_number=i+1,
+                    question_set=q_dict['question_set']))
+        ContentAttemptQuestionSet.objects.bulk_create(
+            new_question_sets, batch_size=chunk_size)
+
+        question_set_ids = {}
+        for (qs_id, attempt_id, question_number) in \
+            ContentAttemptQuestionSet.objects.filter(
+                content_attempt_id__in=new_attempt_ids.values())\
+            .values_list('id', 'content_attempt_id', 'question_number'):
+            question_set_ids[(attempt_id, question_number)] = qs_id
+        for question_set in new_question_sets:
+            question_set.id = question_set_ids[
+                (question_set.content_attempt_id, question_set.question_number)]
+
+        new_question_attempts = []
+        for attempt in new_attempts:
+            for (i,q_dict) in enumerate(question_lists[attempt.record_id]):
+                new_question_attempts.append(QuestionAttempt(
+                    content_attempt_question_set_id=question_set_ids[
+                        (attempt.id, i+1)],
+                    question=q_dict['question'], seed=q_dict['seed'],
+                    valid=attempt.valid))
+        QuestionAttempt.objects.bulk_create(new_question_attempts,
+                                            batch_size=chunk_size)
+
+        # point the latest attempt of each record to its new attempt
+        items = list(new_attempt_ids.items())
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start+chunk_size]
+            ContentRecord.objects.filter(
+                id__in=[record_id for (record_id, attempt_id) in chunk])\
+                .update(last_modified=now, latest_attempt_id=Case(
+                    *[When(id=record_id, 
+                           then=Value(attempt_id, output_field=IntegerField()))
+                      for (record_id, attempt_id) in chunk],
+                    output_field=IntegerField()))
+
+        attempt_ct = ContentType.objects.get(app_label="micourses",
+                                             model="contentattempt")
+        question_set_ct = ContentType.objects.get(
+            app_label="micourses", model="contentattemptquestionset")
+        change_logs = [ChangeLog(content_type=attempt_ct, object_id=attempt.id,
+                                 action="create",
+                                 new_value=json_dump_fields(attempt))
+                       for attempt in new_attempts]
+        change_logs += [ChangeLog(content_type=question_set_ct,
+                                  object_id=question_set.id, action="create",
+                                  new_value=json_dump_fields(question_set))
+                        for question_set in new_question_sets]
+        ChangeLog.objects.bulk_create(change_logs, batch_size=chunk_size)
+
+    for (record, attempt) in zip(student_records, new_attempts):
+        record.latest_attempt = attempt
+        record.last_modified = now
+
+    return new_attempts
+
+
+def check_open_assessment_attempt(student_record, attendance_index=None):
     # check if there is an open, valid, unexpired assessment attempt for student
-    # if not, create and return a new attempt
+    # closing the latest attempt if it has expired
 
     thread_content = student_record.content
 
     # check if the assessment is even available
-    assessment = thread_content.content_object
-
     from micourses.models import AVAILABLE
-    assessment_available = \
-            thread_content.return_availability(student_record) == AVAILABLE
-
-    # treat assessment not set up for recording as not available
-    if not thread_content.record_scores:
-        assessment_available = False
+    assessment_available = return_new_attempt_availability(
+        thread_content, student_record, attendance_index=attendance_index) \
+        == AVAILABLE
 
     result = {'closed_expired': False, 'found_valid': False, 
                    'created_new': False, 'new_attempt_info': None,
@@ -217,10 +391,19 @@ def ensure_open_assessment_attempt(student_record):
         # if have a valid and open attempt, don't create anything
         if latest_attempt.valid and not latest_attempt.closed:
             result['found_valid'] = True
-            return result
 
-    # if assessment isn't available, don't bother trying to create attempt
-    if not assessment_available:
+    return result
+
+
+def ensure_open_assessment_attempt(student_record):
+    # check if there is an open, valid, unexpired assessment attempt for student
+    # if not, create and return a new attempt
+
+    result = check_open_assessment_attempt(student_record)
+
+    # if have a valid and open attempt, don't create anything
+    # and if assessment isn't available, don't bother trying to create attempt
+    if result['found_valid'] or not result['assessment_available']:
         return result
 
     # create new attempt
@@ -233,31 +416,53 @@ def ensure_open_assessment_attempt(student_record):
     return result
 
 
-def ensure_open_assessment_attempt_all_students(thread_content):
+def ensure_open_assessment_attempt_all_students(thread_content, 
+                                                enrollment_ids=None):
     # for each student, create an open, valid, unexpired attempt 
-    # if none exists
+    # if none exists.
+    # Records are checked one by one, but the new attempts are
+    # created together with create_new_assessment_attempts.
+    # If enrollment_ids is given, include just students with those enrollments
 
     from micourses.models import STUDENT_ROLE
 
-    n_created = 0
     n_students = 0
     result = {}
-    
-    
-    for student_record in thread_content.contentrecord_set.filter(
-            enrollment__role=STUDENT_ROLE):
-        result= ensure_open_assessment_attempt(student_record)
-        if result['created_new']:
-            n_created += 1
+    records_needing_attempts = []
+
+    student_records = thread_content.contentrecord_set.filter(
+        enrollment__role=STUDENT_ROLE)
+    if enrollment_ids is not None:
+        student_records = student_records.filter(
+            enrollment_id__in=enrollment_ids)
+
+    # load attendance once for the availability of all students
+    from micourses.attendance import AttendanceIndex
+    attendance_index = AttendanceIndex(thread_content.course,
+                                       enrollment_ids=enrollment_ids)
+
+    for student_record in student_records.select_related(
+            'latest_attempt', 'enrollment__student__user'):
+        # avoid looking up the same thread content for each record
+        student_record.content = thread_content
+        result= check_open_assessment_attempt(
+            student_record, attendance_index=attendance_index)
+        if not result['found_valid'] and result['assessment_available']:
+            records_needing_attempts.append(student_record)
         n_students +=1
 
+    # create new attempts
+    # with attempt_began=None so that doesn't start until student views
+    new_attempts = create_new_assessment_attempts(
+        records_needing_attempts, begin_attempt=False,
+        attendance_index=attendance_index)
 
     if n_students:
         assessment_available = result['assessment_available']
     else:
-        assessmnet_available = None
+        assessment_available = None
 
-    return {'n_created': n_created, 'n_students': n_students,
+    return {'n_created': len(new_attempts), 'n_students': n_students,
             'assessment_available': assessment_available}
 
 
@@ -665,3 +870,14 @@ def extend_due_date(course, content, student, due):
     print("Extended due date of %s" % content_record)
     print("New due date: %s" % due)
     
+
+
+class Echo(object):
+    """
+    An object that implements just the write method of the file-like
+    interface, returning the value written.
+    Used with csv.writer to generate the lines of a CSV file
+    for a StreamingHttpResponse.
+    """
+    def write(self, value):
+        return value
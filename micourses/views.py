@@ -3,7 +3,7 @@ from micourses.models import Course, CourseUser, ThreadContent, QuestionAttempt,
 from micourses.forms import ContentAttemptForm, ScoreForm, CreditForm, AttemptScoresForm
 from django.conf import settings
 from django.shortcuts import render_to_response, get_object_or_404, redirect, render
-from django.http import HttpResponseRedirect, HttpResponse, JsonResponse
+from django.http import HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.template import RequestContext, Context, Template
@@ -1587,7 +1587,9 @@ class EditCourseContentAttemptScores(CourseBaseView):
 
         from micourses.models import ContentAttempt
 
-        skipdate_dict = {sd.date: sd.id for sd in self.course.courseskipdate_set.all() }
+        # load attendance of all students once for adjusted due dates
+        from micourses.attendance import AttendanceIndex
+        attendance_index = AttendanceIndex(self.course)
 
 
         for cca in ccas:
@@ -1613,7 +1615,7 @@ class EditCourseContentAttemptScores(CourseBaseView):
 
                 try:
                     past_due = self.thread_content.get_adjusted_due(
-                        content_record, skipdate_dict=skipdate_dict) \
+                        content_record, attendance_index=attendance_index) \
                         < cca.attempt_began
                 except TypeError:
                     past_due = False
@@ -1781,78 +1783,136 @@ class LatestContentAttemptsCSV(CourseBaseMixin, View):
 
         content_records = self.thread_content.contentrecord_set.filter(enrollment__role=STUDENT_ROLE)
 
-        # Create the HttpResponse object with the appropriate CSV header.
-        hresponse = HttpResponse(content_type='text/csv; charset=utf-8')
-        hresponse['Content-Disposition'] = 'attachment; filename="gradebook.csv"'
+        # Since the number of columns for each question is the 
+        # largest number of answer fields found in any response,
+        # make a first pass through the responses to determine 
+        # the number of fields per question, 
+        # then stream the rows in a second pass,
+        # so that responses are never all held in memory.
+        fields_per_question = []
+        for (student_name, question_responses) in \
+            self.generate_latest_responses(content_records):
+            for (i, responses) in enumerate(question_responses):
+                if i < len(fields_per_question):
+                    fields_per_question[i] = max(fields_per_question[i],
+                                                 len(responses))
+                else:
+                    fields_per_question.append(len(responses))
 
-        import csv, json 
-        writer = csv.writer(hresponse)
+        n_questions = len(fields_per_question)
 
-        student_names = []
-        question_rows = []
-        fields_per_question = []
-        
-        for cr in content_records:
-            try:
-                ca = cr.attempts.filter(valid=True).latest()
-            except ObjectDoesNotExist:
-                continue
+        def generate_rows():
+            for (student_name, question_responses) in \
+                self.generate_latest_responses(content_records):
+                row = [student_name,]
+                for j in range(n_questions):
+                    try:
+                        qr = question_responses[j]
+                    except IndexError:
+                        qr = []
+                    row.extend(qr)
+                    fpq = fields_per_question[j]
+                    if len(qr) < fpq:
+                        row.extend(['']*(fpq-len(qr)))
+                yield row
 
+        import csv
+        from micourses.utils import Echo
+        writer = csv.writer(Echo())
+        hresponse = StreamingHttpResponse(
+            (writer.writerow(row) for row in generate_rows()),
+            content_type='text/csv; charset=utf-8')
+        hresponse['Content-Disposition'] = 'attachment; filename="gradebook.csv"'
 
-            student_names.append(cr.enrollment.student.get_full_name())
-            
-            
-            for (i,qs) in enumerate(ca.question_sets.all()):
-                try:
-                    qr = question_rows[i]
-                except IndexError:
-                    question_rows.append([])
-                    qr = question_rows[i]
-                try:
-                    fpq = fields_per_question[i]
-                except IndexError:
-                    fields_per_question.append(0)
-                    fpq = 0
+        return hresponse
 
-                try:
-                    responses = json.loads(qs.question_attempts.filter(valid=True).latest().responses.filter(valid=True).latest().response)
-                except ObjectDoesNotExist:
-                    qr.append([])
-                    continue
 
-                num_fields = len(responses)
-                if num_fields > fpq:
-                    fields_per_question[i] = num_fields
+    def generate_latest_responses(self, content_records, chunk_size=100):
+        """
+        For each content record of content_records with a valid attempt,
+        yield a tuple (student_name, question_responses),
+        where question_responses is a list with an entry for each question 
+        set of the latest valid attempt, in order of question number.
+        Each entry is the list of the responses of each answer field
+        from the latest valid response of the latest valid question attempt,
+        or an empty list if there is no such response.
 
-                resplist = []
-                for r in responses:
-                    resplist.append(r['response'])
-                qr.append(resplist)
+        Records are processed chunk_size at a time, 
+        with a fixed number of queries for each chunk.
 
-                print(question_rows)   
-                print(fields_per_question)
+        """
 
-        n_questions = len(fields_per_question)
-        print(fields_per_question)
-        print(n_questions)
-        print(question_rows[0])
-        for (i,sn) in enumerate(student_names):
-            row = [sn,]
-            for j in range(n_questions):
-                print(i,j)
+        from micourses.models import ContentRecord, ContentAttempt, \
+            ContentAttemptQuestionSet
+        import json
+
+        def latest_by_key(rows):
+            # from rows of (id, key, time), 
+            # return dictionary of the id with the latest time for each key
+            latest = {}
+            for (obj_id, key, time) in rows:
+                if key not in latest or time >= latest[key][1]:
+                    latest[key] = (obj_id, time)
+            return {key: value[0] for (key, value) in latest.items()}
+
+        record_ids = list(content_records.order_by('id')
+                          .values_list('id', flat=True))
+
+        for start in range(0, len(record_ids), chunk_size):
+            chunk = record_ids[start:start+chunk_size]
+
+            records = ContentRecord.objects.filter(id__in=chunk)\
+                .select_related('enrollment__student__user').order_by('id')
+
+            latest_attempts = latest_by_key(ContentAttempt.objects.filter(
+                record_id__in=chunk, valid=True).values_list(
+                    'id', 'record_id', 'attempt_created'))
+
+            question_sets = {}
+            for (qs_id, ca_id) in ContentAttemptQuestionSet.objects.filter(
+                    content_attempt_id__in=latest_attempts.values())\
+                    .order_by('question_number')\
+                    .values_list('id', 'content_attempt_id'):
+                question_sets.setdefault(ca_id, []).append(qs_id)
+
+            latest_question_attempts = latest_by_key(
+                QuestionAttempt.objects.filter(
+                    content_attempt_question_set__content_attempt_id__in=
+                    latest_attempts.values(), valid=True)
+                .values_list('id', 'content_attempt_question_set_id',
+                             'attempt_began'))
+
+            latest_responses = latest_by_key(
+                QuestionResponse.objects.filter(
+                    question_attempt_id__in=latest_question_attempts.values(),
+                    valid=True)
+                .values_list('id', 'question_attempt_id',
+                             'response_submitted'))
+
+            response_texts = dict(QuestionResponse.objects.filter(
+                id__in=latest_responses.values())
+                .values_list('id', 'response'))
+
+            for cr in records:
                 try:
-                    qr= question_rows[j][i]
-                except IndexError:
-                    qr = []
-                print(qr)
-                row.extend(qr)
-                fpq = fields_per_question[j]
-                if len(qr) < fpq:
-                    row.extend(['']*(fpq-len(qr)))
-            print(row)
-            writer.writerow(row)
-        
-        return hresponse
+                    ca_id = latest_attempts[cr.id]
+                except KeyError:
+                    continue
+
+                question_responses = []
+                for qs_id in question_sets.get(ca_id, []):
+                    try:
+                        response_id = latest_responses[
+                            latest_question_attempts[qs_id]]
+                    except KeyError:
+                        question_responses.append([])
+                        continue
+                    responses = json.loads(response_texts[response_id])
+                    question_responses.append([r['response'] 
+                                               for r in responses])
+
+                yield (cr.enrollment.student.get_full_name(),
+                       question_responses)
 
 
     
@@ -1947,112 +2007,130 @@ class GradebookCSV(CourseBaseMixin, View):
                 totaled_categories.append(cgc)
 
 
-        # Create the HttpResponse object with the appropriate CSV header.
-        response = HttpResponse(content_type='text/csv; charset=iso-8859-1')
-        response['Content-Disposition'] = 'attachment; filename="gradebook.csv"'
-
-        import csv
-        writer = csv.writer(response)
-
-        # write first header row with assessment categories
-        row=["","","",""]
-        for cgc in included_categories:
-            row.append(cgc.grade_category.name)
-            row.extend([""]*(len(assessment_names_in_category[cgc.id])-1))
-            row.append("Total")
-        row.extend(["Total"]*len(totaled_categories))
-        if include_total:
-            row.append("Course")
-        writer.writerow(row)
-
-
-        row=["Student", "ID", "Section", "Group"]
-        for cgc in included_categories:
-            row.extend(assessment_names_in_category[cgc.id])
-            row.append(cgc.grade_category.name)
-        for cgc in totaled_categories:
-            row.append(cgc.grade_category.name)
-        if include_total:
-            row.append("Total")
-        writer.writerow(row)
-
-        student_scores = self.course.student_scores_by_grade_category(
-            section=section)
+        # scores of individual content are needed only
+        # for the included categories
+        score_category_ids = [cgc.id for cgc in included_categories]
+        student_scores = self.course.generate_student_scores_by_grade_category(
+            section=section, score_category_ids=score_category_ids)
+        first_student_score = next(student_scores, None)
 
         # if no student scores, 
         # then test to see if section is an integer and 
         # query with a zero-padded string
-        if not student_scores:
+        if first_student_score is None:
             try:
                 section_int = int(section)
-            except ValueError:
+            except (TypeError, ValueError):
                 pass
             else:
                 # if it is an integer, try a padded section
                 section_padded = '0'+ str(section)
-                student_scores = self.course.student_scores_by_grade_category(
-                    section=section_padded)
-
-        for score_dict in student_scores:
-            ce = score_dict['enrollment']
-            student_section = ce.section
-            student = ce.student
-            row=[str(student), student.userid, student_section, ce.group]
-            for student_category in score_dict['categories']:
-                if student_category['cgc'] not in included_categories:
-                    continue
-                for assessment_results in student_category['scores']:
-                    score = assessment_results['score']
-                    if score is None:
-                        score=0
-                    row.append(round(score*10)/10.0)
-                row.append(round(student_category['student_score']*10)/10.0)
+                student_scores = self.course\
+                    .generate_student_scores_by_grade_category(
+                        section=section_padded,
+                        score_category_ids=score_category_ids)
+                first_student_score = next(student_scores, None)
+
+        if first_student_score is not None:
+            from itertools import chain
+            student_scores = chain([first_student_score], student_scores)
+
+        def generate_rows():
+            # first header row with assessment categories
+            row=["","","",""]
+            for cgc in included_categories:
+                row.append(cgc.grade_category.name)
+                row.extend([""]*(len(assessment_names_in_category[cgc.id])-1))
+                row.append("Total")
+            row.extend(["Total"]*len(totaled_categories))
+            if include_total:
+                row.append("Course")
+            yield row
 
-            for student_category in score_dict['categories']:
-                if student_category['cgc'] not in totaled_categories:
-                    continue
 
-                row.append(round(student_category['student_score']*10)/10.0)
+            row=["Student", "ID", "Section", "Group"]
+            for cgc in included_categories:
+                row.extend(assessment_names_in_category[cgc.id])
+                row.append(cgc.grade_category.name)
+            for cgc in totaled_categories:
+                row.append(cgc.grade_category.name)
+            if include_total:
+                row.append("Total")
+            yield row
+
+            for score_dict in student_scores:
+                ce = score_dict['enrollment']
+                student_section = ce.section
+                student = ce.student
+                row=[str(student), student.userid, student_section, ce.group]
+                for student_category in score_dict['categories']:
+                    if student_category['cgc'] not in included_categories:
+                        continue
+                    for assessment_results in student_category['scores']:
+                        score = assessment_results['score']
+                        if score is None:
+                            score=0
+                        row.append(round(score*10)/10.0)
+                    row.append(
+                        round(student_category['student_score']*10)/10.0)
+
+                for student_category in score_dict['categories']:
+                    if student_category['cgc'] not in totaled_categories:
+                        continue
 
+                    row.append(
+                        round(student_category['student_score']*10)/10.0)
+
+                if include_total:
+                    row.append(round(score_dict['total_score']*10)/10.0)
+
+                yield row
+
+            comments=[]
+
+            row=["Possible points","","",""]
+            for cgc in included_categories:
+                cgc_dict = grade_category_dicts[cgc.id]
+                row.extend(assessment_points_in_category[cgc.id])
+                row.append(cgc_dict['points'])
+                number_assessments = len(assessment_points_in_category[cgc.id])
+                score_comment=cgc_dict['score_comment_long']
+                if score_comment:
+                    score_comment = "Total %s is %s" % (
+                        cgc.grade_category.name, score_comment)
+                    comments.append(score_comment)
+            for cgc in totaled_categories:
+                row.append( grade_category_dicts[cgc.id]['points'])
             if include_total:
-                row.append(round(score_dict['total_score']*10)/10.0)
-
-            writer.writerow(row)
-
-        comments=[]
-
-        row=["Possible points","","",""]
-        for cgc in included_categories:
-            cgc_dict = grade_category_dicts[cgc.id]
-            row.extend(assessment_points_in_category[cgc.id])
-            row.append(cgc_dict['points'])
-            number_assessments = len(assessment_points_in_category[cgc.id])
-            score_comment=cgc_dict['score_comment_long']
-            if score_comment:
-                score_comment = "Total %s is %s" % (cgc.grade_category.name,
-                                                    score_comment)
+                row.append(self.course.total_points())
+                score_comment = "Course total is "
+                first=True
+                for cgc in self.course.coursegradecategory_set.all():
+                    if (self.course.points_for_grade_category \
+                        (cgc)):
+                        if not first:
+                            score_comment += " + "
+                        else:
+                            first=False
+                        score_comment += "Total %s" %cgc.grade_category.name
                 comments.append(score_comment)
-        for cgc in totaled_categories:
-            row.append( grade_category_dicts[cgc.id]['points'])
-        if include_total:
-            row.append(self.course.total_points())
-            score_comment = "Course total is "
-            first=True
-            for cgc in self.course.coursegradecategory_set.all():
-                if (self.course.points_for_grade_category \
-                    (cgc)):
-                    if not first:
-                        score_comment += " + "
-                    else:
-                        first=False
-                    score_comment += "Total %s" %cgc.grade_category.name
-            comments.append(score_comment)
-        writer.writerow(row)
-
-        if(comments):
-            writer.writerow([])
-            for score_comment in comments:
-                writer.writerow([score_comment])
+            yield row
+
+            if(comments):
+                yield []
+                for score_comment in comments:
+                    yield [score_comment]
+
+
+        # Stream the CSV file, one row at a time,
+        # so that the gradebook of a large course is never held in memory
+        import csv
+        from micourses.utils import Echo
+        writer = csv.writer(Echo())
+        response = StreamingHttpResponse(
+            (writer.writerow(row) for row in generate_rows()),
+            content_type='text/csv; charset=iso-8859-1')
+        response['Content-Disposition'] = 'attachment; filename="gradebook.csv"'
 
         return response
 
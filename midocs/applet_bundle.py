@@ -0,0 +1,176 @@
+class AppletBundle(object):
+    """
+    An applet along with its parameters, the parameters of its type,
+    its objects, child object links and texts,
+    loaded with one query each so that applet tags
+    and the javascript builders don't query them individually.
+
+    Bundles are shared between requests through return_applet_bundle,
+    so the loaded objects must not be modified.
+
+    """
+
+    def __init__(self, applet):
+        from midocs.models import AppletParameter
+
+        self.applet = applet
+        self.type_parameters = list(
+            applet.applet_type.valid_parameters.order_by('id'))
+
+        # values of parameters of applet, keyed by parameter id and name
+        self.parameter_values = {}
+        self.parameter_values_by_name = {}
+        for applet_parameter in AppletParameter.objects.filter(applet=applet)\
+                .select_related('parameter').order_by('id'):
+            self.parameter_values.setdefault(
+                applet_parameter.parameter_id, applet_parameter.value)
+            self.parameter_values_by_name.setdefault(
+                applet_parameter.parameter.parameter_name,
+                applet_parameter.value)
+
+        self.objects = list(applet.appletobject_set.select_related(
+            'object_type'))
+        self.texts = list(applet.applettext_set.all())
+        self.child_object_links = list(
+            applet.appletchildobjectlink_set.order_by('id'))
+        self._child_bundle = None
+
+    @property
+    def child_bundle(self):
+        """
+        Bundle of the child applet, or None if no child applet.
+        """
+        if self._child_bundle is None and self.applet.child_applet_id:
+            self._child_bundle = return_applet_bundle(
+                self.applet.child_applet)
+        return self._child_bundle
+
+    def parameter_items(self, skip=("DEFAULT_WIDTH", "DEFAULT_HEIGHT")):
+        """
+        Return list of (parameter name, value) of the parameters
+        of the applet type, other than those in skip,
+        where value is from the applet if defined there,
+        otherwise the default value from the applet type.
+        Parameters without a value are omitted.
+        """
+        items = []
+        for type_parameter in self.type_parameters:
+            parameter_name = type_parameter.parameter_name
+            if parameter_name in skip:
+                continue
+            try:
+                parameter_value = self.parameter_values[type_parameter.id]
+            except KeyError:
+                parameter_value = type_parameter.default_value
+            if parameter_value:
+                items.append((parameter_name, parameter_value))
+        return items
+
+    def parameter_value(self, parameter_name):
+        """
+        Return value of parameter of applet with parameter_name.
+        Raise KeyError if applet doesn't define the parameter.
+        """
+        return self.parameter_values_by_name[parameter_name]
+
+    def type_default_value(self, parameter_name):
+        """
+        Return default value of parameter of applet type
+        with parameter_name.
+        Raise KeyError if applet type doesn't have the parameter.
+        """
+        for type_parameter in self.type_parameters:
+            if type_parameter.parameter_name == parameter_name:
+                return type_parameter.default_value
+        raise KeyError(parameter_name)
+
+    def default_size(self, parameter_name):
+        """
+        Return integer value of parameter_name (DEFAULT_WIDTH or
+        DEFAULT_HEIGHT) from the applet, if defined and nonzero,
+        else from the applet type.  Return None if not found or invalid.
+        """
+        try:
+            size = int(self.parameter_value(parameter_name))
+        except (KeyError, ValueError, TypeError):
+            size = 0
+        if size:
+            return size
+        try:
+            return int(self.type_default_value(parameter_name))
+        except (KeyError, ValueError, TypeError):
+            return None
+
+    def return_objects(self, **attributes):
+        """
+        Return list of applet objects whose attributes
+        have the given values, in the order of applet objects.
+        """
+        return [obj for obj in self.objects
+                if all(getattr(obj, attr) == value
+                       for (attr, value) in attributes.items())]
+
+    def return_object(self, **attributes):
+        """
+        Return first applet object whose attributes have
+        the given values, or None if not found.
+        """
+        objects = self.return_objects(**attributes)
+        if objects:
+            return objects[0]
+        return None
+
+    def capture_objects(self):
+        """
+        Return list of applet objects with capture_changes,
+        ordered by category_for_capture, then sort_order.
+        """
+        return sorted(self.return_objects(capture_changes=True),
+                      key=lambda obj: (obj.category_for_capture is not None,
+                                       obj.category_for_capture or "",
+                                       obj.sort_order))
+
+    def return_related_objects(self, applet_object):
+        """
+        Return list of the applet objects named in the comma separated
+        related_objects of applet_object, skipping names not found.
+        """
+        related_objects = []
+        if applet_object.related_objects:
+            for name in applet_object.related_objects.split(","):
+                related_object = self.return_object(name=name.strip())
+                if related_object is not None:
+                    related_objects.append(related_object)
+        return related_objects
+
+    def return_texts(self, **attributes):
+        """
+        Return list of applet texts whose attributes
+        have the given values, in the order of applet texts.
+        """
+        return [text for text in self.texts
+                if all(getattr(text, attr) == value
+                       for (attr, value) in attributes.items())]
+
+
+def return_applet_bundle(applet):
+    """
+    Return AppletBundle of applet, where applet is an Applet or
+    the code of an applet, using the bundle cached for the applet's
+    date_modified, if available.
+
+    Raise Applet.DoesNotExist if applet is a code of no applet.
+    """
+    from midocs.models import Applet
+    from midocs.caches import applet_bundle_cache
+
+    if not isinstance(applet, Applet):
+        applet = Applet.objects.select_related('applet_type')\
+                               .get(code=applet)
+
+    key = (applet.id, applet.date_modified, applet.applet_type_id)
+    bundle = applet_bundle_cache.get(key)
+    if bundle is None:
+        bundle = AppletBundle(applet)
+        applet_bundle_cache.set(key, bundle)
+    return bundle
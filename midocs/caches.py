@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.core.cache import cache
+from mitesting.caches import LRUCache
+import time
+
+
+# AppletBundles from return_applet_bundle, keyed by
+# (applet id, applet date_modified, applet type id).
+# Changes to the parameters, objects and texts of applets and to
+# applet types update date_modified of the applets,
+# so bundles of changed applets are no longer used by any process.
+# Size can be changed by adding to settings.py:
+# MIDOCS_APPLET_BUNDLE_CACHE_SIZE = 500
+applet_bundle_cache = LRUCache(
+    getattr(settings, 'MIDOCS_APPLET_BUNDLE_CACHE_SIZE', 200))
+
+
+# Related pages of pages from get_all_related_pages are stored
+# in the django cache, shared by all processes, as (date, related pages)
+# under a key with the page id and a version.
+# Changes to the relationships of a page delete its entry,
+# and changes to any page or relationship type increment the version,
+# so that all entries are replaced.
+# Entries are used only on the date they were made, so they expire
+# after a day.  The timeout (in seconds) can be changed by adding
+# to settings.py:
+# MIDOCS_RELATED_PAGES_CACHE_TIMEOUT = 3600
+RELATED_PAGES_VERSION_KEY = 'midocs_related_pages_version'
+
+
+def related_pages_version():
+    """
+    Return the version of the cached related pages,
+    starting from the current time if no version is stored,
+    so that entries of a version lost from the cache aren't used again.
+    """
+    version = cache.get(RELATED_PAGES_VERSION_KEY)
+    if version is None:
+        cache.add(RELATED_PAGES_VERSION_KEY, int(time.time()), None)
+        version = cache.get(RELATED_PAGES_VERSION_KEY, 0)
+    return version
+
+
+def related_pages_cache_key(page_id, version=None):
+    if version is None:
+        version = related_pages_version()
+    return "midocs_related_pages_%s_%s" % (version, page_id)
+
+
+def get_cached_related_pages(page_id, date):
+    """
+    Return the cached related pages of page with id page_id
+    for date, or None if not cached.
+    """
+    entry = cache.get(related_pages_cache_key(page_id))
+    if entry is None or entry[0] != date:
+        return None
+    return entry[1]
+
+
+def set_cached_related_pages(page_id, date, related_pages):
+    cache.set(related_pages_cache_key(page_id), (date, related_pages),
+              getattr(settings, 'MIDOCS_RELATED_PAGES_CACHE_TIMEOUT', 86400))
+
+
+def invalidate_related_pages_cache(page_ids=None):
+    """
+    Remove the cached related pages of pages with ids in page_ids,
+    or of all pages if page_ids is None.
+    """
+    if page_ids is None:
+        try:
+            cache.incr(RELATED_PAGES_VERSION_KEY)
+        except ValueError:
+            # no version stored, so entries of any old version
+            # won't be used again
+            related_pages_version()
+    else:
+        version = related_pages_version()
+        cache.delete_many([related_pages_cache_key(page_id, version)
+                           for page_id in page_ids])
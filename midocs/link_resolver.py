@@ -0,0 +1,231 @@
+class LinkResolver(object):
+    """
+    Finds the targets of internal links by code,
+    loading all pending targets of a class with one query.
+
+    Templates register the literal codes of their link targets
+    (collected when the templates are compiled) with add_targets,
+    so that the first link rendered loads the targets of all links.
+    Codes not registered in advance, such as those from variables,
+    are loaded when first looked up, along with any other pending codes.
+
+    Links are also memoized, so that repeated links to the same target
+    with the same options are created just once.
+
+    A resolver should be used for just one request,
+    as loaded objects aren't refreshed.
+
+    """
+
+    # foreign keys needed to create links to each class
+    select_related_fields = {
+        'page': ('page_type',),
+        'assessment': ('course', 'assessment_type'),
+        'auxiliaryfile': ('file_type',),
+    }
+
+    def __init__(self):
+        self._pending = {}
+        self._loaded = {}
+        self._registered = set()
+        self._page_types = None
+        self._links = {}
+
+    def add_targets(self, targets):
+        """
+        Register targets, a list of (model, code),
+        to be loaded with the next lookup of the same class.
+        """
+        if id(targets) in self._registered:
+            return
+        self._registered.add(id(targets))
+        for (model, code) in targets:
+            if code not in self._loaded.get(model, {}):
+                self._pending.setdefault(model, set()).add(code)
+
+    def objects_with_code(self, model, code):
+        """
+        Return list of instances of model with code, ordered by id,
+        loading them along with any pending codes of model.
+
+        Loaded instances are keyed by the requested code.
+        As the database may match codes without regard to case
+        (e.g., with the default collations of MySQL),
+        each instance is added to every requested code it matches.
+        """
+        loaded = self._loaded.setdefault(model, {})
+        try:
+            return loaded[code]
+        except KeyError:
+            pass
+
+        codes = self._pending.pop(model, set())
+        codes.add(code)
+        codes = {c for c in codes if c not in loaded}
+        for c in codes:
+            loaded[c] = []
+
+        queryset = model.objects.filter(code__in=list(codes))
+        fields = self.select_related_fields.get(model._meta.model_name)
+        if fields:
+            queryset = queryset.select_related(*fields)
+        for obj in queryset.order_by('id'):
+            # codes that differ by more than case, e.g., trailing spaces,
+            # aren't matched even if the database matched them
+            for c in codes:
+                if codes_match(c, obj.code):
+                    loaded[c].append(obj)
+
+        return loaded[code]
+
+    def page_types(self):
+        if self._page_types is None:
+            from midocs.models import PageType
+            self._page_types = list(PageType.objects.order_by('id'))
+        return self._page_types
+
+    def return_page_type(self, page_type=None):
+        """
+        Return page type with code page_type
+        (or page_type itself if it is a PageType),
+        or the default page type if page_type is None or not found,
+        with the same result as PageType.return_default().
+        """
+        from midocs.models import PageType
+        if isinstance(page_type, PageType):
+            return page_type
+        page_types = self.page_types()
+        if page_type is not None:
+            for pt in page_types:
+                if pt.code == page_type:
+                    return pt
+        defaults = [pt for pt in page_types if pt.default]
+        if len(defaults) == 1:
+            return defaults[0]
+        if page_types:
+            return page_types[0]
+        return None
+
+    def find(self, model, code):
+        """
+        Return instance of model with code.
+        Raise model.DoesNotExist if not found.
+        """
+        try:
+            return self.objects_with_code(model, code)[0]
+        except IndexError:
+            raise model.DoesNotExist
+
+    def find_page(self, code, page_type=None):
+        """
+        Return page with code and page_type, where page_type is
+        a PageType, the code of a page type or None for the default type.
+        Raise Page.DoesNotExist if not found.
+        """
+        from midocs.models import Page
+        page_type = self.return_page_type(page_type)
+        for page in self.objects_with_code(Page, code):
+            if page_type and page.page_type_id == page_type.id:
+                return page
+        raise Page.DoesNotExist
+
+    def find_auxiliary_file(self, code, file_type=None):
+        """
+        Return auxiliary file with code and file_type,
+        where file_type is an AuxiliaryFileType or its code.
+        If file_type is not specified, return any file with code.
+        Raise AuxiliaryFile.DoesNotExist if not found.
+        """
+        from midocs.models import AuxiliaryFile, AuxiliaryFileType
+        for auxiliary_file in self.objects_with_code(AuxiliaryFile, code):
+            if not file_type:
+                return auxiliary_file
+            if isinstance(file_type, AuxiliaryFileType):
+                if auxiliary_file.file_type_id == file_type.id:
+                    return auxiliary_file
+            elif auxiliary_file.file_type.code == file_type:
+                return auxiliary_file
+        raise AuxiliaryFile.DoesNotExist
+
+    def find_assessment(self, code, course=None, preferred_courses=()):
+        """
+        Return assessment with code.
+
+        If course, a Course or course code, is specified,
+        assessment must be from that course.
+        Otherwise, use the first of preferred_courses (Courses or None)
+        that contains an assessment with code,
+        then an assessment from an active course,
+        then any assessment with code.
+
+        Raise Assessment.DoesNotExist if not found.
+        """
+        from micourses.models import Assessment, Course
+        assessments = self.objects_with_code(Assessment, code)
+
+        if course:
+            for assessment in assessments:
+                if isinstance(course, Course):
+                    if assessment.course_id == course.id:
+                        return assessment
+                elif assessment.course.code == course:
+                    return assessment
+            raise Assessment.DoesNotExist
+
+        for preferred_course in preferred_courses:
+            if preferred_course is None:
+                continue
+            for assessment in assessments:
+                if assessment.course_id == preferred_course.id:
+                    return assessment
+
+        for assessment in assessments:
+            if assessment.course.active:
+                return assessment
+
+        try:
+            return assessments[0]
+        except IndexError:
+            raise Assessment.DoesNotExist
+
+    def return_link(self, target, **kwargs):
+        """
+        Return target.return_link(**kwargs),
+        memoized by target and kwargs.
+        """
+        try:
+            key = (target.__class__, target.pk,
+                   tuple(sorted(kwargs.items())))
+            return self._links[key]
+        except TypeError:
+            # kwargs aren't hashable, so don't memoize
+            return target.return_link(**kwargs)
+        except KeyError:
+            pass
+        link = target.return_link(**kwargs)
+        self._links[key] = link
+        return link
+
+
+def codes_match(code1, code2):
+    """
+    Return True if code1 and code2 are equal without regard to case.
+    """
+    try:
+        return code1.lower() == code2.lower()
+    except AttributeError:
+        return code1 == code2
+
+
+def return_link_resolver(context):
+    """
+    Return the link resolver of context, creating it if necessary.
+    The resolver is stored in the base of context
+    so that it is shared by all templates rendered with context.
+    """
+    try:
+        return context['_link_resolver_']
+    except KeyError:
+        resolver = LinkResolver()
+        context.dicts[0]['_link_resolver_'] = resolver
+        return resolver
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from midocs.models import Page
+from midocs.page_links import update_page_links
+from midocs.similarity import update_similar_pages
+
+
+class Command(BaseCommand):
+    help = "Update the embedded objects, navigation entries, citations, equation tags, external links, index entries and similar pages of pages with the given codes, or of all pages"
+
+    def add_arguments(self, parser):
+        parser.add_argument('page_codes', nargs='*')
+        parser.add_argument('--similar-only', action='store_true',
+                            dest='similar_only',
+                            help='Update just the similar pages')
+
+    def handle(self, *args, **options):
+        pages = Page.objects.all()
+        page_codes = options['page_codes']
+        if page_codes:
+            pages = pages.filter(code__in=page_codes)
+            missing = set(page_codes) - set(pages.values_list('code', flat=True))
+            if missing:
+                raise CommandError('Pages "%s" do not exist'
+                                   % '", "'.join(sorted(missing)))
+
+        page_ids = list(pages.values_list('id', flat=True))
+        if options['similar_only']:
+            n_updated = update_similar_pages(page_ids)
+            self.stdout.write(self.style.MIGRATE_SUCCESS(
+                "Updated similar pages of %s pages" % n_updated))
+        else:
+            n_updated = update_page_links(page_ids)
+            self.stdout.write(self.style.MIGRATE_SUCCESS(
+                "Updated links of %s pages" % n_updated))
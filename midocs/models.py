@@ -1,8 +1,8 @@
-from django.db import models, transaction
+from django.db import models
 from django.conf import settings
-from django.db.models import Count
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.template.loader import render_to_string
-from django.template import TemplateSyntaxError, TemplateDoesNotExist, Context, loader, Template
+from django.template import TemplateSyntaxError, TemplateDoesNotExist, loader
 from django.core.exceptions import ValidationError, ObjectDoesNotExist, MultipleObjectsReturned
 from django.contrib.contenttypes.fields import GenericRelation
 import datetime, os
@@ -474,216 +474,38 @@ class Page(models.Model):
             self.page_type_title_text = ""
 
         super(Page, self).save(*args, **kwargs) 
-        self.update_links()
+
+        # queue page for updating links, which is deferred during requests
+        from midocs.page_links import enqueue_page_links
+        enqueue_page_links([self.id])
  
     def update_links(self, force_update=0):
-        from midocs.functions import return_new_auxiliary_data
-        update_context = {'thepage': self, 'process_image_entries': 1,
-                          'process_applet_entries': 1,
-                          'process_video_entries': 1,
-                          'process_equation_tags': 1,
-                          'process_navigation_tags': 1,
-                          'process_citations': 1,
-                          'update_database': 1,
-                          'process_index_entries': 1,
-                          'blank_style': 1,
-                          'STATIC_URL': '',
-                          '_auxiliary_data_': return_new_auxiliary_data(),
-                      }
-
-        # if page is hidden, don't update image/applet/video links or index entries
-        if self.hidden:
-            update_context['process_applet_entries']=0
-            update_context['process_video_entries']=0
-            update_context['process_image_entries']=0
-            update_context['process_index_entries']=0
-
-        # delete old data regarding links from templates
-        self.embedded_images.clear()
-        self.embedded_applets.clear()
-        self.embedded_videos.clear()
-        self.pagenavigation_set.all().delete()
-        self.pagecitation_set.all().delete()
-        self.equationtag_set.all().delete()
-        self.externallink_set.all().delete()
-        self.indexentry_set.all().delete()
-
-        # parse the text field with flags to enter links into database
-        try:
-
-            Template("{% load mi_tags question_tags %}"+self.text).render(Context(update_context))
-            # save without updating links again
-            super(Page, self).save() 
-
-            #  update similar pages
-            self.update_similar()
-            
-        except:
-            pass
+        """
+        Update the database entries created by the tags in the text of page,
+        such as embedded images and applets, navigation entries,
+        citations and index entries, and then the similar pages.
+        """
+        from midocs.page_links import update_page_links
+        update_page_links([self.id])
 
 
     @classmethod
     def update_all_similar(theclass):
-        for thepage in theclass.objects.all():
-            print("Updating %s" % thepage.code)
-            thepage.update_similar()
+        """
+        Update similar pages of all pages together.
+        Return number of pages updated.
+        """
+        from midocs.similarity import update_similar_pages
+        return update_similar_pages()
             
 
     def similar_10(self):
         return self.similar.all()[0:10]
     
-    @transaction.atomic
     def update_similar(self):
         """ Update all similar pages for page """
-        # delete old similar pages
-        self.similar.all().delete()
-
-        related_pages={}
-        today=datetime.date.today()
-
-
-        background_relationship = RelationshipType.objects.get(code="background")
-        
-        background_pages = Page.objects.filter \
-            (reverse_relationships__origin=self,
-             reverse_relationships__relationship_type=
-             background_relationship) \
-             .filter(publish_date__lte=today, hidden=False) \
-             .order_by('pk')
-       
-        # find related pages based on keywords
-        # list of keywords in page
-        keyword_list = self.keywords.all().values_list('pk', flat=True)
-  
-        # get pages with keyword list, ordered in reverse by number 
-        # of matching keywords it had
-        pages_with_keywords =Page.objects.exclude(pk=self.pk) \
-            .filter(publish_date__lte=today,hidden=False) \
-            .filter(keywords__in=keyword_list) \
-            .annotate(hits=Count('keywords')).order_by('-hits')
-        try:
-            max_keyword_hits=pages_with_keywords[0].hits
-        except:
-            max_keyword_hits=0
-        pages_with_keywords=pages_with_keywords.order_by('pk')
-        
-        # find related pages based on subjects
-        # list of subjects in page
-        subject_list = self.subjects.all().values_list('pk', flat=True)
- 
-        # get pages with subject list, ordered in reverse by number 
-        # of matching subjects it had
-        pages_with_subjects =Page.objects.exclude(pk=self.pk) \
-            .filter(publish_date__lte=today,hidden=False) \
-            .filter(subjects__in=subject_list) \
-            .annotate(hits=Count('subjects')).order_by('-hits')
-        try:
-            max_subject_hits=pages_with_subjects[0].hits
-        except:
-            max_subject_hits=0
-        pages_with_subjects=pages_with_subjects.order_by('pk')
-
-  
-        # find pages that match via full text search indexing
-        try:
-            from midocs.search_functions import midocsSearchQuerySet
-            pages_mlt=midocsSearchQuerySet().models(Page).more_like_this(self)[:100]
-            max_mlt_score = pages_mlt[0].score
-            mlt_score_10 = pages_mlt[9].score
-
-            pages_mlt_list = []
-            for mp in pages_mlt:
-                pages_mlt_list.append((mp.object.pk,mp.object,mp.score))
-            pages_mlt_list=sorted(pages_mlt_list, key=lambda page: page[0])
-
-
-        except:
-            pages_mlt_list=[]
-            max_mlt_score = 1
-            mlt_score_10 = 0
-            
-            
-        # print pages_with_keywords[0].pk, pages_with_keywords[1].pk
-        # print pages_with_subjects[0].pk, pages_with_subjects[1].pk
-        # print pages_mlt_list[0][0]
-
-        try:
-            keyword_subject_weight=4*(max_mlt_score-mlt_score_10)/(max_keyword_hits+max_subject_hits)
-        except:
-            keyword_subject_weight=0
-        i_keyword=0
-        i_subject=0
-        i_mlt=0
-        i_background=0
-
-        overall_list=[]
-
-        #pages_with_keywords=pages_with_keywords[:2]
-        #pages_with_subjects=pages_with_subjects[:2]
-        #pages_mlt_list=pages_mlt_list[:2]
-
-        while(True):
-            try:
-                page_keyword = pages_with_keywords[i_keyword]
-            except:
-                i_keyword=-1
-            try:
-                page_subject = pages_with_subjects[i_subject]
-            except:
-                i_subject=-1
-            try:
-                page_mlt = pages_mlt_list[i_mlt]
-            except:
-                i_mlt=-1
-            try:
-                page_background = background_pages[i_background]
-            except:
-                i_background=-1
-  
-            #print (i_keyword,i_subject,i_mlt)
-
-            if i_keyword==-1 and i_subject==-1 and i_mlt==-1:
-                break
-
-            pks=[]
-            if i_keyword>=0:
-                pks.append(page_keyword.pk)
-            if i_subject>=0:
-                pks.append(page_subject.pk)
-            if i_mlt>=0:
-                pks.append(page_mlt[0])
-            if i_background>=0:
-                pks.append(page_background.pk)
-            
-            min_pk = min(pks)
-            
-            page_score=0
-            thepage=None
-            is_background=False
-            if i_keyword>=0 and page_keyword.pk==min_pk:
-                thepage=page_keyword
-                page_score += page_keyword.hits*keyword_subject_weight
-                i_keyword+=1
-            if i_subject>=0 and page_subject.pk==min_pk:
-                thepage=page_subject
-                page_score += page_subject.hits*keyword_subject_weight
-                i_subject+=1
-            if i_mlt>=0 and page_mlt[0]==min_pk:
-                thepage=page_mlt[1]
-                page_score += page_mlt[2]
-                i_mlt+=1
-            if i_background>=0 and page_background.pk==min_pk:
-                is_background=True
-                i_background+=1
-                
-            overall_list.append((thepage,page_score,is_background))
-
-        overall_list=sorted(overall_list,  key=lambda page: page[1], reverse=True)[:20]
-
-        for thepage in overall_list:
-            PageSimilar.objects.create \
-                (origin=self, similar=thepage[0], \
-                     score=thepage[1], background_page=thepage[2])
+        from midocs.similarity import update_similar_pages
+        update_similar_pages([self.id])
 
 
 
@@ -2041,3 +1863,96 @@ class PageCitation(models.Model):
         else:
             return "?"
 
+
+
+def applet_component_changed(sender, **kwargs):
+    from django.utils import timezone
+    Applet.objects.filter(id=kwargs['instance'].applet_id)\
+                  .update(date_modified=timezone.now())
+
+def applet_type_parameter_changed(sender, **kwargs):
+    from django.utils import timezone
+    Applet.objects.filter(applet_type_id=kwargs['instance'].applet_type_id)\
+                  .update(date_modified=timezone.now())
+
+
+# cached applet bundles and pages are keyed on applet date_modified,
+# so update it when components are changed without saving the applet
+for model in (AppletParameter, AppletObject, AppletChildObjectLink,
+              AppletText):
+    post_save.connect(applet_component_changed, sender=model,
+                      dispatch_uid='applet-bundle-save-signal')
+    post_delete.connect(applet_component_changed, sender=model,
+                        dispatch_uid='applet-bundle-delete-signal')
+post_save.connect(applet_type_parameter_changed, sender=AppletTypeParameter,
+                  dispatch_uid='applet-bundle-type-save-signal')
+post_delete.connect(applet_type_parameter_changed, sender=AppletTypeParameter,
+                    dispatch_uid='applet-bundle-type-delete-signal')
+
+
+def page_features_changed(sender, instance, action, reverse, pk_set,
+                          **kwargs):
+    """
+    Queue updating similar pages after keywords or subjects of pages change,
+    for the changed pages and the pages that share the added or removed
+    keywords or subjects, whose scores change as well.
+    Affected pages are found before the change so that
+    pages sharing removed keywords or subjects are included.
+    """
+    from midocs.similarity import return_pages_sharing_features
+    from midocs.page_links import enqueue_similar_pages
+
+    if sender is Page.keywords.through:
+        feature_field = 'keyword_id'
+    else:
+        feature_field = 'subject_id'
+
+    if action.startswith("pre_"):
+        if reverse:
+            page_ids = pk_set or []
+            feature_ids = [instance.pk]
+        else:
+            page_ids = [instance.pk]
+            feature_ids = pk_set
+        instance._similar_pages_to_update = return_pages_sharing_features(
+            sender, feature_field, page_ids, feature_ids)
+    elif action.startswith("post_"):
+        page_ids = instance.__dict__.pop('_similar_pages_to_update', set())
+        if page_ids:
+            enqueue_similar_pages(page_ids)
+
+for through in (Page.keywords.through, Page.subjects.through):
+    m2m_changed.connect(page_features_changed, sender=through,
+                        dispatch_uid='similar-pages-m2m-signal')
+
+
+def page_relationship_changed(sender, **kwargs):
+    from midocs.caches import invalidate_related_pages_cache
+    invalidate_related_pages_cache([kwargs['instance'].origin_id])
+
+def related_pages_changed(sender, **kwargs):
+    from midocs.caches import invalidate_related_pages_cache
+    invalidate_related_pages_cache()
+
+# cached related pages include the titles and codes of the related pages,
+# so discard all of them when any page or relationship type changes
+post_save.connect(page_relationship_changed, sender=PageRelationship,
+                  dispatch_uid='related-pages-save-signal')
+post_delete.connect(page_relationship_changed, sender=PageRelationship,
+                    dispatch_uid='related-pages-delete-signal')
+for model in (Page, RelationshipType):
+    post_save.connect(related_pages_changed, sender=model,
+                      dispatch_uid='related-pages-page-save-signal')
+    post_delete.connect(related_pages_changed, sender=model,
+                        dispatch_uid='related-pages-page-delete-signal')
+
+
+# defer updating links of pages saved during a request
+# until the response is sent
+from django.core.signals import request_started, request_finished
+from midocs.page_links import request_started_handler, \
+    request_finished_handler
+request_started.connect(request_started_handler,
+                        dispatch_uid='page-links-request-started-signal')
+request_finished.connect(request_finished_handler,
+                         dispatch_uid='page-links-request-finished-signal')
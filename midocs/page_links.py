@@ -0,0 +1,478 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PageLinks(object):
+    """
+    The database entries created by the tags in the text of a page,
+    i.e., embedded images, applets and videos, navigation entries,
+    citations, equation tags, external links and index entries.
+
+    While update_page_links renders the text of the page,
+    the tags record their entries in the PageLinks found in the context
+    as _page_links_, rather than writing them to the database,
+    so that they can be compared with the existing entries.
+
+    """
+
+    def __init__(self, page):
+        self.page = page
+        # title and description before rendering,
+        # as the title and description tags set them on page
+        self.title = page.title
+        self.description = page.description
+
+        self.image_ids = set()
+        self.applet_ids = set()
+        self.video_ids = set()
+
+        # navigation phrase: (page anchor, list of (subphrase, page anchor))
+        self.navigation = OrderedDict()
+        # citation code: (reference id, footnote text, reference number)
+        self.citations = OrderedDict()
+        # list of (code, tag)
+        self.equation_tags = []
+        # list of (external url, link text)
+        self.external_links = []
+        # list of (index type id, phrase, subphrase, page anchor)
+        self.index_entries = []
+
+    def add_navigation(self, navigation_phrase, page_anchor,
+                       navigation_subphrase=None):
+        """
+        Add navigation entry with navigation_phrase, if not already added,
+        and sub entry with navigation_subphrase, if given and not
+        already added to the entry.
+        """
+        try:
+            subentries = self.navigation[navigation_phrase][1]
+        except KeyError:
+            subentries = []
+            self.navigation[navigation_phrase] = (page_anchor, subentries)
+        if navigation_subphrase and navigation_subphrase not in \
+                [subphrase for (subphrase, anchor) in subentries]:
+            subentries.append((navigation_subphrase, page_anchor))
+
+    def add_citation(self, code, reference_id=None, footnote_text=None):
+        """
+        Add citation with code, numbered after the previous citations,
+        if not already added.
+        """
+        if code not in self.citations:
+            self.citations[code] = (reference_id, footnote_text,
+                                    len(self.citations)+1)
+
+    def reference_number(self, code):
+        """
+        Return reference number of citation with code, or ?? if not found.
+        """
+        try:
+            return self.citations[code][2]
+        except KeyError:
+            return '??'
+
+
+def collect_page_links(page):
+    """
+    Render text of page with the tags recording their database entries.
+    Return the resulting PageLinks, or None if the text has errors.
+    """
+    from django.template import Template, Context
+    from midocs.functions import return_new_auxiliary_data
+
+    page_links = PageLinks(page)
+    update_context = {'thepage': page, 'process_image_entries': 1,
+                      'process_applet_entries': 1,
+                      'process_video_entries': 1,
+                      'process_equation_tags': 1,
+                      'process_navigation_tags': 1,
+                      'process_citations': 1,
+                      'update_database': 1,
+                      'process_index_entries': 1,
+                      'blank_style': 1,
+                      'STATIC_URL': '',
+                      '_auxiliary_data_': return_new_auxiliary_data(),
+                      '_page_links_': page_links,
+                  }
+
+    # if page is hidden, don't update image/applet/video links or index entries
+    if page.hidden:
+        update_context['process_applet_entries']=0
+        update_context['process_video_entries']=0
+        update_context['process_image_entries']=0
+        update_context['process_index_entries']=0
+
+    try:
+        Template("{% load mi_tags question_tags %}"+(page.text or ""))\
+            .render(Context(update_context))
+    except Exception:
+        return None
+
+    return page_links
+
+
+def update_page_links(page_ids):
+    """
+    Update the database entries created by the tags in the text
+    of the pages with ids in page_ids, along with titles and descriptions
+    set by tags, then update the similar pages of the pages.
+
+    Pages are processed in batches.  The entries of the pages of a batch
+    are compared with the existing entries, loaded with one query per model,
+    so that only the entries that changed are deleted or inserted,
+    with one query per model.
+    The entries of pages whose text has errors are left unchanged.
+
+    Return number of pages updated.
+    """
+    from midocs.models import Page
+    from midocs.similarity import update_similar_pages
+
+    page_ids = sorted(set(page_ids))
+    batch_size = return_page_links_batch_size()
+
+    for start in range(0, len(page_ids), batch_size):
+        batch = page_ids[start:start+batch_size]
+
+        collected = []
+        for page in Page.objects.filter(id__in=batch)\
+                                .select_related('page_type'):
+            page_links = collect_page_links(page)
+            if page_links is not None:
+                collected.append(page_links)
+
+        with transaction.atomic():
+            _write_page_links(collected)
+
+        update_similar_pages(batch)
+
+    return len(page_ids)
+
+
+def _write_page_links(collected):
+    from midocs.models import Page, Image, Applet, Video, PageCitation, \
+        EquationTag, ExternalLink, IndexEntry
+
+    if not collected:
+        return
+
+    for (model, attribute) in ((Image, 'image_ids'),
+                               (Applet, 'applet_ids'),
+                               (Video, 'video_ids')):
+        object_field = model._meta.model_name + '_id'
+        _update_entries(model.in_pages.through, 'page_id', (object_field,),
+                        collected, lambda page_links: [
+                            (object_id,) for object_id
+                            in sorted(getattr(page_links, attribute))])
+
+    _update_entries(EquationTag, 'page_id', ('code', 'tag'), collected,
+                    lambda page_links: page_links.equation_tags)
+    _update_entries(ExternalLink, 'in_page_id', ('external_url', 'link_text'),
+                    collected, lambda page_links: page_links.external_links)
+    _update_entries(IndexEntry, 'page_id',
+                    ('index_type_id', 'indexed_phrase', 'indexed_subphrase',
+                     'page_anchor'),
+                    collected, lambda page_links: page_links.index_entries)
+
+    # citations are shown in order of id
+    _update_entries(PageCitation, 'page_id',
+                    ('code', 'reference_id', 'footnote_text',
+                     'reference_number'),
+                    collected, lambda page_links: [
+                        (code,) + citation for (code, citation)
+                        in page_links.citations.items()],
+                    ordered=True)
+
+    _update_navigation(collected)
+
+    # save titles and descriptions set by tags
+    titles_changed = False
+    for page_links in collected:
+        page = page_links.page
+        if (page.title, page.description) != \
+           (page_links.title, page_links.description):
+            Page.objects.filter(id=page.id).update(
+                title=page.title, description=page.description,
+                date_modified=timezone.now())
+            titles_changed = True
+    if titles_changed:
+        from midocs.caches import invalidate_related_pages_cache
+        invalidate_related_pages_cache()
+
+
+def _update_entries(model, page_field, fields, collected, entries_of,
+                    ordered=False):
+    """
+    Delete and insert rows of model so that, for each PageLinks
+    of collected, the values of fields of the rows of model whose
+    page_field is its page are given by entries_of(page_links),
+    a list of tuples.
+
+    If ordered, rows are shown in order of id, so existing rows are kept
+    only for the initial entries that are unchanged.
+    """
+    page_ids = [page_links.page.id for page_links in collected]
+
+    existing = {}
+    for row in model.objects.filter(**{page_field + '__in': page_ids})\
+                            .order_by('id')\
+                            .values_list('id', page_field, *fields):
+        existing.setdefault(row[1], []).append(row)
+
+    delete_ids = []
+    new_objects = []
+    for page_links in collected:
+        page_id = page_links.page.id
+        rows = existing.get(page_id, [])
+        entries = list(entries_of(page_links))
+
+        if ordered:
+            n_kept = 0
+            for (row, entry) in zip(rows, entries):
+                if tuple(row[2:]) != tuple(entry):
+                    break
+                n_kept += 1
+            delete_ids.extend(row[0] for row in rows[n_kept:])
+            new_entries = entries[n_kept:]
+        else:
+            # match each existing row with at most one entry
+            unmatched = Counter(tuple(entry) for entry in entries)
+            for row in rows:
+                if unmatched[tuple(row[2:])]:
+                    unmatched[tuple(row[2:])] -= 1
+                else:
+                    delete_ids.append(row[0])
+            new_entries = list(unmatched.elements())
+
+        for entry in new_entries:
+            values = dict(zip(fields, entry))
+            values[page_field] = page_id
+            new_objects.append(model(**values))
+
+    if delete_ids:
+        model.objects.filter(id__in=delete_ids).delete()
+    if new_objects:
+        model.objects.bulk_create(new_objects)
+
+
+def _update_navigation(collected):
+    """
+    Delete and insert navigation entries and their sub entries,
+    which are shown in order of id, keeping existing entries
+    for the initial entries of each page that are unchanged,
+    including their sub entries.
+    """
+    from midocs.models import PageNavigation, PageNavigationSub
+
+    page_ids = [page_links.page.id for page_links in collected]
+
+    subentries = {}
+    for (navigation_id, subphrase, page_anchor) in \
+        PageNavigationSub.objects.filter(navigation__page_id__in=page_ids)\
+            .order_by('id').values_list('navigation_id',
+                                        'navigation_subphrase',
+                                        'page_anchor'):
+        subentries.setdefault(navigation_id, []).append(
+            (subphrase, page_anchor))
+
+    existing = {}
+    for (navigation_id, page_id, phrase, page_anchor) in \
+        PageNavigation.objects.filter(page_id__in=page_ids).order_by('id')\
+            .values_list('id', 'page_id', 'navigation_phrase',
+                         'page_anchor'):
+        existing.setdefault(page_id, []).append(
+            (navigation_id, (phrase, page_anchor,
+                             tuple(subentries.get(navigation_id, [])))))
+
+    delete_ids = []
+    new_navigation = []
+    new_subentries = {}
+    for page_links in collected:
+        page_id = page_links.page.id
+        rows = existing.get(page_id, [])
+        entries = [(phrase, page_anchor, tuple(subs)) for
+                   (phrase, (page_anchor, subs))
+                   in page_links.navigation.items()]
+
+        n_kept = 0
+        for ((navigation_id, row), entry) in zip(rows, entries):
+            if row != entry:
+                break
+            n_kept += 1
+        delete_ids.extend(navigation_id for (navigation_id, row)
+                          in rows[n_kept:])
+
+        for (phrase, page_anchor, subs) in entries[n_kept:]:
+            new_navigation.append(PageNavigation(
+                page_id=page_id, navigation_phrase=phrase,
+                page_anchor=page_anchor))
+            if subs:
+                new_subentries[(page_id, phrase)] = subs
+
+    if delete_ids:
+        # deletes sub entries as well
+        PageNavigation.objects.filter(id__in=delete_ids).delete()
+    if not new_navigation:
+        return
+    PageNavigation.objects.bulk_create(new_navigation)
+
+    if new_subentries:
+        # bulk_create doesn't set ids of new entries for all databases,
+        # so find them by the unique page and phrase
+        new_subs = []
+        for (navigation_id, page_id, phrase) in \
+            PageNavigation.objects.filter(
+                page_id__in=set(page_id for (page_id, phrase)
+                                in new_subentries))\
+                .values_list('id', 'page_id', 'navigation_phrase'):
+            for (subphrase, page_anchor) in \
+                new_subentries.get((page_id, phrase), ()):
+                new_subs.append(PageNavigationSub(
+                    navigation_id=navigation_id,
+                    navigation_subphrase=subphrase,
+                    page_anchor=page_anchor))
+        PageNavigationSub.objects.bulk_create(new_subs)
+
+
+class PageLinksQueue(threading.local):
+    """
+    Ids of the pages queued by the current thread for updating
+    their links (with update_page_links) or just their similar pages.
+
+    While updates are deferred, queued pages are processed, without
+    duplicates, when the outermost deferral ends; otherwise, they are
+    processed immediately.  Updates are deferred during requests,
+    so that pages saved in a request are processed once the response
+    is sent, and can be deferred with deferred_page_links.
+
+    """
+
+    def __init__(self):
+        # number of nested deferrals, besides that of a request
+        self.depth = 0
+        self.in_request = False
+        self.link_page_ids = set()
+        self.similar_page_ids = set()
+        # true while process_page_links_queue is running
+        self.processing = False
+
+    def deferred(self):
+        return bool(self.depth or self.in_request)
+
+page_links_queue = PageLinksQueue()
+
+
+def enqueue_page_links(page_ids):
+    """
+    Queue pages with ids in page_ids for updating their links.
+    """
+    page_links_queue.link_page_ids.update(page_ids)
+    if not page_links_queue.deferred():
+        process_page_links_queue()
+
+
+def enqueue_similar_pages(page_ids):
+    """
+    Queue pages with ids in page_ids for updating their similar pages.
+    """
+    page_links_queue.similar_page_ids.update(page_ids)
+    if not page_links_queue.deferred():
+        process_page_links_queue()
+
+
+def process_page_links_queue():
+    """
+    Update links of the pages queued by the current thread,
+    then similar pages of pages queued just for similar pages,
+    in batches.
+
+    Pages are removed from the queue only once their batch has been
+    updated, so that if an update fails, the pages remain queued
+    and are processed again the next time the queue is processed.
+    Pages queued while processing (e.g., by signals) are processed
+    in the same call.
+    """
+    from midocs.similarity import update_similar_pages, \
+        return_similar_batch_size
+
+    if page_links_queue.processing:
+        return
+
+    page_links_queue.processing = True
+    try:
+        while page_links_queue.link_page_ids \
+              or page_links_queue.similar_page_ids:
+            if page_links_queue.link_page_ids:
+                batch = sorted(page_links_queue.link_page_ids)\
+                        [:return_page_links_batch_size()]
+                update_page_links(batch)
+                page_links_queue.link_page_ids.difference_update(batch)
+                # update_page_links also updated similar pages of batch
+                page_links_queue.similar_page_ids.difference_update(batch)
+            else:
+                batch = sorted(page_links_queue.similar_page_ids)\
+                        [:return_similar_batch_size()]
+                update_similar_pages(batch)
+                page_links_queue.similar_page_ids.difference_update(batch)
+    finally:
+        page_links_queue.processing = False
+
+
+def begin_deferral():
+    page_links_queue.depth += 1
+
+def end_deferral():
+    if page_links_queue.depth:
+        page_links_queue.depth -= 1
+    if not page_links_queue.deferred():
+        process_page_links_queue()
+
+
+def request_started_handler(sender, **kwargs):
+    page_links_queue.in_request = True
+
+def request_finished_handler(sender, **kwargs):
+    # As the response has already been sent, log any error
+    # rather than raising it, leaving the pages queued.
+    page_links_queue.in_request = False
+    if not page_links_queue.deferred():
+        try:
+            process_page_links_queue()
+        except Exception:
+            logger.exception("Error updating links of pages %s"
+                             % sorted(page_links_queue.link_page_ids
+                                      | page_links_queue.similar_page_ids))
+
+
+@contextmanager
+def deferred_page_links():
+    """
+    Context manager that defers updating links of saved pages
+    until it exits, so that pages saved many times,
+    e.g., when importing pages, are processed just once and in batches.
+
+    with deferred_page_links():
+        for page in pages:
+            page.save()
+    """
+    begin_deferral()
+    try:
+        yield
+    finally:
+        end_deferral()
+
+
+def return_page_links_batch_size():
+    """
+    Return number of pages whose links are updated together.
+    Can be changed by adding to settings.py:
+    MIDOCS_PAGE_LINKS_BATCH_SIZE = 200
+    """
+    return getattr(settings, 'MIDOCS_PAGE_LINKS_BATCH_SIZE', 100)
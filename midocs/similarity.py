@@ -0,0 +1,261 @@
+from django.conf import settings
+from django.db import transaction
+from collections import Counter
+
+
+class PageFeatures(object):
+    """
+    Membership of pages in features (keywords or subjects),
+    loaded from the through table of the many to many field.
+
+    The number of features each origin page shares with every
+    candidate page is obtained for a whole batch of origins
+    from a single product of sparse page by feature matrices.
+    If scipy is not available, the same counts are obtained
+    from an index of the candidate pages with each feature.
+
+    """
+
+    def __init__(self, through, feature_field, candidate_ids):
+        self.features_of_page = {}
+        self.candidates_of_feature = {}
+        for (page_id, feature_id) in through.objects.values_list(
+                'page_id', feature_field):
+            self.features_of_page.setdefault(page_id, set()).add(feature_id)
+            if page_id in candidate_ids:
+                self.candidates_of_feature.setdefault(
+                    feature_id, set()).add(page_id)
+
+    def shared_counts(self, origin_ids):
+        """
+        Return dictionary, keyed by each origin id, of dictionaries
+        giving the number of features shared with each candidate page
+        (other than the origin) that has at least one in common.
+        """
+        try:
+            from scipy.sparse import csr_matrix
+        except ImportError:
+            return self._shared_counts_from_index(origin_ids)
+
+        feature_index = {feature_id: i for (i, feature_id)
+                         in enumerate(self.candidates_of_feature)}
+        candidate_ids = sorted(set().union(
+            *self.candidates_of_feature.values()))
+
+        def membership_matrix(page_ids):
+            rows = []
+            columns = []
+            for (i, page_id) in enumerate(page_ids):
+                for feature_id in self.features_of_page.get(page_id, ()):
+                    try:
+                        columns.append(feature_index[feature_id])
+                    except KeyError:
+                        # feature of no candidate
+                        continue
+                    rows.append(i)
+            return csr_matrix(([1]*len(rows), (rows, columns)),
+                              shape=(len(page_ids), len(feature_index)))
+
+        counts = {origin_id: {} for origin_id in origin_ids}
+        if not origin_ids or not candidate_ids:
+            return counts
+
+        shared = membership_matrix(origin_ids).dot(
+            membership_matrix(candidate_ids).T).tocoo()
+        for (i, j, n) in zip(shared.row, shared.col, shared.data):
+            origin_id = origin_ids[i]
+            candidate_id = candidate_ids[j]
+            if candidate_id != origin_id:
+                counts[origin_id][candidate_id] = int(n)
+        return counts
+
+    def _shared_counts_from_index(self, origin_ids):
+        counts = {}
+        for origin_id in origin_ids:
+            hits = Counter()
+            for feature_id in self.features_of_page.get(origin_id, ()):
+                hits.update(self.candidates_of_feature.get(feature_id, ()))
+            hits.pop(origin_id, None)
+            counts[origin_id] = dict(hits)
+        return counts
+
+
+class PageSimilarityIndex(object):
+    """
+    Keywords and subjects of all pages, loaded with one query each,
+    for computing the similar pages of many pages at once.
+
+    Candidates for similar pages are the active pages,
+    i.e., those published and not hidden.
+
+    """
+
+    def __init__(self):
+        from midocs.models import Page
+        self.candidate_ids = set(
+            Page.activepages.values_list('id', flat=True))
+        self.keywords = PageFeatures(Page.keywords.through, 'keyword_id',
+                                     self.candidate_ids)
+        self.subjects = PageFeatures(Page.subjects.through, 'subject_id',
+                                     self.candidate_ids)
+
+    def return_similar(self, origin_ids, batch_size=None):
+        """
+        Generator of (origin_id, similar) for each origin id,
+        where similar is the list of the top similar pages of origin,
+        as (page id, score, background_page) ordered by decreasing score.
+
+        The score of each page is the number of keywords and subjects
+        it shares with the origin, weighted so that they are comparable
+        to the more like this scores from the search index, if available,
+        plus its more like this score.
+        """
+        from midocs.models import Page, PageRelationship
+
+        if batch_size is None:
+            batch_size = return_similar_batch_size()
+        origin_ids = list(origin_ids)
+
+        try:
+            from midocs.search_functions import midocsSearchQuerySet
+        except ImportError:
+            midocsSearchQuerySet = None
+
+        for start in range(0, len(origin_ids), batch_size):
+            batch = origin_ids[start:start+batch_size]
+
+            keyword_hits = self.keywords.shared_counts(batch)
+            subject_hits = self.subjects.shared_counts(batch)
+
+            background_pages = set(PageRelationship.objects.filter(
+                origin_id__in=batch, relationship_type__code="background")
+                                   .values_list('origin_id', 'related_id'))
+
+            if midocsSearchQuerySet:
+                pages = Page.objects.in_bulk(batch)
+
+            for origin_id in batch:
+                # find pages that match via full text search indexing
+                mlt_scores = {}
+                max_mlt_score = 1
+                mlt_score_10 = 0
+                if midocsSearchQuerySet:
+                    try:
+                        pages_mlt = midocsSearchQuerySet().models(Page)\
+                            .more_like_this(pages[origin_id])[:100]
+                        max_mlt_score = pages_mlt[0].score
+                        mlt_score_10 = pages_mlt[9].score
+                        for mp in pages_mlt:
+                            mlt_scores[int(mp.pk)] = mp.score
+                    except Exception:
+                        mlt_scores = {}
+                        max_mlt_score = 1
+                        mlt_score_10 = 0
+
+                keywords = keyword_hits[origin_id]
+                subjects = subject_hits[origin_id]
+                max_hits = max(keywords.values() or [0]) \
+                    + max(subjects.values() or [0])
+                try:
+                    keyword_subject_weight = \
+                        4*(max_mlt_score-mlt_score_10)/max_hits
+                except ZeroDivisionError:
+                    keyword_subject_weight = 0
+
+                similar = []
+                for page_id in sorted(set(keywords) | set(subjects)
+                                      | set(mlt_scores)):
+                    score = (keywords.get(page_id, 0)
+                             + subjects.get(page_id, 0)) \
+                             * keyword_subject_weight \
+                             + mlt_scores.get(page_id, 0)
+                    similar.append((page_id, score,
+                                    (origin_id, page_id) in background_pages))
+
+                # sort is stable, so ties are ordered by page id
+                similar.sort(key=lambda s: s[1], reverse=True)
+                yield (origin_id, similar[:return_similar_number()])
+
+
+def update_similar_pages(page_ids=None):
+    """
+    Recompute the similar pages (PageSimilar) of the pages
+    with ids in page_ids, or of all pages if page_ids is None.
+
+    Similar pages of each batch are replaced with one delete
+    and one bulk insert.
+
+    Return number of pages updated.
+    """
+    from midocs.models import Page, PageSimilar
+
+    index = PageSimilarityIndex()
+
+    origins = Page.objects.all()
+    if page_ids is not None:
+        origins = origins.filter(id__in=list(page_ids))
+    origin_ids = sorted(origins.values_list('id', flat=True))
+
+    batch_size = return_similar_batch_size()
+    similar_list = []
+    batch = []
+    for (origin_id, similar) in index.return_similar(origin_ids, batch_size):
+        batch.append(origin_id)
+        for (page_id, score, background_page) in similar:
+            similar_list.append(PageSimilar(
+                origin_id=origin_id, similar_id=page_id,
+                score=score, background_page=background_page))
+        if len(batch) == batch_size:
+            _replace_similar_pages(batch, similar_list)
+            batch = []
+            similar_list = []
+    if batch:
+        _replace_similar_pages(batch, similar_list)
+
+    return len(origin_ids)
+
+
+def return_pages_sharing_features(through, feature_field, page_ids,
+                                  feature_ids=None):
+    """
+    Return set of page_ids along with the ids of the pages that have
+    any of feature_ids, the ids of keywords or subjects
+    (through is Page.keywords.through or Page.subjects.through).
+    If feature_ids is None, use all features of the pages with page_ids.
+
+    The scores of these pages are the ones affected when pages with
+    page_ids gain or lose the features.
+    """
+    page_ids = set(page_ids)
+    if feature_ids is None:
+        feature_ids = through.objects.filter(page_id__in=list(page_ids))\
+                                     .values_list(feature_field, flat=True)
+    page_ids.update(through.objects.filter(
+        **{feature_field + '__in': list(feature_ids)})
+                    .values_list('page_id', flat=True))
+    return page_ids
+
+
+def _replace_similar_pages(origin_ids, similar_list):
+    from midocs.models import PageSimilar
+    with transaction.atomic():
+        PageSimilar.objects.filter(origin_id__in=origin_ids).delete()
+        PageSimilar.objects.bulk_create(similar_list)
+
+
+def return_similar_number():
+    """
+    Return number of similar pages stored for each page.
+    Can be changed by adding to settings.py:
+    MIDOCS_SIMILAR_PAGES = 30
+    """
+    return getattr(settings, 'MIDOCS_SIMILAR_PAGES', 20)
+
+
+def return_similar_batch_size():
+    """
+    Return number of pages whose similar pages are computed together.
+    Can be changed by adding to settings.py:
+    MIDOCS_SIMILAR_BATCH_SIZE = 1000
+    """
+    return getattr(settings, 'MIDOCS_SIMILAR_BATCH_SIZE', 500)
@@ -1,17 +1,17 @@
-from django.db import models, transaction
+from django.db import models
 from django import template
-from midocs.models import Page, PageType, PageNavigation, PageNavigationSub, IndexEntry, IndexType, Image, ImageType, Applet, AppletType, Video, EquationTag, ExternalLink, PageCitation, Reference, return_default_page_type, AuxiliaryFile
+from midocs.models import Page, IndexType, Image, ImageType, Applet, AppletType, Video, PageCitation, Reference, AuxiliaryFile
 from micourses.models import Assessment
 from django.core.urlresolvers import reverse, NoReverseMatch
-from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
 from django.utils.encoding import smart_text
 from django.template.base import kwarg_re
 import re
 import math
 from django.contrib.sites.models import Site
-from django.db.models import  Max
 from sympy.printing import StrPrinter
+from midocs.applet_bundle import return_applet_bundle
 
 register=template.Library()
 
@@ -24,11 +24,54 @@ def resolve_if_set(variable, context):
     return None
 
 
+# classes of link targets specified by the class kwarg, default Page
+LINK_TARGET_CLASSES = {
+    'applet': Applet,
+    'video': Video,
+    'image': Image,
+    'assessment': Assessment,
+    'auxiliary_file': AuxiliaryFile,
+}
+
+def collect_link_target(parser, target, kwargs):
+    """
+    Record the class and code of target in the list of link targets
+    of the template being compiled by parser, if they are literals,
+    so that all targets can be loaded together by a LinkResolver.
+    Return the list of link targets.
+    """
+    try:
+        link_targets = parser._mi_link_targets
+    except AttributeError:
+        link_targets = parser._mi_link_targets = []
+
+    def literal(value):
+        if value.filters or not isinstance(value.var, str):
+            return None
+        return value.var
+
+    code = literal(target)
+    if not code:
+        return link_targets
+
+    target_class = Page
+    if "class" in kwargs:
+        target_class_string = literal(kwargs["class"])
+        if target_class_string is None:
+            return link_targets
+        target_class = LINK_TARGET_CLASSES.get(
+            target_class_string.lower(), Page)
+
+    link_targets.append((target_class, code))
+    return link_targets
+
+
 class InternalLinkNode(template.Node):
-    def __init__(self, target, kwargs, nodelist):
+    def __init__(self, target, kwargs, nodelist, link_targets=()):
         self.target=target
         self.kwargs=kwargs
         self.nodelist=nodelist
+        self.link_targets=link_targets
 
     def render(self, context):
 
@@ -50,22 +93,20 @@ class InternalLinkNode(template.Node):
             kwargs["link_text"]=link_text
 
         target = self.target.resolve(context)
+
+        # link targets of the whole template are loaded 
+        # with the first lookup, one query per class
+        from midocs.link_resolver import return_link_resolver
+        resolver = return_link_resolver(context)
+        resolver.add_targets(self.link_targets)
         
         target_class = None
         
         # check if target is an instance of an object
-        if isinstance(target, Page):
-            target_class = Page
-        elif isinstance(target, Applet):
-            target_class = Applet
-        elif isinstance(target, Video):
-            target_class = Video
-        elif isinstance(target, Image):
-            target_class = Image
-        elif isinstance(target, Assessment):
-            target_class = Assessment
-        elif isinstance(target, AuxiliaryFile):
-            target_class = AuxiliaryFile
+        for model in (Page, Applet, Video, Image, Assessment, AuxiliaryFile):
+            if isinstance(target, model):
+                target_class = model
+                break
             
         # if target is not an object, then check for type kwarg
         # and look for that type of object with code given by target
@@ -76,18 +117,7 @@ class InternalLinkNode(template.Node):
                 target_class_string=target_class_string.lower()
             except:
                 pass
-            if target_class_string=="applet":
-                target_class=Applet
-            elif target_class_string=="video":
-                target_class=Video
-            elif target_class_string=="image":
-                target_class=Image
-            elif target_class_string=="assessment":
-                target_class=Assessment
-            elif target_class_string=="auxiliary_file":
-                target_class=AuxiliaryFile
-            else:
-                target_class=Page
+            target_class = LINK_TARGET_CLASSES.get(target_class_string, Page)
 
 
             # since target was not an object, try to find
@@ -106,7 +136,7 @@ class InternalLinkNode(template.Node):
                     #    same assessment in a course)
                     # 2: kwarg: course
                     #    course could either be a Course instance or a code
-                    # 3. last_course from context
+                    # 3. course or last_course from context
                     # 4. top course thread_content_list from context
                     # 5. arbitrary version from an active course
                     # 6. arbitrary version from any course
@@ -130,116 +160,42 @@ class InternalLinkNode(template.Node):
                         # if thread_content doesn't match target code,
                         # return broken link
                         if target.code != target_code:
-                            raise ObjecctDoesNotExist
+                            raise ObjectDoesNotExist
                         if thread_content.n_of_object > 1:
                             kwargs['n_of_object'] = thread_content.n_of_object
 
-
-                    # 2. try course from kwargs
-                    if not target:
-                        course = kwargs.get("course")
-                        if course:
-                            from micourses.models import Course
-                            if not isinstance(course, Course):
-                                # if course doesn't exist
-                                # will return broken link
-                                course=Course.objects.get(code = course)
-                            # if assessment not found, return broken link
-                            target=Assessment.objects.get(code=target_code,
-                                                          course=course)
-
-                    # 3. try course or last_course from context
-                    if not target:
-                        course=context.get("course")
-                        if not course:
-                            course=context.get("last_course")
-
-                        if course:
-                            try:
-                                target=Assessment.objects.get(code=target_code,
-                                                       course=course)
-                            except Assessment.DoesNotExist:
-                                # if assessment not found, try next method
-                                pass
-
-                    # 4. try top course thread_content_list from context
+                    # 2-6. find among assessments with code,
+                    # all loaded with one query
                     if not target:
+                        preferred_courses = [context.get("course") or 
+                                             context.get("last_course")]
                         thread_content_list = context.get("thread_content_list")
                         if thread_content_list:
-                            try:
-                                target=Assessment.objects.get(code=target_code,
-                                        course=thread_content_list[0].course)
-                            except Assessment.DoesNotExist:
-                                # if assessment not found, try next method
-                                pass
-
-                    # 5. choose arbitrary version from an active course
-                    if not target:
-                        target = Assessment.objects.filter(code=target_code,
-                                                course__active=True).first()
-
-                    # 6. choose arbitrary version 
-                    if not target:
-                        target = Assessment.objects.filter(code=target_code)\
-                                                   .first()
+                            preferred_courses.append(
+                                thread_content_list[0].course)
+                        target = resolver.find_assessment(
+                            target_code, course=kwargs.get("course"),
+                            preferred_courses=preferred_courses)
 
-                    # couldn't find assessment, return broken link
-                    if not target:
-                        raise Assessment.DoesNotExist
-
-                        
                 elif target_class == AuxiliaryFile:
                     # for auxiliary file, the code doesn't uniquely specify
                     # the file.  Need file_type_code.
                     
                     # If file_type is not a kwarg, then try to find
                     # a matching auxiliary file with code of any type
-                    
-                    
-                    target_code=target
-                    target=None
-
-                    file_type = kwargs.get("file_type")
-                    if file_type:
-                        from midocs.models import AuxiliaryFileType
-                        if not isinstance(file_type, AuxiliaryFileType):
-                            # if file_type doesn't exist
-                            # will return broken link
-                            file_type=AuxiliaryFileType.objects.get(
-                                code = file_type)
-                        # if auxiliary_file not found, return broken link
-                        target=AuxiliaryFile.objects.get(code=target_code,
-                                                         file_type=file_type)
-
-                    if not target:
-                        target = AuxiliaryFile.objects.filter(code=target_code)\
-                                                      .first()
-
-                    # couldn't find file, return broken link
-                    if not target:
-                        raise AuxiliaryFile.DoesNotExist
 
+                    target = resolver.find_auxiliary_file(
+                        target, file_type=kwargs.get("file_type"))
                 
                 elif target_class == Page:
 
                     # for Page, determine page type
-                    page_type = kwargs.get("page_type")
-
-                    if page_type is not None and \
-                       not isinstance(page_type, PageType):
-                        try:
-                            page_type = PageType.objects.get(code=page_type)
-                        except ObjectDoesNotExist:
-                            page_type = None
-
-                    if page_type is None:
-                        page_type = return_default_page_type()
-
-                    target=target_class.objects.get(code=target, 
-                                                    page_type=page_type)
+                    # (default page type if not specified or not found)
+                    target = resolver.find_page(
+                        target, page_type=kwargs.get("page_type"))
 
                 else:
-                    target=target_class.objects.get(code=target)
+                    target = resolver.find(target_class, target)
 
             # if object does not exist, set link to point to target
             # mark as broken
@@ -269,7 +225,7 @@ class InternalLinkNode(template.Node):
         if blank_style:
             return " %s " % link_text
 
-        return target.return_link(**kwargs)
+        return resolver.return_link(target, **kwargs)
 
 
 @register.tag
@@ -293,10 +249,12 @@ def intlink(parser, token):
                 kwargs[name] = parser.compile_filter(value)
   
 
+    link_targets = collect_link_target(parser, target, kwargs)
+
     nodelist = parser.parse(('endintlink',))
     parser.delete_first_token()
 
-    return InternalLinkNode(target, kwargs, nodelist)
+    return InternalLinkNode(target, kwargs, nodelist, link_targets)
 
 
 
@@ -322,7 +280,9 @@ def extendedlink(parser, token):
 
     kwargs["extended"] = parser.compile_filter("1")
 
-    return InternalLinkNode(target, kwargs, "")
+    link_targets = collect_link_target(parser, target, kwargs)
+
+    return InternalLinkNode(target, kwargs, "", link_targets)
 
 
 
@@ -349,7 +309,9 @@ def confusedlink(parser, token):
 
     kwargs["confused"] = parser.compile_filter("1")
 
-    return InternalLinkNode(target, kwargs, "")
+    link_targets = collect_link_target(parser, target, kwargs)
+
+    return InternalLinkNode(target, kwargs, "", link_targets)
 
 
 
@@ -363,14 +325,13 @@ class EquationTagNode(template.Node):
         tag = self.tag.resolve(context)
 
         # check to see if the variable process_equation_tags is set
-        # if so, add entry to database
+        # if so, record entry for database
         if context.get("process_equation_tags"):
             # get page object, if doesn't exist, just return blank string
             thepage = context.get("thepage")
             if thepage:
                 # add equation tag
-                EquationTag.objects.create \
-                    (page=thepage, code=code, tag=tag)
+                context['_page_links_'].equation_tags.append((code, tag))
             else:
                 return ""
             
@@ -408,18 +369,11 @@ class ExternalLinkNode(template.Node):
         # check to see if the variable update_database is set
         if context.get("update_database"):
             # get page object, 
-            # and save as linked from that page
+            # and record as linked from that page
             thepage = context.get("thepage")
             if thepage:
-                extlink = ExternalLink.objects.create \
-                    (external_url=external_url,
-                     in_page=thepage, link_text=link_text)
-                        
-            # if not in a page, save without reference to page
-            else:
-                extlink = ExternalLink.objects.create \
-                    (external_url=external_url,
-                     link_text=link_text)
+                context['_page_links_'].external_links.append(
+                    (external_url, link_text))
 
         # check if blank_style is set
         if context.get("blank_style"):
@@ -464,45 +418,18 @@ class NavigationTagNode(template.Node):
             navigation_subphrase=template.Template(navigation_subphrase).render(context)
 
         # check to see if the variable navigation_tags is set
-        # if so, add entry to database
+        # if so, record entry for database
         if context.get("process_navigation_tags"):
             # get page object, if doesn't exist, just return blank string
             thepage = context.get("thepage")
             if not thepage:
                 return ""
             
-            # add navigation_tag
-            if navigation_subphrase:
-                # first try to find the phrase already there
-                # and just create subphrase entry
-                try:
-                    with transaction.atomic():
-                        navigation_entry = PageNavigation.objects.get(
-                            page=thepage, navigation_phrase=navigation_phrase)
-                        navigation_sub_entry=PageNavigationSub.objects.create(
-                            navigation=navigation_entry,
-                            navigation_subphrase=navigation_subphrase,
-                            page_anchor=page_anchor)
-                except:
-                    # next try to create both phrase and subphrase entries
-                    with transaction.atomic():
-                        navigation_entry = PageNavigation.objects.create(
-                            page=thepage,
-                            navigation_phrase=navigation_phrase,
-                            page_anchor=page_anchor)
-                        navigation_sub_entry=PageNavigationSub.objects.create(
-                            navigation=navigation_entry,
-                            navigation_subphrase=navigation_subphrase,
-                            page_anchor=page_anchor)
-                            
-            else:
-                # if no subphrase, just create phrase entry
-                with transaction.atomic():
-                    navigation_entry = PageNavigation.objects.create(
-                        page=thepage, 
-                        navigation_phrase=navigation_phrase,
-                        page_anchor=page_anchor)
-                        
+            # add navigation_tag, along with subphrase entry, if given.
+            # If phrase is already there, just add subphrase entry
+            context['_page_links_'].add_navigation(
+                navigation_phrase, page_anchor, navigation_subphrase)
+
 
         # check if blank_style is set 
         # if so, return ""
@@ -540,34 +467,29 @@ class FootnoteNode(template.Node):
         cite_code = self.cite_code.resolve(context)
 
         # check to see if the variable process_citations is set
-        # if so, add entry to database
+        # if so, record entry for database
         if context.get("process_citations"):
+            page_links = context['_page_links_']
 
-            # check to see if page already has citations
-            # and if so, what the largest reference number is
-            previous_citations=PageCitation.objects.filter(page=thepage)
-            previous_reference_number=0
-            if previous_citations:
-                previous_reference_number=previous_citations.aggregate(Max('reference_number'))['reference_number__max']
-                
-            try:
-                with transaction.atomic():
-                    # add footnote entry
+            # add footnote entry, numbered after previous citations,
+            # unless already cited
+            if cite_code not in page_links.citations:
+                try:
                     footnote_text = self.nodelist.render(context)
-                    footnote_entry = PageCitation.objects.create(
-                        page=thepage, code=cite_code,
-                        footnote_text=footnote_text,
-                        reference_number = previous_reference_number+1)
-            
-            # fail silently
-            except:
-                pass
+                # fail silently
+                except:
+                    pass
+                else:
+                    page_links.add_citation(cite_code,
+                                            footnote_text=footnote_text)
 
-        # find reference number
-        reference_number = 0
-        footnote_entry = PageCitation.objects.get( \
-            page=thepage, code=cite_code)
-        reference_number = footnote_entry.reference_number
+            reference_number = page_links.reference_number(cite_code)
+
+        else:
+            # find reference number
+            footnote_entry = PageCitation.objects.get( \
+                page=thepage, code=cite_code)
+            reference_number = footnote_entry.reference_number
 
         # check if blank_style is set 
         # if so, return reference number
@@ -608,42 +530,37 @@ class CitationNode(template.Node):
             cite_codes.append(code.resolve(context))
 
         # check to see if the variable process_citations is set
-        # if so, add entry to database
+        # if so, record entry for database
         if context.get("process_citations"):
+            page_links = context['_page_links_']
 
-            # check to see if page already has citations
-            # and if so, what the largest reference number is
-            previous_citations=PageCitation.objects.filter(page=thepage)
-            previous_reference_number=0
-            if previous_citations:
-                previous_reference_number=previous_citations.aggregate(Max('reference_number'))['reference_number__max']
-                
             # find references based on cite_code
+            # and add citation entries, numbered after previous citations,
+            # unless already cited
             for cite_code in cite_codes:
+                if cite_code in page_links.citations:
+                    continue
                 try:
-                    with transaction.atomic():
-                        the_reference=Reference.objects.get(code=cite_code)
-                        
-                        # add citation entry
-                        citation_entry = PageCitation.objects.create(
-                            page=thepage, code=cite_code,
-                            reference=the_reference,
-                            reference_number = previous_reference_number+1)
-                        previous_reference_number += 1
-
+                    the_reference=Reference.objects.get(code=cite_code)
                 # fail silently
-                except:
-                    pass
+                except ObjectDoesNotExist:
+                    continue
+                page_links.add_citation(cite_code,
+                                        reference_id=the_reference.id)
 
-        # find reference number
-        reference_numbers = []
-        for cite_code in cite_codes:
-            try:
-                citation_entry = PageCitation.objects.get( \
-                    page=thepage, code=cite_code)
-                reference_numbers.append(citation_entry.reference_number)
-            except:
-                reference_numbers.append('??')
+            reference_numbers = [page_links.reference_number(cite_code)
+                                 for cite_code in cite_codes]
+
+        else:
+            # find reference number
+            reference_numbers = []
+            for cite_code in cite_codes:
+                try:
+                    citation_entry = PageCitation.objects.get( \
+                        page=thepage, code=cite_code)
+                    reference_numbers.append(citation_entry.reference_number)
+                except:
+                    reference_numbers.append('??')
                 
         # check if blank_style is set to 1
         # if so, return reference number
@@ -711,11 +628,9 @@ class IndexEntryNode(template.Node):
                 index_type = IndexType.objects.get(code="general") 
                         
                 # add index entry
-                index_entry = IndexEntry.objects.create \
-                    (page=thepage, index_type=index_type, 
-                     indexed_phrase=indexed_phrase,
-                     indexed_subphrase=indexed_subphrase,
-                     page_anchor=page_anchor)
+                context['_page_links_'].index_entries.append(
+                    (index_type.id, indexed_phrase, indexed_subphrase,
+                     page_anchor))
 
         # check if blank_style is set
         # if so, return ""
@@ -776,15 +691,9 @@ class TitleNode(template.Node):
             if context.get("process_navigation_tags"):
                 thepage = context.get("thepage")
                 if thepage:
-                    try:
-                        with transaction.atomic():
-                            # add an navigation_entry, ignore any errors
-                            navigation_entry = PageNavigation.objects.create(
-                                page=thepage, 
-                                navigation_phrase=self.navigation_phrase,
-                                page_anchor="main")
-                    except:
-                        pass
+                    # add an navigation_entry, unless already there
+                    context['_page_links_'].add_navigation(
+                        navigation_phrase, "main")
                         
 
         # check if blank_style is set 
@@ -892,8 +801,8 @@ class ImageNode(template.Node):
             # get page object, 
             thepage = context.get("thepage")
             if thepage:
-                # add page to in_pages of image
-                image.in_pages.add(thepage)
+                # record image as embedded in page
+                context['_page_links_'].image_ids.add(image.id)
 
         # check if blank_style is set 
         # if so, just return title of image
@@ -1014,34 +923,10 @@ def return_applet_parameter_string(applet):
     """
     the_string=""
 
-    # loop through all applet parameters of applet type
-    for possible_param in applet.applet_type.valid_parameters.all():
-        parameter_name=possible_param.parameter_name
-        # skip DEFAULT_WIDTH and DEFAULT_HEIGHT
-        if parameter_name != "DEFAULT_WIDTH" and \
-                parameter_name != "DEFAULT_HEIGHT":
- 
-            parameter_value=""
-            # check to see if parameter defined for particular applet
-            try:
-                app_param=applet.appletparameter_set.get(parameter=possible_param)
-                parameter_name = possible_param.parameter_name
-                parameter_value = app_param.value
-                
-            # if not in particular applet, use default value
-            except ObjectDoesNotExist:
-                parameter_value=possible_param.default_value
-
-            # if applet parameter is defined twice just take one of the values
-            except MultipleObjectsReturned:
-                app_param=applet.appletparameter_set.filter(parameter=possible_param)[0]
-                parameter_name = possible_param.parameter_name
-                parameter_value = app_param.value
-
-            # if found a value, add to html string
-            if parameter_value:
-                the_string = '%s<param name="%s" value="%s" />' \
-                    % (the_string, parameter_name, parameter_value)
+    for (parameter_name, parameter_value) in \
+            return_applet_bundle(applet).parameter_items():
+        the_string = '%s<param name="%s" value="%s" />' \
+            % (the_string, parameter_name, parameter_value)
     
     return the_string
 
@@ -1055,39 +940,8 @@ def return_applet_parameter_dictionary(applet):
     Skip DEFAULT_WIDTH or DEFAULT_HEIGHT
     """
 
-
-    applet_parameters = {}
-
-    # loop through all applet parameters of applet type
-    for possible_param in applet.applet_type.valid_parameters.all():
-        parameter_name=possible_param.parameter_name
-        # skip DEFAULT_WIDTH and DEFAULT_HEIGHT
-        if parameter_name != "DEFAULT_WIDTH" and \
-                parameter_name != "DEFAULT_HEIGHT" and \
-                parameter_name != "code":
- 
-            parameter_value=""
-            # check to see if parameter defined for particular applet
-            try:
-                app_param=applet.appletparameter_set.get(parameter=possible_param)
-                parameter_name = possible_param.parameter_name
-                parameter_value = app_param.value
-                
-            # if not in particular applet, use default value
-            except ObjectDoesNotExist:
-                parameter_value=possible_param.default_value
-
-            # if applet parameter is defined twice just take one of the values
-            except MultipleObjectsReturned:
-                app_param=applet.appletparameter_set.filter(parameter=possible_param)[0]
-                parameter_name = possible_param.parameter_name
-                parameter_value = app_param.value
-
-            # if found a value, add to dictionary
-            if parameter_value:
-                applet_parameters[parameter_name] = parameter_value
-    
-    return applet_parameters
+    return dict(return_applet_bundle(applet).parameter_items(
+        skip=("DEFAULT_WIDTH", "DEFAULT_HEIGHT", "code")))
 
 def return_applet_error_string(applet, panel=0):
 
@@ -1368,8 +1222,8 @@ def Geogebra_capture_object_javascript(appletobject, applet_variable,
 def GeogebraTube_link(context, applet, applet_identifier, width, height):
 
     try:
-        geogebracode=applet.appletparameter_set.get(parameter__parameter_name ="code").value
-    except ObjectDoesNotExist:
+        geogebracode=return_applet_bundle(applet).parameter_value("code")
+    except KeyError:
         return "[Broken applet]", ""
 
     applet_parameters = return_applet_parameter_dictionary(applet)
@@ -1517,18 +1371,17 @@ def Three_link(context, applet, applet_identifier, width, height, url_get_parame
         run_script_string += "\njQuery('#container2_%s').empty();\napplet2_%s.run();\n" % (applet_id, applet_id)
 
         # insert javascript to link applet and child objects
-        for object_link in applet.appletchildobjectlink_set.all():
+        bundle = return_applet_bundle(applet)
+        for object_link in bundle.child_object_links:
             # first check if objects exist in applet and child applet
             # if not, ignore
-            try:
-                applet_object = applet.appletobject_set.get\
-                    (name=object_link.object_name)
-            except ObjectDoesNotExist:
+            applet_object = bundle.return_object(
+                name=object_link.object_name)
+            if applet_object is None:
                 continue
-            try:
-                child_applet_object = applet.child_applet.appletobject_set.get\
-                    (name=object_link.child_object_name)
-            except ObjectDoesNotExist:
+            child_applet_object = bundle.child_bundle.return_object(
+                name=object_link.child_object_name)
+            if child_applet_object is None:
                 continue
 
             # look up object types.  Ignore if not same type
@@ -1603,40 +1456,18 @@ def DoubleLiveGraphics3D_link(context, applet, applet_identifier, width, height)
     param_string1=""
     param_string2=""
 
-   # loop through all applet parameters of applet type
-    for possible_param in applet.applet_type.valid_parameters.all():
-        parameter_name=possible_param.parameter_name
-        # skip DEFAULT_WIDTH and DEFAULT_HEIGHT
-        if parameter_name != "DEFAULT_WIDTH" and \
-                parameter_name != "DEFAULT_HEIGHT":
- 
-            parameter_value=""
-            # check to see if parameter defined for particular applet
-            try:
-                app_param=applet.appletparameter_set.get(parameter=possible_param)
-                parameter_name = possible_param.parameter_name
-                parameter_value = app_param.value
-                
-            # if not in particular applet, use default value
-            except ObjectDoesNotExist:
-                parameter_value=possible_param.default_value
-                
-            # if applet parameter is defined twice just take one of the values
-            except MultipleObjectsReturned:
-                app_param=applet.appletparameter_set.filter(parameter=possible_param)[0]
-                parameter_name = possible_param.parameter_name
-                parameter_value = app_param.value
-
-            # if found a value, add to html string
-            if parameter_value:
-                # put it into string based on last digit
-                # and ignore last digit
-                if parameter_name[-1] == "1":
-                    param_string1= '%s<param name="%s" value="%s" />' \
-                        % (param_string1, parameter_name[:-1], parameter_value)
-                elif parameter_name[-1]=="2":
-                    param_string2= '%s<param name="%s" value="%s" />' \
-                        % (param_string2, parameter_name[:-1], parameter_value)
+    # loop through all applet parameters of applet type,
+    # using value from applet if defined there
+    for (parameter_name, parameter_value) in \
+            return_applet_bundle(applet).parameter_items():
+        # put it into string based on last digit
+        # and ignore last digit
+        if parameter_name[-1] == "1":
+            param_string1= '%s<param name="%s" value="%s" />' \
+                % (param_string1, parameter_name[:-1], parameter_value)
+        elif parameter_name[-1]=="2":
+            param_string2= '%s<param name="%s" value="%s" />' \
+                % (param_string2, parameter_name[:-1], parameter_value)
 
 
     # start string with table and first applet tag
@@ -1689,14 +1520,14 @@ class AppletNode(template.Node):
 
         # if applet is not an applet instance
         # try to load applet with that code
-        if not isinstance(applet, Applet):
-            # test if applet with applet_code exists
-            try:
-                applet=Applet.objects.get(code=applet)
-                # if applet does not exist
-                # return tag to applet code anyway
-            except ObjectDoesNotExist:
-                return '<p>[Broken applet]</p>'
+        # parameters, objects and texts of applet are loaded together
+        try:
+            bundle = return_applet_bundle(applet)
+        except ObjectDoesNotExist:
+            # if applet does not exist
+            # return tag to applet code anyway
+            return '<p>[Broken applet]</p>'
+        applet = bundle.applet
 
         # set width and height from kwarg parameters, if exist
         # else get defaults from applet, if exist
@@ -1711,15 +1542,7 @@ class AppletNode(template.Node):
             pass
 
         if width==0:
-            try:
-                width=int(applet.appletparameter_set.get(parameter__parameter_name ="DEFAULT_WIDTH").value)
-            except:
-                pass
-        if width==0:
-            try:
-                width=int(applet.applet_type.valid_parameters.get(parameter_name ="DEFAULT_WIDTH").default_value)
-            except:
-                width=default_size
+            width = bundle.default_size("DEFAULT_WIDTH") or default_size
 
         height=0
         try:
@@ -1728,25 +1551,16 @@ class AppletNode(template.Node):
             pass
 
         if height==0:
-            try:
-                height=int(applet.appletparameter_set.get(parameter__parameter_name ="DEFAULT_HEIGHT").value)
-            except:
-                pass
-
-        if height==0:
-            try:
-                height=int(applet.applet_type.valid_parameters.get(parameter_name ="DEFAULT_HEIGHT").default_value)
-            except:
-                height=default_size
+            height = bundle.default_size("DEFAULT_HEIGHT") or default_size
 
         # check to see if the variable process_applet_entries is set
-        # if so, add entry to database
+        # if so, record entry for database
         if context.get("process_applet_entries"):
             # get page object, 
             thepage = context.get('thepage')
-            # if applet was in a page,  add page to in_pages of applet
+            # if applet was in a page, record applet as embedded in page
             if thepage:
-                applet.in_pages.add(thepage)
+                context['_page_links_'].applet_ids.add(applet.id)
 
         answer_data = context.get('_answer_data_')
         
@@ -1890,8 +1704,7 @@ class AppletNode(template.Node):
         # add default applet texts unless specified not
         if kwargs.get("add_default_texts", True):
             top_text=""
-            for applet_text in applet.applettext_set\
-                                     .filter(default_position="top"):
+            for applet_text in bundle.return_texts(default_position="top"):
 
                 top_text = render_applet_text(
                     context, applet_text, applet=applet, 
@@ -1900,8 +1713,8 @@ class AppletNode(template.Node):
 
 
             bottom_text = ""
-            for applet_text in applet.applettext_set\
-                                     .filter(default_position="bottom"):
+            for applet_text in bundle.return_texts(
+                    default_position="bottom"):
 
                 bottom_text += render_applet_text(
                     context, applet_text, applet=applet, 
@@ -1930,9 +1743,7 @@ class AppletNode(template.Node):
 
         appletobjects = []
         if answer_data:
-            appletobjects=applet.appletobject_set.filter \
-                           (capture_changes=True).order_by(
-                               "category_for_capture", "sort_order")
+            appletobjects=bundle.capture_objects()
 
         inputboxlist=''
         capture_javascript={}
@@ -2030,16 +1841,7 @@ class AppletNode(template.Node):
                                 answer_field_name
                 applet_feedback = True
 
-            related_objects=[]
-            if appletobject.related_objects:
-                related_object_names = \
-                    [item.strip() for item in appletobject.related_objects.split(",")]
-                for name in related_object_names:
-                    try:
-                        ro = applet.appletobject_set.get(name=name)
-                        related_objects.append(ro)
-                    except:
-                        pass
+            related_objects=bundle.return_related_objects(appletobject)
 
             if applet.applet_type.code == "Geogebra" \
                     or applet.applet_type.code == "GeogebraWeb":
@@ -2061,9 +1863,7 @@ class AppletNode(template.Node):
 
         # if call_parent_capture, attempt to call parent version of capture
         if kwargs.get("call_parent_capture"):
-            appletobjects=applet.appletobject_set.filter \
-                           (capture_changes=True).order_by(
-                               "category_for_capture", "sort_order")
+            appletobjects=bundle.capture_objects()
 
             for appletobject in appletobjects:
                 this_capture= capture_javascript.get(appletobject.name,"")
@@ -2076,8 +1876,7 @@ class AppletNode(template.Node):
 
         # check if any applet objects are specified 
         # to be changed with javascript
-        appletobjects=applet.appletobject_set.filter \
-            (change_from_javascript=True)
+        appletobjects=bundle.return_objects(change_from_javascript=True)
 
         for appletobject in appletobjects:
             objectvalue = kwargs.get(appletobject.name)
@@ -2232,14 +2031,13 @@ class AppletObjectNode(template.Node):
 
         # if applet is not an applet instance
         # try to load applet with that code
-        if not isinstance(applet, Applet):
-            # test if applet with applet_code exists
-            try:
-                applet=Applet.objects.get(code=applet)
-                # if applet does not exist
-                # return tag to applet code anyway
-            except ObjectDoesNotExist:
-                return "[Broken applet object: no applet found]"
+        try:
+            bundle = return_applet_bundle(applet)
+        except ObjectDoesNotExist:
+            # if applet does not exist
+            # return tag to applet code anyway
+            return "[Broken applet object: no applet found]"
+        applet = bundle.applet
 
         # get applet_id_user optionally from kwargs or context
         applet_id_user = kwargs.get('applet_id', 
@@ -2256,10 +2054,9 @@ class AppletObjectNode(template.Node):
         # get applet_identifier optionally from context
         applet_identifier = context.get('_the_applet_identifier')
         
-        try:
-            applet_object=applet.appletobject_set.get \
-                           (capture_changes=True, name=object_name)
-        except ObjectDoesNotExist:
+        applet_object=bundle.return_object(capture_changes=True, 
+                                           name=object_name)
+        if applet_object is None:
             return "[Broken applet object: no object found]"
 
         try:
@@ -2361,14 +2158,13 @@ class RenderJavascriptSetAppletObjectNode(template.Node):
 
         # if applet is not an applet instance
         # try to load applet with that code
-        if not isinstance(applet, Applet):
-            # test if applet with applet_code exists
-            try:
-                applet=Applet.objects.get(code=applet)
-                # if applet does not exist
-                # return tag to applet code anyway
-            except ObjectDoesNotExist:
-                return "console.log('Broken render_javascript_set_applet_object: no applet found');"
+        try:
+            bundle = return_applet_bundle(applet)
+        except ObjectDoesNotExist:
+            # if applet does not exist
+            # return tag to applet code anyway
+            return "console.log('Broken render_javascript_set_applet_object: no applet found');"
+        applet = bundle.applet
 
         # get applet_id_user optionally from kwargs or context
         applet_id_user = kwargs.get('applet_id', 
@@ -2385,10 +2181,9 @@ class RenderJavascriptSetAppletObjectNode(template.Node):
         # get applet_identifier optionally from context
         applet_identifier = context.get('_the_applet_identifier')
         
-        try:
-            applet_object=applet.appletobject_set.get \
-                           (capture_changes=True, name=object_name)
-        except ObjectDoesNotExist:
+        applet_object=bundle.return_object(capture_changes=True, 
+                                           name=object_name)
+        if applet_object is None:
             return "console.log('Broken render_javascript_set_applet_object: no object found');"
 
         try:
@@ -2478,14 +2273,13 @@ class AppletTextNode(template.Node):
 
         # if applet is not an applet instance
         # try to load applet with that code
-        if not isinstance(applet, Applet):
-            # test if applet with applet_code exists
-            try:
-                applet=Applet.objects.get(code=applet)
-                # if applet does not exist
-                # return tag to applet code anyway
-            except ObjectDoesNotExist:
-                return "[Broken applet text: no applet found]"
+        try:
+            bundle = return_applet_bundle(applet)
+        except ObjectDoesNotExist:
+            # if applet does not exist
+            # return tag to applet code anyway
+            return "[Broken applet text: no applet found]"
+        applet = bundle.applet
 
         # get applet_id_user optionally from kwargs or context
         applet_id_user = kwargs.get('applet_id', 
@@ -2501,10 +2295,10 @@ class AppletTextNode(template.Node):
         # get applet_identifier optionally from context
         applet_identifier = context.get('_the_applet_identifier')
         
-        try:
-            applet_text=applet.applettext_set.get(code=text_code)
-        except ObjectDoesNotExist:
+        applet_texts = bundle.return_texts(code=text_code)
+        if not applet_texts:
             return "[Broken applet text: no text found]"
+        applet_text = applet_texts[0]
 
         return render_applet_text(context, applet_text, applet=applet, 
                                   applet_id_user=applet_id_user,
@@ -2679,13 +2473,13 @@ class VideoNode(template.Node):
 
 
         # check to see if the variable process_video_entries is set
-        # if so, add entry to database
+        # if so, record entry for database
         if context.get("process_video_entries"):
             # get page object, 
             thepage = context.get('thepage')
-            # if video was in a page, add page to in_pages of video
+            # if video was in a page, record video as embedded in page
             if thepage:
-                video.in_pages.add(thepage)
+                context['_page_links_'].video_ids.add(video.id)
 
         # check if blank_style is set
         # if so, just return title, and caption if "boxed"
@@ -3160,16 +2954,8 @@ def return_applet_object_javascript(applet_data, capture_javascript):
             # of the object assigned to temp, so we only need to
             # add the capture object javascript if it is empty
             if not object_capture:
-                related_objects=[]
-                if applet_object.related_objects:
-                    related_object_names  \
-                        = [item.strip() for item in applet_object.related_objects.split(",")]
-                    for name in related_object_names:
-                        try:
-                            ro = applet.appletobject_set.get(name=name)
-                            related_objects.append(ro)
-                        except:
-                            pass
+                related_objects=return_applet_bundle(applet)\
+                    .return_related_objects(applet_object)
 
                 object_capture += "var temp;\n"
                 object_capture += Geogebra_capture_object_javascript(
@@ -3262,16 +3048,8 @@ def return_modify_applet_object_javascript(applet_data, capture_javascript,
 
                 # capture_command1 is command to capture value of 
                 # applet_object and assign it to variable temp
-                related_objects=[]
-                if applet_object.related_objects:
-                    related_object_names  \
-                        = [item.strip() for item in applet_object.related_objects.split(",")]
-                    for name in related_object_names:
-                        try:
-                            ro = applet.appletobject_set.get(name=name)
-                            related_objects.append(ro)
-                        except:
-                            pass
+                related_objects=return_applet_bundle(applet)\
+                    .return_related_objects(applet_object)
                     
                 capture_command1 = "var temp;\n"
                 capture_command1 += Geogebra_capture_object_javascript(
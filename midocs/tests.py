@@ -271,3 +271,355 @@ class ActiveManagerTests(TestCase):
         pastvideo=create_video(code="pastvideo", title="Past Video", publish_date = datetime.date.today()-datetime.timedelta(days=1), video_type = vtype)
         active_videos = Video.activevideos.all()
         self.assertQuerysetEqual(active_videos,[repr(currentvideo), repr(pastvideo)], ordered=False)
+
+
+class PageViewCacheTests(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        PageType.objects.create(code="pagetype", name="Page Type",
+                                default=True)
+        self.page = create_page(code="cachedpage", title="Cached page")
+        self.page.text = "<p>Original text of {{thepage.title}}</p>"
+        self.page.save()
+        self.url = reverse('mi-page', kwargs={'page_code': self.page.code})
+
+    def test_rendered_page_cached_until_modified(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, "Original text of Cached page")
+
+        # changing text without updating date_modified uses cached rendering
+        Page.objects.filter(id=self.page.id).update(
+            text="<p>Changed text</p>")
+        response = self.client.get(self.url)
+        self.assertContains(response, "Original text of Cached page")
+
+        # GET parameters other than bare bypass the cache
+        response = self.client.get(self.url, {'n': 2})
+        self.assertContains(response, "Changed text")
+
+        # saving page updates date_modified, so page is rendered again
+        page = Page.objects.get(id=self.page.id)
+        page.save()
+        response = self.client.get(self.url)
+        self.assertContains(response, "Changed text")
+
+        # response depends on session and user, so isn't conditional
+        self.assertFalse(response.has_header('Last-Modified'))
+
+    def test_cache_key_includes_link_courses(self):
+        from django.test import RequestFactory
+        from micourses.models import Course
+        from midocs.views import return_page_cache_key
+        course1 = Course.objects.create(code="course1", name="Course 1")
+        course2 = Course.objects.create(code="course2", name="Course 2")
+        request = RequestFactory().get(self.url)
+        page_type = self.page.page_type
+
+        keys = {return_page_cache_key(request, self.page, page_type, None,
+                                      link_courses)
+                for link_courses in ([None], [course1], [course1, course1],
+                                     [course1, course2], [None, course2])}
+        self.assertEqual(len(keys), 5)
+
+
+class InternalLinkTests(TestCase):
+    def setUp(self):
+        PageType.objects.create(code="pagetype", name="Page Type",
+                                default=True)
+        self.pagea = create_page(code="pagea", title="Page a")
+        self.pageb = create_page(code="pageb", title="Page b")
+        self.applet = create_applet(code="appleta", 
+                                    applet_type=create_an_applet_type())
+
+    def test_links_loaded_together(self):
+        from django.template import Template, Context
+        t = Template("{% load mi_tags %}"
+                     "{% intlink 'pagea' %}first{% endintlink %} "
+                     "{% intlink 'pageb' %}second{% endintlink %} "
+                     "{% intlink 'pagea' %}first{% endintlink %} "
+                     "{% intlink 'appleta' class='applet' %}applet{% endintlink %} "
+                     "{% intlink 'missing' %}missing{% endintlink %}")
+
+        # one query each for page types, pages and applets
+        with self.assertNumQueries(3):
+            rendered = t.render(Context({}))
+
+        self.assertIn(self.pagea.return_link(link_text="first"), rendered)
+        self.assertIn(self.pageb.return_link(link_text="second"), rendered)
+        self.assertIn(self.applet.return_link(link_text="applet"), rendered)
+        self.assertIn('<a href="/missing" class="broken">missing</a>',
+                      rendered)
+
+    def test_codes_keyed_by_requested_code(self):
+        from midocs.models import Page
+        from midocs.link_resolver import LinkResolver
+        resolver = LinkResolver()
+
+        # codes are matched with case on sqlite
+        with self.assertRaises(Page.DoesNotExist):
+            resolver.find_page("PageA")
+
+        # code in other case is still loaded
+        self.assertEqual(resolver.find_page("pagea"), self.pagea)
+        with self.assertNumQueries(0):
+            self.assertEqual(resolver.find_page("pagea"), self.pagea)
+
+
+class AppletBundleTests(TestCase):
+    def setUp(self):
+        from midocs.models import AppletObjectType
+        self.applet_type = create_an_applet_type(code="GeogebraWeb")
+        parameters = {}
+        for (name, default) in [("DEFAULT_WIDTH", "400"),
+                                ("DEFAULT_HEIGHT", "300"),
+                                ("showToolBar", "false"),
+                                ("code", ""),
+                                ("enableLabelDrags", "")]:
+            parameters[name] = self.applet_type.valid_parameters.create(
+                parameter_name=name, default_value=default)
+        self.applet = create_applet(code="appleta",
+                                    applet_type=self.applet_type)
+        self.applet.appletparameter_set.create(
+            parameter=parameters["DEFAULT_HEIGHT"], value="250")
+        self.applet.appletparameter_set.create(
+            parameter=parameters["code"], value="abc")
+        point = AppletObjectType.objects.create(object_type="Point")
+        self.objecta = self.applet.appletobject_set.create(
+            object_type=point, name="A", capture_changes=True,
+            related_objects="B, C")
+        self.objectb = self.applet.appletobject_set.create(
+            object_type=point, name="B", change_from_javascript=False)
+        self.text = self.applet.applettext_set.create(
+            code="instructions", title="Instructions", text="Move A",
+            default_position="top")
+
+    def test_applet_bundle(self):
+        from midocs.applet_bundle import return_applet_bundle
+        from midocs.caches import applet_bundle_cache
+        applet_bundle_cache.clear()
+
+        applet = Applet.objects.get(id=self.applet.id)
+        with self.assertNumQueries(6):
+            bundle = return_applet_bundle(applet)
+
+        self.assertEqual(bundle.parameter_items(),
+                         [("showToolBar", "false"), ("code", "abc")])
+        self.assertEqual(bundle.default_size("DEFAULT_WIDTH"), 400)
+        self.assertEqual(bundle.default_size("DEFAULT_HEIGHT"), 250)
+        self.assertEqual(bundle.capture_objects(), [self.objecta])
+        self.assertEqual(bundle.return_object(name="B"), self.objectb)
+        self.assertEqual(bundle.return_related_objects(self.objecta),
+                         [self.objectb])
+        self.assertEqual(bundle.return_texts(default_position="top"),
+                         [self.text])
+
+        # bundle is cached for same date_modified
+        with self.assertNumQueries(0):
+            self.assertIs(return_applet_bundle(applet), bundle)
+
+        # and not used if components change
+        self.text.title = "New instructions"
+        self.text.save()
+        applet = Applet.objects.get(id=self.applet.id)
+        new_bundle = return_applet_bundle(applet)
+        self.assertIsNot(new_bundle, bundle)
+        self.assertEqual(new_bundle.texts[0].title, "New instructions")
+
+    def test_component_changes_update_applet(self):
+        date_modified = Applet.objects.get(id=self.applet.id).date_modified
+
+        # changing text of applet updates its date_modified
+        self.text.title = "New instructions"
+        self.text.save()
+        new_date = Applet.objects.get(id=self.applet.id).date_modified
+        self.assertGreater(new_date, date_modified)
+
+        # as does changing a parameter of its applet type
+        parameter = self.applet_type.valid_parameters.get(
+            parameter_name="showToolBar")
+        parameter.default_value = "true"
+        parameter.save()
+        self.assertGreater(
+            Applet.objects.get(id=self.applet.id).date_modified, new_date)
+
+
+class SimilarPagesTests(TestCase):
+    def setUp(self):
+        from midocs.models import Keyword, Subject, RelationshipType
+        PageType.objects.create(code="pagetype", name="Page Type",
+                                default=True)
+        self.pagea = create_page(code="pagea", title="Page a")
+        self.pageb = create_page(code="pageb", title="Page b")
+        self.pagec = create_page(code="pagec", title="Page c")
+        self.paged = create_page(code="paged", title="Page d", hidden=True)
+        self.keyword1 = Keyword.objects.create(code="keyword1")
+        self.keyword2 = Keyword.objects.create(code="keyword2")
+        self.subject = Subject.objects.create(code="subject")
+        self.background = RelationshipType.objects.create(
+            code="background", description="background")
+
+        self.pagea.keywords.add(self.keyword1, self.keyword2)
+        self.pagea.subjects.add(self.subject)
+        self.pageb.keywords.add(self.keyword1, self.keyword2)
+        self.pagec.keywords.add(self.keyword1)
+        self.paged.keywords.add(self.keyword1, self.keyword2)
+
+    def similar(self, page):
+        return [(ps.similar, ps.score, ps.background_page)
+                for ps in page.similar.all()]
+
+    def test_similar_pages(self):
+        from midocs.similarity import update_similar_pages
+
+        # similar pages updated when keywords added, 
+        # with weight 4/(maximum keyword hits + maximum subject hits)
+        # and not including hidden page
+        self.assertEqual(self.similar(self.pagea),
+                         [(self.pageb, 4, False), (self.pagec, 2, False)])
+        self.assertEqual(self.similar(self.pagec),
+                         [(self.pagea, 4, False), (self.pageb, 4, False)])
+
+        self.pagea.relationships.create(related=self.pagec,
+                                        relationship_type=self.background)
+        self.assertEqual(update_similar_pages(), 4)
+        self.assertEqual(self.similar(self.pagea),
+                         [(self.pageb, 4, False), (self.pagec, 2, True)])
+        self.assertEqual(self.similar(self.paged),
+                         [(self.pagea, 4, False), (self.pageb, 4, False),
+                          (self.pagec, 2, False)])
+
+        # removing keyword from page b also updates pages sharing keyword
+        self.pageb.keywords.remove(self.keyword2)
+        self.assertEqual(self.similar(self.pagea),
+                         [(self.pageb, 4, False), (self.pagec, 4, True)])
+        self.assertEqual(self.similar(self.paged),
+                         [(self.pagea, 4, False), (self.pageb, 2, False),
+                          (self.pagec, 2, False)])
+
+    def test_related_pages_cached(self):
+        from django.core.cache import cache
+        from midocs.views import get_all_related_pages
+        cache.clear()
+
+        self.pagea.relationships.create(related=self.pagec,
+                                        relationship_type=self.background,
+                                        sort_order=2)
+        self.pagea.relationships.create(related=self.pageb,
+                                        relationship_type=self.background,
+                                        sort_order=1)
+        self.pagea.relationships.create(related=self.paged,
+                                        relationship_type=self.background)
+
+        with self.assertNumQueries(1):
+            related_pages = get_all_related_pages(self.pagea)
+        self.assertEqual(related_pages,
+                         {'background': [self.pageb, self.pagec]})
+        with self.assertNumQueries(0):
+            self.assertEqual(get_all_related_pages(self.pagea),
+                             related_pages)
+
+        # and discarded if relationships change
+        self.pagea.relationships.get(related=self.pageb).delete()
+        self.assertEqual(get_all_related_pages(self.pagea),
+                         {'background': [self.pagec]})
+
+    def test_related_pages_discarded_when_pages_change(self):
+        from django.core.cache import cache
+        from midocs.views import get_all_related_pages
+        cache.clear()
+
+        self.pagea.relationships.create(related=self.pageb,
+                                        relationship_type=self.background)
+        self.assertEqual(get_all_related_pages(self.pagea),
+                         {'background': [self.pageb]})
+
+        # hiding related page discards related pages of all pages
+        self.pageb.hidden = True
+        self.pageb.save()
+        self.assertEqual(get_all_related_pages(self.pagea), {})
+
+
+class PageLinksTests(TestCase):
+    def setUp(self):
+        from midocs.models import IndexType
+        PageType.objects.create(code="pagetype", name="Page Type",
+                                default=True)
+        IndexType.objects.create(code="general", name="General",
+                                 description="general")
+        self.page = create_page(code="linkedpage", title="Linked page")
+        self.page.text = '{% navigation_tag "intro" "Introduction" %}' \
+                         '{% navigation_tag "rates" "Rates" "Average rates" %}' \
+                         '{% equation_tag "eq1" "1" %}' \
+                         '{% extlink "http://example.com" %}Example{% endextlink %}' \
+                         '{% footnote "note" %}A note{% endfootnote %}' \
+                         '{% index_entry "derivative" %}'
+        self.page.save()
+
+    def test_page_links_updated(self):
+        from midocs.models import PageNavigationSub
+        from midocs.page_links import deferred_page_links
+
+        navigation = list(self.page.pagenavigation_set.values_list(
+            'id', 'navigation_phrase', 'page_anchor'))
+        self.assertEqual([n[1:] for n in navigation],
+                         [("Introduction", "intro"), ("Rates", "rates")])
+        self.assertEqual(list(PageNavigationSub.objects.filter(
+            navigation__page=self.page).values_list(
+                'navigation_subphrase', flat=True)), ["Average rates"])
+        equation_tags = list(self.page.equationtag_set.values_list(
+            'id', 'code', 'tag'))
+        self.assertEqual([e[1:] for e in equation_tags], [("eq1", "1")])
+        self.assertEqual(list(self.page.externallink_set.values_list(
+            'external_url', 'link_text')), [("http://example.com", "Example")])
+        self.assertEqual(list(self.page.pagecitation_set.values_list(
+            'code', 'footnote_text', 'reference_number')),
+                         [("note", "A note", 1)])
+        self.assertEqual(list(self.page.indexentry_set.values_list(
+            'indexed_phrase', flat=True)), ["derivative"])
+
+        # links are updated once deferral ends
+        with deferred_page_links():
+            self.page.text = self.page.text.replace(
+                '"Rates" "Average rates"', '"Rates of change"')\
+                .replace('{% footnote "note" %}A note{% endfootnote %}', '')
+            self.page.save()
+            self.page.save()
+            self.assertEqual(self.page.pagecitation_set.count(), 1)
+
+        self.assertEqual(self.page.pagecitation_set.count(), 0)
+        self.assertFalse(PageNavigationSub.objects.filter(
+            navigation__page=self.page).exists())
+
+        # unchanged entries are kept
+        new_navigation = list(self.page.pagenavigation_set.values_list(
+            'id', 'navigation_phrase', 'page_anchor'))
+        self.assertEqual(new_navigation[0], navigation[0])
+        self.assertEqual([n[1:] for n in new_navigation],
+                         [("Introduction", "intro"),
+                          ("Rates of change", "rates")])
+        self.assertEqual(list(self.page.equationtag_set.values_list(
+            'id', 'code', 'tag')), equation_tags)
+
+    def test_failed_update_stays_queued(self):
+        from midocs import page_links
+
+        def fail_update(page_ids):
+            raise RuntimeError("update failed")
+
+        original_update = page_links.update_page_links
+        page_links.update_page_links = fail_update
+        try:
+            page_links.request_started_handler(sender=None)
+            self.page.save()
+            # error is logged rather than raised after the response
+            with self.assertLogs('midocs.page_links', level='ERROR'):
+                page_links.request_finished_handler(sender=None)
+            self.assertEqual(page_links.page_links_queue.link_page_ids,
+                             {self.page.id})
+        finally:
+            page_links.update_page_links = original_update
+
+        page_links.process_page_links_queue()
+        self.assertEqual(page_links.page_links_queue.link_page_ids, set())
+        self.assertEqual(page_links.page_links_queue.similar_page_ids, set())
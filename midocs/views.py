@@ -1,4 +1,4 @@
-from midocs.models import NotationSystem, Author, Objective, Subject, Keyword, RelationshipType, Page, PageType, PageRelationship, Image, Applet, Video, IndexType, IndexEntry, NewsItem, return_default_page_type, AuxiliaryFile
+from midocs.models import NotationSystem, Author, Objective, Subject, Keyword, Page, PageType, PageRelationship, Image, Applet, Video, IndexType, IndexEntry, NewsItem, return_default_page_type, AuxiliaryFile
 from django import http, forms
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.views.decorators.http import last_modified
@@ -29,36 +29,40 @@ import random
 
 
 def get_all_related_pages(thepage, max_keyword_matches=0, max_total_related=0):
-    related_pages={}
+    """
+    Return dictionary, keyed by relationship type code, of the lists
+    of published, non-hidden pages related to thepage,
+    ordered by the sort_order of the relationships.
+    Relationship types with no related pages are omitted.
+
+    Related pages are loaded with one query and cached for the day,
+    until relationships or pages are changed.
+    """
+    from midocs.caches import get_cached_related_pages, \
+        set_cached_related_pages
+
     today=datetime.date.today()
-    for relationship_type in RelationshipType.objects.all():
-        related_pages[relationship_type.code] = \
-            Page.objects.filter \
-            (reverse_relationships__origin=thepage,
-             reverse_relationships__relationship_type=
-             relationship_type) \
-             .filter(publish_date__lte=today, hidden=False) \
-             .order_by('reverse_relationships__sort_order',
-                       'reverse_relationships__id')
+    related_pages = get_cached_related_pages(thepage.id, today)
+    if related_pages is None:
+        related_pages={}
+        for relationship in PageRelationship.objects.filter(
+                origin=thepage, related__publish_date__lte=today,
+                related__hidden=False)\
+                .select_related('relationship_type', 'related',
+                                'related__page_type')\
+                .order_by('sort_order', 'id'):
+            related_pages.setdefault(relationship.relationship_type.code,
+                                     []).append(relationship.related)
+        set_cached_related_pages(thepage.id, today, related_pages)
 
     return related_pages
 
 
-# calculate date of page as the last date_modified 
-# of the page itself or its included applets, videos, and images
-def date_page(request, page_code, page_type_code=None):
-    if page_type_code is None:
-        page_type = return_default_page_type()
-    else:
-        try:
-            page_type = PageType.objects.get(code=page_type_code)
-        except:
-            return None
-    
-    try:
-        thepage = Page.object.get(code=page_code, page_type=page_type)
-    except:
-        return None
+def return_page_date(thepage):
+    """
+    Return the last date_modified of the page itself
+    or its included applets, videos, and images.
+    """
     latest_date=thepage.date_modified
     try:
         last_image=thepage.image_set.latest("date_modified").date_modified
@@ -78,7 +82,86 @@ def date_page(request, page_code, page_type_code=None):
     return latest_date
 
 
-@last_modified(date_page)
+def render_page_templates(thepage, context):
+    """
+    Render text, header and javascript of thepage with context,
+    returning dictionary of rendered_text, rendered_header 
+    and rendered_javascript.
+    Rendering text adds to the auxiliary data of context.
+    """
+    if thepage.text:
+        try:
+            rendered_text = Template("{% load mi_tags question_tags %}"+thepage.text).render(context)
+        except Exception as e:
+            rendered_text = "Template error in text (TMPLERR): %s" % e
+    else:
+        rendered_text = ""
+
+    if thepage.header:
+        try:
+            rendered_header = Template("{% load mi_tags question_tags %}"+thepage.header).render(context)
+        except Exception as e:
+            rendered_header = ""
+            rendered_text = "<p>Template error in text (TMPLERR): %s</p> %s" \
+                            % (e, rendered_text)
+    else:
+        rendered_header = ""
+
+    if thepage.javascript:
+        try:
+            rendered_javascript = Template("{% load mi_tags question_tags %}"+thepage.javascript).render(context)
+        except Exception as e:
+            rendered_javascript = ""
+            rendered_text = "<p>Template error in text (TMPLERR): %s</p> %s" \
+                            % (e, rendered_text)
+    else:
+        rendered_javascript = ""
+
+    return {'rendered_text': rendered_text,
+            'rendered_header': rendered_header,
+            'rendered_javascript': rendered_javascript}
+
+
+def return_page_cache_key(request, thepage, page_type, notation_system,
+                          link_courses):
+    """
+    Return key under which the rendered text, header and javascript 
+    of thepage are cached, or None if the rendering shouldn't be cached.
+
+    The rendering depends on the page, its page type, the notation system,
+    the last date_modified of the page and its applets, videos and images,
+    and link_courses, the courses in which assessments of links are found
+    (see InternalLinkNode).
+
+    Pages with embedded questions, which may be rendered with random seeds,
+    and requests with GET parameters other than bare, 
+    which applets may read, are not cached.
+
+    Timeout can be changed by adding to settings.py:
+    MIDOCS_PAGE_CACHE_TIMEOUT = 3600
+    A timeout of zero disables caching.
+    """
+    if not getattr(settings, 'MIDOCS_PAGE_CACHE_TIMEOUT', 600):
+        return None
+
+    if set(request.GET.keys()) - {'bare'}:
+        return None
+
+    for field in (thepage.text, thepage.header, thepage.javascript):
+        if field and ("display_question" in field
+                      or "display_video_questions" in field):
+            return None
+
+    page_date = return_page_date(thepage)
+
+    return "midocs_page:%s:%s:%s:%s:%s" % (
+        thepage.id, page_type.code, 
+        notation_system.id if notation_system else "",
+        page_date.isoformat(),
+        ",".join(str(course.id) if course else "" 
+                 for course in link_courses))
+
+
 @ensure_csrf_cookie
 def pageview(request, page_code, page_type_code=None, overview=False):
     if page_type_code is None:
@@ -187,33 +270,28 @@ def pageview(request, page_code, page_type_code=None, overview=False):
     context['last_course'] = last_course
     context['thread_content_list'] = thread_content_list
 
-    if thepage.text:
-        try:
-            rendered_text = Template("{% load mi_tags question_tags %}"+thepage.text).render(context)
-        except Exception as e:
-            rendered_text = "Template error in text (TMPLERR): %s" % e
+    # courses in which assessments of links are found, in order
+    # (see InternalLinkNode)
+    link_courses = [last_course]
+    if thread_content_list:
+        link_courses.append(thread_content_list[0].course)
+
+    # rendered text, header and javascript, along with the resulting
+    # auxiliary data, are the same for all users, so are cached
+    from django.core.cache import cache
+    cache_key = return_page_cache_key(request, thepage, page_type,
+                                      notation_system, link_courses)
+    rendered = None
+    if cache_key:
+        rendered = cache.get(cache_key)
+    if rendered is not None:
+        context['_auxiliary_data_'] = rendered['auxiliary_data']
     else:
-        rendered_text = ""
-
-    if thepage.header:
-        try:
-            rendered_header = Template("{% load mi_tags question_tags %}"+thepage.header).render(context)
-        except Exception as e:
-            rendered_header = ""
-            rendered_text = "<p>Template error in text (TMPLERR): %s</p> %s" \
-                            % (e, rendered_text)
-    else:
-        rendered_header = ""
-
-    if thepage.javascript:
-        try:
-            rendered_javascript = Template("{% load mi_tags question_tags %}"+thepage.javascript).render(context)
-        except Exception as e:
-            rendered_javascript = ""
-            rendered_text = "<p>Template error in text (TMPLERR): %s</p> %s" \
-                            % (e, rendered_text)
-    else:
-        rendered_javascript = ""
+        rendered = render_page_templates(thepage, context)
+        if cache_key:
+            rendered['auxiliary_data'] = context['_auxiliary_data_']
+            cache.set(cache_key, rendered, 
+                      getattr(settings, 'MIDOCS_PAGE_CACHE_TIMEOUT', 600))
 
     templates = ["midocs/%s_detail.html" % page_type.code, "midocs/page_detail.html"]
 
@@ -228,9 +306,9 @@ def pageview(request, page_code, page_type_code=None, overview=False):
                     'notation_config': notation_config,
                     'notation_system_form': notation_system_form,
                     'noanalytics': noanalytics,
-                    'rendered_text': rendered_text,
-                    'rendered_header': rendered_header,
-                    'rendered_javascript': rendered_javascript,
+                    'rendered_text': rendered['rendered_text'],
+                    'rendered_header': rendered['rendered_header'],
+                    'rendered_javascript': rendered['rendered_javascript'],
                 });
 
     return render(request, templates, context=context.flatten() )
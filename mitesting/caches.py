@@ -0,0 +1,86 @@
+from django.conf import settings
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe, in-process cache that evicts the least
+    recently used entry once max_size entries are stored.
+    If max_size is zero, nothing is cached.
+
+    Entries are stored as is, so callers are responsible for copying
+    any mutable values that should not be shared between requests.
+    """
+
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            # reinsert so that key is marked as most recently used
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        if not self.max_size:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, predicate):
+        """
+        Remove all entries whose key satisfies predicate(key).
+        """
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Evaluated expression contexts from setup_expression_context,
+# keyed by (question id, question revision, seed, random outcomes).
+# Size can be changed by adding to settings.py:
+# MITESTING_EXPRESSION_CONTEXT_CACHE_SIZE = 1000
+expression_context_cache = LRUCache(
+    getattr(settings, 'MITESTING_EXPRESSION_CONTEXT_CACHE_SIZE', 500))
+
+# QuestionPlans from return_question_plan,
+# keyed by (question id, question revision).
+# Size can be changed by adding to settings.py:
+# MITESTING_QUESTION_PLAN_CACHE_SIZE = 1000
+question_plan_cache = LRUCache(
+    getattr(settings, 'MITESTING_QUESTION_PLAN_CACHE_SIZE', 500))
+
+# Compiled templates of question, subpart, hint and solution text
+# from return_compiled_template, keyed by
+# (question id, model name, pk, field, question revision).
+# Size can be changed by adding to settings.py:
+# MITESTING_COMPILED_TEMPLATE_CACHE_SIZE = 2000
+compiled_template_cache = LRUCache(
+    getattr(settings, 'MITESTING_COMPILED_TEMPLATE_CACHE_SIZE', 1000))
+
+
+def invalidate_question_caches(question_ids):
+    """
+    Remove all cached data for the questions with ids in question_ids.
+    """
+    question_ids = set(question_ids)
+    for cache in (expression_context_cache, question_plan_cache,
+                  compiled_template_cache):
+        cache.invalidate(lambda key: key[0] in question_ids)
@@ -604,138 +604,133 @@ def compare_response_with_answer_code(user_response, the_answer_info, question,
     return answer_result
 
 
-def index_convert(i, removed_indices):
-    # compute index of original array from index of array with removed entries
-
-    # removed_indices is a list of entries removed from original array
-
-    # assume removed_indices is small so just do linear search
-    
-    for ind in sorted(removed_indices):
-        if i >= ind:
-            i += 1
-        else:
-            return i
-    return i
-
-
-def match_max_ones(A):
-    """
-    Find elements (i,j) of matrix A, maximizing number of 1's under
-    condition that each i and each j are used at most once
-
-    Assume A is a matrix of 1's and 0's. 
-    
-    Returns a list of tuples of form (i,j), where each i and j in range of 
-    column and row indicies, respectively, and each i and j appear at most once.
-    
+def maximum_bipartite_matching(adjacency, n_right):
     """
-    index_list = []
-    removed_rows = []
-    removed_cols = []
-    
-    # find any rows that have exactly one 1
-    
-    while True:
-        removed_nonzero_items=False
-
-        rows_to_remove = []
-        for row_ind in range(A.rows):
-            the_row=list(A[row_ind,:])
-            if sum(the_row) == 1:
-                col_ind= the_row.index(1)
-                index_list.append((index_convert(row_ind,removed_rows), 
-                                   index_convert(col_ind,removed_cols)))
-                # remove row later
-                rows_to_remove.append(row_ind)
-
-                # remove column right away
-                removed_cols.append(index_convert(col_ind,removed_cols))
-                A.col_del(col_ind)
-
-                removed_nonzero_items=True
-            elif sum(the_row)==0:
-                rows_to_remove.append(row_ind)
-        
-        rows_to_remove_converted = []
-        rows_to_keep=list(range(A.rows))
-
-        for row_ind in rows_to_remove:
-            rows_to_remove_converted.append(index_convert(row_ind,removed_rows))
-            rows_to_keep.remove(row_ind)
-
-        removed_rows.extend(rows_to_remove_converted)
-
-        A=A[rows_to_keep, :]
-
+    Find a maximum matching of a bipartite graph 
+    using the Hopcroft-Karp algorithm.
 
-        cols_to_remove = []
-        for col_ind in range(A.cols):
-            the_col=list(A[:,col_ind])
-            if sum(the_col) == 1:
-                row_ind= the_col.index(1)
-                index_list.append((index_convert(row_ind,removed_rows), 
-                                   index_convert(col_ind,removed_cols)))
+    The left vertices are 0, ..., len(adjacency)-1 and the right vertices
+    are 0, ..., n_right-1.  adjacency[i] is a list of the right vertices
+    joined to left vertex i by an edge.
 
-                # remove column later
-                cols_to_remove.append(col_ind)
+    Returns a list of tuples of form (i,j), where each i is a left vertex,
+    each j is a right vertex adjacent to i, and each i and j appear 
+    at most once.  The list is as long as possible and sorted by i.
 
-                # remove row right away
-                removed_rows.append(index_convert(row_ind,removed_rows))
-                A.row_del(row_ind)
+    """
 
-                removed_nonzero_items=True
-            elif sum(the_col)==0:
-                cols_to_remove.append(col_ind)
-        
-        cols_to_remove_converted = []
-        cols_to_keep=list(range(A.cols))
+    n_left = len(adjacency)
+    match_left = [None]*n_left
+    match_right = [None]*n_right
 
-        for col_ind in cols_to_remove:
-            cols_to_remove_converted.append(index_convert(col_ind,removed_cols))
-            cols_to_keep.remove(col_ind)
+    while True:
+        # breadth first search from all unmatched left vertices
+        # to compute the layer of each left vertex on shortest
+        # alternating paths
+        layer = [None]*n_left
+        queue = [i for i in range(n_left) if match_left[i] is None]
+        for i in queue:
+            layer[i] = 0
+        found_augmenting_path = False
+        for i in queue:
+            for j in adjacency[i]:
+                i_next = match_right[j]
+                if i_next is None:
+                    found_augmenting_path = True
+                elif layer[i_next] is None:
+                    layer[i_next] = layer[i]+1
+                    queue.append(i_next)
+
+        if not found_augmenting_path:
+            break
 
-        removed_cols.extend(cols_to_remove_converted)
+        # depth first search along the layers for
+        # vertex disjoint augmenting paths, flipping each one found
+        def augment(i):
+            for j in adjacency[i]:
+                i_next = match_right[j]
+                if i_next is None or (layer[i_next] == layer[i]+1
+                                      and augment(i_next)):
+                    match_left[i] = j
+                    match_right[j] = i
+                    return True
+            # dead end, so don't visit again in this phase
+            layer[i] = None
+            return False
 
-        A=A[:, cols_to_keep]
+        for i in range(n_left):
+            if match_left[i] is None:
+                augment(i)
 
-        if not removed_nonzero_items:
-            break
+    return [(i, j) for (i, j) in enumerate(match_left) if j is not None]
 
-    # if removed all rows or columns of A, then we are done
-    if(A.rows*A.cols==0):
-        return index_list
-
-    # in the remaining matrix A, each row and each column has at least two 1s.
-    # Take the first row of A, match it in turn with each column with a 1,
-    # compute the index_list from the remaining submatrix
-    # Choose the alternative where index list is the largest
 
+def maximum_weight_matching(weights):
+    """
+    Find a perfect matching of the rows and columns of the square
+    matrix weights (a list of lists of numbers) that maximizes the
+    sum of the matched weights, using the Hungarian algorithm.
 
-    index_sublists = []
-    len_sublists=[]
-    for col in range(A.cols):
-        if A[0,col]==0:
-            index_sublists.append(None)
-            len_sublists.append(-1)
-        else:
-            index_sublists.append(match_max_ones(A.minorMatrix(0,col)))
-            len_sublists.append(len(index_sublists[col]))
+    Returns a list of tuples of form (i,j) of row and column indices,
+    where each i and each j appear exactly once.  The list is sorted by i.
 
-    best_col = len_sublists.index(max(len_sublists))
+    """
 
-    row = index_convert(0,removed_rows)
-    col = index_convert(best_col,removed_cols)
-    index_list.append((row,col))
-    removed_rows.append(row)
-    removed_cols.append(col)
+    n = len(weights)
+    if n == 0:
+        return []
+
+    # convert to the problem of minimizing nonnegative costs
+    max_weight = max(max(row) for row in weights)
+    cost = [[max_weight-w for w in row] for row in weights]
+
+    # Rows and columns are numbered starting with 1,
+    # with 0 used as a fictitious column to start each augmenting path.
+    # u and v are the potentials of the rows and columns, 
+    # row_of_col[j] is the row matched with column j,
+    # and previous_col[j] records the augmenting path.
+    infinity = float('inf')
+    u = [0]*(n+1)
+    v = [0]*(n+1)
+    row_of_col = [0]*(n+1)
+    previous_col = [0]*(n+1)
+
+    for i in range(1, n+1):
+        row_of_col[0] = i
+        j0 = 0
+        min_slack = [infinity]*(n+1)
+        used = [False]*(n+1)
+        while True:
+            used[j0] = True
+            i0 = row_of_col[j0]
+            delta = infinity
+            j1 = 0
+            for j in range(1, n+1):
+                if not used[j]:
+                    slack = cost[i0-1][j-1]-u[i0]-v[j]
+                    if slack < min_slack[j]:
+                        min_slack[j] = slack
+                        previous_col[j] = j0
+                    if min_slack[j] < delta:
+                        delta = min_slack[j]
+                        j1 = j
+            for j in range(n+1):
+                if used[j]:
+                    u[row_of_col[j]] += delta
+                    v[j] -= delta
+                else:
+                    min_slack[j] -= delta
+            j0 = j1
+            if row_of_col[j0] == 0:
+                break
 
-    for pair in index_sublists[best_col]:
-        row =index_convert(pair[0],removed_rows)
-        col =index_convert(pair[1],removed_cols)
-        index_list.append((row,col))
+        # flip the augmenting path ending at column j0
+        while j0:
+            j1 = previous_col[j0]
+            row_of_col[j0] = row_of_col[j1]
+            j0 = j1
 
-    return index_list
+    return sorted((row_of_col[j]-1, j-1) for j in range(1, n+1))
 
     
 def grade_question_group(group_list, user_responses, answer_info, question,
@@ -746,7 +741,8 @@ def grade_question_group(group_list, user_responses, answer_info, question,
     in any sequence.
 
     First, match as many answers with responses that get full credit.
-    Then, match answers with responses in order of decreasing percent credit.
+    Then, match the remaining answers with responses to maximize
+    the points from partial credit.
 
     Inputs:
     - group_list: list of answer numbers in the given group
@@ -770,8 +766,6 @@ def grade_question_group(group_list, user_responses, answer_info, question,
     """
 
 
-    from sympy import zeros
-
     n_answers=len(group_list)
 
     answer_array = []
@@ -800,59 +794,39 @@ def grade_question_group(group_list, user_responses, answer_info, question,
                     'answer_feedback': 'Sorry.  Unable to understand the answer.  Possibly, a server error occured.'})
 
 
-    correct_matrix = zeros(n_answers, n_answers)
+    # for each response, list the answers for which it is correct
+    correct_answers = []
     for response_num in range(n_answers):
-        for answer_num in range(n_answers):
-            if answer_array[response_num][answer_num]['answer_correct']:
-                correct_matrix[response_num,answer_num] = 1
+        correct_answers.append(
+            [answer_num for answer_num in range(n_answers)
+             if answer_array[response_num][answer_num]['answer_correct']])
 
-                
     # match as many as possible answers with full credit
-    answer_matches = match_max_ones(correct_matrix)
+    answer_matches = maximum_bipartite_matching(correct_answers, n_answers)
     n_matches = len(answer_matches)
     n_answers_left = n_answers-n_matches
 
     if n_answers_left > 0:
 
-        # for remaining responses and answers match starting with the 
-        # largest partial credit
-        responses_used = []
-        answers_used = []
-        for match in answer_matches:
-            responses_used.append(match[0])
-            answers_used.append(match[1])
-
-        # partial credit matrix
-        P = zeros(n_answers_left, n_answers_left)
-
-        row=-1
-        for response_num in range(n_answers):
-            if response_num in responses_used:
-                continue
-            row +=1
-            col=-1
-            for answer_num in range(n_answers):
-                if answer_num in answers_used:
-                    continue
-                col+=1
-                P[row,col] = \
-                    answer_array[response_num][answer_num]['percent_correct']
-
-        while P.rows > 0:
-            max_credit = max(P)
-            for row in range(P.rows):
-                try:
-                    col = list(P[row,:]).index(max_credit)
-                except ValueError:
-                    continue
-                actual_response=index_convert(row,responses_used)
-                actual_answer=index_convert(col,answers_used)
-                answer_matches.append((actual_response,actual_answer))
-                responses_used.append(actual_response)
-                answers_used.append(actual_answer)
-                P.row_del(row)
-                P.col_del(col)
-                break
+        # match remaining responses and answers so that the
+        # points from partial credit are as large as possible
+        responses_used = [match[0] for match in answer_matches]
+        answers_used = [match[1] for match in answer_matches]
+        responses_left = [response_num for response_num in range(n_answers)
+                          if response_num not in responses_used]
+        answers_left = [answer_num for answer_num in range(n_answers)
+                        if answer_num not in answers_used]
+
+        # partial credit matrix, weighted by points of the response's blank
+        P = []
+        for response_num in responses_left:
+            response_points = answer_info[group_list[response_num]]['points']
+            P.append([response_points*
+                      answer_array[response_num][answer_num]['percent_correct']
+                      for answer_num in answers_left])
+
+        for (row, col) in maximum_weight_matching(P):
+            answer_matches.append((responses_left[row], answers_left[col]))
 
     # record answers in answer_results
     points_achieved_times_100=0
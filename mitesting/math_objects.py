@@ -628,6 +628,27 @@ class math_object(object):
             new_expr = bottom_up(new_expr, replace_logs)
 
 
+        match_partial_on_compare = self._parameters.get(
+            'match_partial_on_compare',False)
+
+        # Before normalizing, which can be slow, see if the values
+        # of the expressions at random points show they must differ.
+        # Skip if the comparison could give credit to expressions that 
+        # are not numerically equal, i.e., when rounding, checking errors,
+        # or giving partial credit to functions.
+        if not check_errors and not match_partial_on_compare \
+           and self._parameters.get('round_on_compare') is None \
+           and numerical_fingerprints_differ(expression, new_expr):
+            return {'fraction_equal': 0, 'fraction_equal_on_normalize': 0,
+                    'fraction_equal_errors': 0, 'n_sign_errors': 0,
+                    'n_constant_term_errors': 0,
+                    'n_constant_factor_errors': 0,
+                    'fraction_equal_on_normalize_errors': 0,
+                    'n_sign_errors_on_normalize': 0,
+                    'n_constant_term_errors_on_normalize': 0,
+                    'n_constant_factor_errors_on_normalize': 0,
+            }
+
         # Calculate the normalized expressions for both expressions,
         # rounded to precision as specified by 
         # round_on_compare and round_absolute (with additional rounding)
@@ -650,8 +671,6 @@ class math_object(object):
             evaluate=comparison_evaluate)
 
         tuple_is_unordered = self._parameters.get('tuple_is_unordered',False)
-        match_partial_on_compare = self._parameters.get(
-            'match_partial_on_compare',False)
         
         results = {'fraction_equal': 0, 'fraction_equal_on_normalize': 0,
                    'fraction_equal_errors': 0, 'n_sign_errors': 0,
@@ -795,6 +814,94 @@ def create_symbol_name_dict():
     return symbol_name_dict
 
 
+def numerical_fingerprint(expression, symbols, n_points=8, seed=0):
+    """
+    Evaluate expression, using numpy, at n_points random points
+    for the given symbols, returning an array of complex values.
+
+    The points are reproducible for a given seed and are chosen
+    near the positive real axis, so that the values do not depend 
+    on branch cuts or on transformations that are valid only for 
+    positive symbols.  Symbols assumed real are given real values.
+
+    Returns None if numpy is not available, if expression cannot be 
+    evaluated numerically, or if a symbol is assumed to be an integer,
+    so that no fingerprint is meaningful.
+
+    """
+
+    try:
+        import numpy
+    except ImportError:
+        return None
+
+    from sympy import lambdify
+
+    random_state = numpy.random.RandomState(seed)
+    points = []
+    for symbol in symbols:
+        if symbol.is_integer or symbol.is_rational:
+            return None
+        values = random_state.uniform(0.5, 1.5, n_points).astype(complex)
+        if not symbol.is_real:
+            values += 0.5j*random_state.uniform(-1, 1, n_points)
+        points.append(values)
+
+    try:
+        f = lambdify(symbols, expression, modules="numpy")
+        with numpy.errstate(all='ignore'):
+            values = numpy.asarray(f(*points), dtype=complex)
+            return values*numpy.ones(n_points)
+    except Exception:
+        return None
+
+
+def numerical_fingerprints_differ(expression1, expression2):
+    """
+    Determine if expression1 and expression2 are clearly different,
+    based on their numerical fingerprints.
+
+    Returns True only if both expressions are scalar expressions,
+    their fingerprints can be computed, the fingerprints have
+    finite values at a majority of the points, and the values
+    differ at every point where both are finite.  
+    Otherwise, returns False, in which case the expressions
+    must be compared symbolically.
+
+    Since expressions that are equal after normalization have
+    the same numerical values, a True result means the expressions
+    will not compare equal.  
+
+    """
+
+    from sympy import Expr
+
+    for expr in (expression1, expression2):
+        if not isinstance(expr, Expr) or getattr(expr, "is_Matrix", False) \
+           or expr.is_Relational or not expr.is_commutative:
+            return False
+
+    symbols = sorted(expression1.free_symbols | expression2.free_symbols,
+                     key=lambda s: s.name)
+
+    n_points = 8
+    fingerprint1 = numerical_fingerprint(expression1, symbols, n_points)
+    if fingerprint1 is None:
+        return False
+    fingerprint2 = numerical_fingerprint(expression2, symbols, n_points)
+    if fingerprint2 is None:
+        return False
+
+    import numpy
+    finite = numpy.isfinite(fingerprint1) & numpy.isfinite(fingerprint2)
+    if 2*finite.sum() <= n_points:
+        return False
+
+    close = numpy.isclose(fingerprint1[finite], fingerprint2[finite],
+                          rtol=1E-6, atol=1E-10)
+    return not close.any()
+
+
 def try_normalize_expr(expr):
     """
     Attempt to normalize expression.
@@ -1288,18 +1395,32 @@ def check_tuple_equality(the_tuple1, the_tuple2, tuple_is_unordered=False, \
         return results
 
     # if not ordered, check if match with any order
-    
-    # loop through all elements of tuple 1
+
+    # First pair off elements that are identical in normalized form,
+    # using their normalized forms to bucket the elements of tuple 2,
+    # so that a correct answer is matched in linear time.
+    # Pairwise comparisons are needed only for the leftover elements.
+    def elements_equal(expr1, expr2):
+        return check_equality(expr1, expr2)["fraction_equal"] == 1
+
+    (remaining1, remaining2, n_identical) = pair_identical_elements(
+        the_tuple1, the_tuple2, equal=elements_equal)
+
+    if nelts1==nelts2 and nelts1==n_identical:
+        results["fraction_equal"] = 1
+        return results
+
+    # loop through all remaining elements of tuple 1
     # for each element, look for a matching element of tuple 2
     # that has not been used yet.
     tuple2_indices_used=[]
-    n_matches=0
+    n_matches=n_identical
     tuple2_indices_used_error=[]
-    n_error_matches=0
+    n_error_matches=n_identical
     n_sign_errors=0
     n_constant_term_errors=0
     n_constant_factor_errors=0
-    for expr1 in the_tuple1:
+    for expr1 in remaining1:
         
         best_match_ind=-1
         best_match=0
@@ -1308,7 +1429,7 @@ def check_tuple_equality(the_tuple1, the_tuple2, tuple_is_unordered=False, \
         best_n_sign_errors=0
         best_n_constant_term_errors=0
         best_n_constant_factor_errors=0
-        for (i, expr2) in enumerate(the_tuple2):
+        for (i, expr2) in enumerate(remaining2):
             if i in tuple2_indices_used and i in tuple2_indices_used_error:
                 continue
             
@@ -1386,6 +1507,91 @@ def check_tuple_equality(the_tuple1, the_tuple2, tuple_is_unordered=False, \
             
 
 
+def pair_identical_elements(elements1, elements2, equal=None):
+    """
+    Pair elements of elements1 with structurally identical 
+    elements of elements2, without regard to order.
+    If equal is given, also pair elements that have the same 
+    normalized form (from return_pairing_key) and for which 
+    equal(element1, element2) is true.
+
+    Elements of elements2 are bucketed by their normalized form, 
+    so that each element of elements1 is compared only with elements 
+    of elements2 in the same bucket.  Elements whose normalized form
+    is unhashable are not paired.
+
+    Returns a tuple (remaining1, remaining2, n_pairs) where
+    remaining1 and remaining2 are lists of the unpaired elements,
+    in their original order, and n_pairs is the number of pairs found.
+
+    """
+
+    buckets = {}
+    remaining2 = list(elements2)
+    for (i, expr2) in enumerate(remaining2):
+        try:
+            buckets.setdefault(return_pairing_key(expr2), []).append(i)
+        except TypeError:
+            pass
+
+    remaining1 = []
+    paired2 = set()
+    for expr1 in elements1:
+        try:
+            bucket = buckets.get(return_pairing_key(expr1), [])
+        except TypeError:
+            bucket = []
+        for (k, i) in enumerate(bucket):
+            expr2 = remaining2[i]
+            if expr2 == expr1 or (equal is not None and equal(expr1, expr2)):
+                paired2.add(i)
+                del bucket[k]
+                break
+        else:
+            remaining1.append(expr1)
+
+    remaining2 = [expr2 for (i, expr2) in enumerate(remaining2)
+                  if i not in paired2]
+
+    return (remaining1, remaining2, len(paired2))
+
+
+def return_pairing_key(expr):
+    """
+    Return normalized form of expr, used by pair_identical_elements
+    to find elements that could compare equal with check_equality
+    even though they are not structurally identical.
+    
+    As in check_tuple_equality, vectors and open intervals
+    are converted to Tuples and closed intervals to lists
+    (represented by tuples starting with "list", so that they are hashable).
+    As in check_relational_equality, inequalities are represented 
+    by their smaller and larger sides, so that inequalities
+    with sides reversed have the same form.
+
+    """
+
+    from .sympy_customized import Interval
+    from .customized_commands import MatrixAsVector
+
+    if isinstance(expr, list):
+        return ("list",) + tuple(return_pairing_key(e) for e in expr)
+    if isinstance(expr, MatrixAsVector) or isinstance(expr, tuple):
+        return Tuple(*expr)
+    if isinstance(expr, Interval):
+        if expr.left_open and expr.right_open:
+            return Tuple(expr.left, expr.right)
+        if not expr.left_open and not expr.right_open:
+            return ("list", return_pairing_key(expr.left),
+                    return_pairing_key(expr.right))
+        return expr
+    if is_strict_inequality(expr):
+        return ("<", expr.lts, expr.gts)
+    if is_nonstrict_inequality(expr):
+        return ("<=", expr.lts, expr.gts)
+    return expr
+
+
 def check_set_equality(the_set1, the_set2, partial_matches=False,
                        check_sign_errors=False,
                        check_constant_term_errors=False,
@@ -7,7 +7,8 @@ from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from math import *
 import re
 from sympy import Function, Tuple, Symbol
-from django.db.models import Max
+from django.db.models import Max, F, Q
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from mitesting.math_objects import math_object
 from mitesting.sympy_customized import parse_expr, parse_and_process, customized_sort_key, SymbolCallable, TupleNoParen
 import logging
@@ -79,6 +80,9 @@ class Question(models.Model):
     subjects = models.ManyToManyField('midocs.Subject', blank=True)
     authors = models.ManyToManyField('midocs.Author', through='QuestionAuthor',
                                      blank=True)
+    # incremented whenever question or anything used to evaluate
+    # its expressions changes, so that cached results can be discarded
+    revision = models.PositiveIntegerField(default=0, editable=False)
     objects = models.Manager()
     question_database = QuestionDatabaseManager()
 
@@ -90,6 +94,18 @@ class Question(models.Model):
     def __str__(self):
         return "%s: %s" % (self.id, self.name)
 
+    def save(self, *args, **kwargs):
+        # revision is changed only by update_question_revisions,
+        # so don't write back the revision of an existing question,
+        # which may be out of date if its components have changed
+        if self.pk is not None and not self._state.adding \
+           and kwargs.get('update_fields') is None \
+           and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'revision']
+        super(Question, self).save(*args, **kwargs)
+
     @models.permalink
     def get_absolute_url(self):
         return('miquestion:question', (), {'question_id': self.id})
@@ -156,12 +172,20 @@ class Question(models.Model):
         Otherwise use commands from allowed_sympy_commands.
         """
         from .utils import return_sympy_local_dict
-        if user_response and self.customize_user_sympy_commands:
-            return return_sympy_local_dict(
-                [a.commands for a in \
-                     self.allowed_user_sympy_commands.all()])
         return return_sympy_local_dict(
-            [a.commands for a in self.allowed_sympy_commands.all()])
+            self.return_allowed_sympy_commands(user_response=user_response))
+
+    def return_allowed_sympy_commands(self, user_response=False):
+        """
+        Return list of strings of comma separated sympy command names
+        allowed for the question, as used by return_sympy_local_dict.
+        If user_response is True and customize_sympy_user_commands is True,
+        then use the commands from allowed_user_sympy_commands.
+        Otherwise use commands from allowed_sympy_commands.
+        """
+        if user_response and self.customize_user_sympy_commands:
+            return [a.commands for a in self.allowed_user_sympy_commands.all()]
+        return [a.commands for a in self.allowed_sympy_commands.all()]
     
 
     def render_javascript_commands(self, context, question=True, solution=False):
@@ -1009,3 +1033,64 @@ class SympyCommandSet(models.Model):
     default = models.BooleanField(default=False)
     def __str__(self):
         return self.name
+
+
+def update_question_revisions(question_ids):
+    """
+    Increment the revision of the questions with ids in question_ids
+    and discard any of their results cached in this process.
+    """
+    question_ids = [qid for qid in question_ids if qid is not None]
+    if not question_ids:
+        return
+    Question.objects.filter(id__in=question_ids)\
+                    .update(revision=F('revision')+1)
+    from mitesting.caches import invalidate_question_caches
+    invalidate_question_caches(question_ids)
+
+def question_changed(sender, **kwargs):
+    question = kwargs['instance']
+    if kwargs.get('raw'):
+        from mitesting.caches import invalidate_question_caches
+        invalidate_question_caches([question.id])
+    else:
+        update_question_revisions([question.id])
+        question.revision = Question.objects.filter(id=question.id)\
+                                            .values_list('revision', flat=True)[0]
+
+def question_component_changed(sender, **kwargs):
+    update_question_revisions([kwargs['instance'].question_id])
+
+def sympy_command_set_changed(sender, **kwargs):
+    command_set = kwargs['instance']
+    question_ids = Question.objects.filter(
+        Q(allowed_sympy_commands=command_set) |
+        Q(allowed_user_sympy_commands=command_set))\
+        .values_list('id', flat=True).distinct()
+    update_question_revisions(list(question_ids))
+
+def allowed_sympy_commands_changed(sender, **kwargs):
+    action = kwargs['action']
+    if kwargs['reverse']:
+        # instance is a SympyCommandSet and pk_set contains question ids
+        if action in ('post_add', 'post_remove'):
+            update_question_revisions(kwargs['pk_set'])
+        elif action == 'pre_clear':
+            sympy_command_set_changed(sender, **kwargs)
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        update_question_revisions([kwargs['instance'].id])
+
+
+post_save.connect(question_changed, sender=Question,
+                  dispatch_uid='question-revision-save-signal')
+for model in (Expression, ExpressionFromAnswer, QuestionSubpart):
+    post_save.connect(question_component_changed, sender=model,
+                      dispatch_uid='question-revision-save-signal')
+    post_delete.connect(question_component_changed, sender=model,
+                        dispatch_uid='question-revision-delete-signal')
+post_save.connect(sympy_command_set_changed, sender=SympyCommandSet,
+                  dispatch_uid='question-revision-save-signal')
+for through in (Question.allowed_sympy_commands.through,
+                Question.allowed_user_sympy_commands.through):
+    m2m_changed.connect(allowed_sympy_commands_changed, sender=through,
+                        dispatch_uid='question-revision-m2m-signal')
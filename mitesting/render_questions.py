@@ -4,6 +4,7 @@ from django.utils.safestring import mark_safe
 from django.core.urlresolvers import reverse
 from django.db import transaction
 from django.db.utils import OperationalError
+from collections import namedtuple
 import json 
 import re
 import sys
@@ -20,9 +21,60 @@ Identifier changed
 
 """
 
+# The database objects needed to evaluate the expressions of a question,
+# loaded once so that setup_expression_context does not query the database
+# again for each attempt to meet the expression conditions.
+# - expressions: tuple of expressions not flagged as post user response
+# - post_user_expressions: tuple of expressions flagged as post user response
+# - expressions_from_answers: tuple of ExpressionFromAnswer of the question
+# - allowed_sympy_commands: tuple of strings of comma separated commands
+#   used to create local_dict
+# - allowed_user_sympy_commands: the same, used to create user_dict
+QuestionPlan = namedtuple('QuestionPlan', [
+    'expressions', 'post_user_expressions', 'expressions_from_answers',
+    'allowed_sympy_commands', 'allowed_user_sympy_commands'])
+
+
+def return_question_plan(question):
+    """
+    Return the QuestionPlan for question.
+
+    Plans are cached in the process-wide question_plan_cache,
+    keyed by question id and question revision.
+    """
+
+    from mitesting.caches import question_plan_cache
+
+    if question.id is not None:
+        cache_key = (question.id, question.revision)
+        plan = question_plan_cache.get(cache_key)
+        if plan is not None:
+            return plan
+    else:
+        cache_key = None
+
+    expressions = list(question.expression_set.all())
+    plan = QuestionPlan(
+        expressions = tuple(expr for expr in expressions
+                            if not expr.post_user_response),
+        post_user_expressions = tuple(expr for expr in expressions
+                                      if expr.post_user_response),
+        expressions_from_answers = tuple(
+            question.expressionfromanswer_set.all()),
+        allowed_sympy_commands = tuple(
+            question.return_allowed_sympy_commands()),
+        allowed_user_sympy_commands = tuple(
+            question.return_allowed_sympy_commands(user_response=True)),
+    )
+
+    if cache_key is not None:
+        question_plan_cache.set(cache_key, plan)
+
+    return plan
+
  
 def setup_expression_context(question, rng, seed, user_responses=None,
-                             random_outcomes={}):
+                             random_outcomes=None):
     """
     Set up the question context by parsing all expressions for question.
     Returns context that contains all evaluated expressions 
@@ -64,6 +116,14 @@ def setup_expression_context(question, rng, seed, user_responses=None,
       is encountered.
     These lists and dictionaries are added to the expression context.
 
+    The results of the first step depend only on the question,
+    the seed and random_outcomes, so they are cached in the process-wide
+    expression_context_cache, keyed by question id, question revision,
+    seed and random_outcomes.  Grading a response then reuses the
+    expressions that were evaluated when the question was rendered.
+    On a cache hit, random_outcomes and the state of rng are restored 
+    to what they were after the expressions were evaluated.
+
     Return a dictionary with the following:
     - expression_context: a Context() with mappings from the expressions
     - error_in_expressions: True if encountered any errors in normal expressions
@@ -76,98 +136,48 @@ def setup_expression_context(question, rng, seed, user_responses=None,
 
     """
 
-    rng.seed(seed)
-
-    max_tries=500
-    success=False
-
-    failed_condition_message=""
-    failed_conditions=True
-
-    from mitesting.utils import get_new_seed
-
-    for i in range(max_tries):
-
-        if i>0:
-            seed=get_new_seed(rng)
-            rng.seed(seed)
-
-            # remove any specifications for random outcomes
-            # since they caused a failed condition
-            random_outcomes.clear()
-
-        expression_context = Context({})
-        random_group_indices={}
-        error_in_expressions = False
-        expression_error = {}
-
-        # initialize global dictionary using the comamnds
-        # found in allowed_sympy_commands.
-        # Also adds standard symbols to dictionary.
-        local_dict = question.return_sympy_local_dict()
-        user_dict = question.return_sympy_local_dict(
-            user_response=True)
-        alternate_dicts = []
-        alternate_exprs = {}
-        alternate_funcs = {}
-        try:
-
-            from mitesting.models import Expression
-            # first processes the expressions that aren't flagged
-            # as post user response
-            for expression in question.expression_set\
-                                      .filter(post_user_response=False):
-
-                try:
-                    evaluate_results=expression.evaluate(
-                        local_dict=local_dict, 
-                        user_dict=user_dict,
-                        alternate_dicts = alternate_dicts, 
-                        random_group_indices=random_group_indices,
-                        rng=rng, random_outcomes=random_outcomes)
-                # on FailedCondition, reraise to stop evaluating expressions
-                except Expression.FailedCondition:
-                    raise
-
-                # for any other exception, record exception and
-                # allow to continue processing expressions
-                except Exception as exc:
-                    error_in_expressions = True
-                    expression_error[expression.name] = str(exc)
-                    expression_context[expression.name] = '??'
-                    if expression.expression_type == expression.RANDOM_WORD:
-                        expression_context[expression.name + "_plural"] = "??"
-                else:
-                    # if random word, add singular and plural to context
-                    if expression.expression_type == expression.RANDOM_WORD:
-                        expression_evaluated\
-                            =evaluate_results['expression_evaluated']
-                        expression_context[expression.name] \
-                            = expression_evaluated[0]
-                        expression_context[expression.name + "_plural"] \
-                            = expression_evaluated[1]
-                    else:
-                        expression_context[expression.name] \
-                            = evaluate_results['expression_evaluated']
-                        # the following lists will be empty until the
-                        # first EXPRESSION_WITH_ALTERNATES is encountered
-                        alternate_exprs[expression.name] \
-                            = evaluate_results['alternate_exprs']
-                        alternate_funcs[expression.name] \
-                            = evaluate_results['alternate_funcs']
+    from mitesting.caches import expression_context_cache
 
-                        the_expr = expression_context[expression.name]
+    if random_outcomes is None:
+        random_outcomes = {}
 
-            # if make it through all expressions without encountering
-            # a failed condition, then record fact and
-            # break out of loop
-            failed_conditions = False
-            break
+    plan = return_question_plan(question)
 
-        # on FailedCondition, continue loop, but record
-        # message in case it is final pass through loop
-        except Expression.FailedCondition as exc:
-            failed_condition_message = exc.args[0]
+    # random_outcomes is modified in place while evaluating expressions,
+    # so fingerprint it before evaluating
+    if question.id is not None:
+        cache_key = (question.id, question.revision, seed,
+                     json.dumps(random_outcomes, sort_keys=True))
+        snapshot = expression_context_cache.get(cache_key)
+    else:
+        cache_key = None
+        snapshot = None
+
+    if snapshot is None:
+        snapshot = evaluate_normal_expressions(
+            plan, rng=rng, seed=seed, random_outcomes=random_outcomes)
+        if cache_key is not None:
+            expression_context_cache.set(
+                cache_key, copy_expression_snapshot(snapshot))
+    else:
+        snapshot = copy_expression_snapshot(snapshot)
+        rng.setstate(snapshot['rng_state'])
+        random_outcomes.clear()
+        random_outcomes.update(snapshot['random_outcomes'])
+
+    seed = snapshot['seed']
+    failed_conditions = snapshot['failed_conditions']
+    failed_condition_message = snapshot['failed_condition_message']
+    error_in_expressions = snapshot['error_in_expressions']
+    expression_error = snapshot['expression_error']
+    random_group_indices = snapshot['random_group_indices']
+    local_dict = snapshot['local_dict']
+    user_dict = snapshot['user_dict']
+    alternate_dicts = snapshot['alternate_dicts']
+    alternate_exprs = snapshot['alternate_exprs']
+    alternate_funcs = snapshot['alternate_funcs']
+
+    expression_context = Context(snapshot['expression_context'])
 
     # add state to expression context as convenience to 
     # reset state if not generating regular expression
@@ -196,7 +206,7 @@ def setup_expression_context(question, rng, seed, user_responses=None,
 
         # ExpressionFromAnswer contains information about any
         # answers that were assigned to expressions
-        for expression in question.expressionfromanswer_set.all():
+        for expression in plan.expressions_from_answers:
             # will assign Dummy(default_value) if no response given for answer
             # or if error in parsing respons
             default_value= re.sub('_long_underscore_', '\uff3f',
@@ -243,8 +253,7 @@ def setup_expression_context(question, rng, seed, user_responses=None,
                 math_object(math_expr, evaluate_level=EVALUATE_NONE)
 
         # last, process expressions flagged as post user response
-        for expression in question.expression_set\
-                                  .filter(post_user_response=True):
+        for expression in plan.post_user_expressions:
 
             try:
                 evaluate_results=expression.evaluate(
@@ -284,6 +293,162 @@ def setup_expression_context(question, rng, seed, user_responses=None,
     return results
 
 
+
+def evaluate_normal_expressions(plan, rng, seed, random_outcomes={}):
+    """
+    Evaluate the expressions from the QuestionPlan plan that are not flagged
+    as post user response, the first step of setup_expression_context.
+    The plan is reused for every attempt, so the number of
+    database queries does not depend on the number of attempts.
+
+    Random expressions are based on state of random instance rng set by seed.
+    If an expression is a CONDITION that is not met, a new seed is
+    generated and all expressions are evaluated again, up to 500 times.
+
+    Returns a snapshot dictionary with the results of the evaluation
+    that contains only plain dictionaries and lists
+    (along with the sympy results) so that it can be cached
+    and copied with copy_expression_snapshot.  The keys are
+    - expression_context: dictionary mapping expression names to results
+    - local_dict, user_dict, alternate_dicts, alternate_exprs,
+      alternate_funcs: as described in setup_expression_context
+    - random_group_indices: indices chosen for random list groups
+    - random_outcomes: the random outcomes after evaluation
+    - rng_state: the state of rng after evaluation
+    - error_in_expressions, expression_error, failed_conditions,
+      failed_condition_message, seed: as described 
+      in setup_expression_context
+    """
+
+    rng.seed(seed)
+
+    max_tries=500
+    success=False
+
+    failed_condition_message=""
+    failed_conditions=True
+
+    from mitesting.utils import get_new_seed, return_sympy_local_dict
+    from mitesting.models import Expression
+
+    for i in range(max_tries):
+
+        if i>0:
+            seed=get_new_seed(rng)
+            rng.seed(seed)
+
+            # remove any specifications for random outcomes
+            # since they caused a failed condition
+            random_outcomes.clear()
+
+        expression_context = {}
+        random_group_indices={}
+        error_in_expressions = False
+        expression_error = {}
+
+        # initialize global dictionary using the comamnds
+        # found in allowed_sympy_commands.
+        # Also adds standard symbols to dictionary.
+        local_dict = return_sympy_local_dict(plan.allowed_sympy_commands)
+        user_dict = return_sympy_local_dict(
+            plan.allowed_user_sympy_commands)
+        alternate_dicts = []
+        alternate_exprs = {}
+        alternate_funcs = {}
+        try:
+
+            # first processes the expressions that aren't flagged
+            # as post user response
+            for expression in plan.expressions:
+
+                try:
+                    evaluate_results=expression.evaluate(
+                        local_dict=local_dict, 
+                        user_dict=user_dict,
+                        alternate_dicts = alternate_dicts, 
+                        random_group_indices=random_group_indices,
+                        rng=rng, random_outcomes=random_outcomes)
+                # on FailedCondition, reraise to stop evaluating expressions
+                except Expression.FailedCondition:
+                    raise
+
+                # for any other exception, record exception and
+                # allow to continue processing expressions
+                except Exception as exc:
+                    error_in_expressions = True
+                    expression_error[expression.name] = str(exc)
+                    expression_context[expression.name] = '??'
+                    if expression.expression_type == expression.RANDOM_WORD:
+                        expression_context[expression.name + "_plural"] = "??"
+                else:
+                    # if random word, add singular and plural to context
+                    if expression.expression_type == expression.RANDOM_WORD:
+                        expression_evaluated\
+                            =evaluate_results['expression_evaluated']
+                        expression_context[expression.name] \
+                            = expression_evaluated[0]
+                        expression_context[expression.name + "_plural"] \
+                            = expression_evaluated[1]
+                    else:
+                        expression_context[expression.name] \
+                            = evaluate_results['expression_evaluated']
+                        # the following lists will be empty until the
+                        # first EXPRESSION_WITH_ALTERNATES is encountered
+                        alternate_exprs[expression.name] \
+                            = evaluate_results['alternate_exprs']
+                        alternate_funcs[expression.name] \
+                            = evaluate_results['alternate_funcs']
+
+                        the_expr = expression_context[expression.name]
+
+            # if make it through all expressions without encountering
+            # a failed condition, then record fact and
+            # break out of loop
+            failed_conditions = False
+            break
+
+        # on FailedCondition, continue loop, but record
+        # message in case it is final pass through loop
+        except Expression.FailedCondition as exc:
+            failed_condition_message = exc.args[0]
+
+    return {
+        'seed': seed,
+        'failed_conditions': failed_conditions,
+        'failed_condition_message': failed_condition_message,
+        'error_in_expressions': error_in_expressions,
+        'expression_error': expression_error,
+        'expression_context': expression_context,
+        'random_group_indices': random_group_indices,
+        'local_dict': local_dict,
+        'user_dict': user_dict,
+        'alternate_dicts': alternate_dicts,
+        'alternate_exprs': alternate_exprs,
+        'alternate_funcs': alternate_funcs,
+        'random_outcomes': dict(random_outcomes),
+        'rng_state': rng.getstate(),
+    }
+
+
+def copy_expression_snapshot(snapshot):
+    """
+    Return a copy of snapshot from evaluate_normal_expressions
+    where all dictionaries and lists that are modified
+    when processing user responses are new objects.
+    The evaluated expressions themselves are shared.
+    """
+    new_snapshot = dict(snapshot)
+    for key in ['expression_context', 'random_group_indices', 'local_dict',
+                'user_dict', 'expression_error', 'random_outcomes']:
+        new_snapshot[key] = dict(snapshot[key])
+    new_snapshot['alternate_dicts'] = [dict(alt_dict) for alt_dict
+                                       in snapshot['alternate_dicts']]
+    for key in ['alternate_exprs', 'alternate_funcs']:
+        new_snapshot[key] = dict((name, list(alts)) for (name, alts)
+                                 in snapshot[key].items())
+    return new_snapshot
+
+
 def return_valid_answer_codes(question, expression_context): 
     """
     For question and expression_content, determine valid answer codes 
@@ -423,6 +588,42 @@ def process_expressions_from_answers(question):
 
 
 
+def return_compiled_template(instance, field, question=None):
+    """
+    Return the Django template compiled from the text in field of instance,
+    which is either a question or one of the subparts of question,
+    after loading the template tags available in question text.
+
+    Compiled templates are cached in the process-wide compiled_template_cache,
+    keyed by question id, model, pk of instance, field and question revision,
+    so that the text is parsed only once after each change to the question.
+    As instance could have been changed without being saved,
+    a cached template is used only if it was compiled from the same text.
+    """
+
+    from mitesting.caches import compiled_template_cache
+
+    if question is None:
+        question = instance
+
+    the_text = getattr(instance, field)
+    template_string = "{% load question_tags mi_tags dynamictext humanize %}" \
+                      + the_text
+
+    if instance.pk is None or question.id is None:
+        return Template(template_string)
+
+    cache_key = (question.id, instance._meta.model_name, instance.pk,
+                 field, question.revision)
+    cached = compiled_template_cache.get(cache_key)
+    if cached is not None and cached[0] == the_text:
+        return cached[1]
+
+    template = Template(template_string)
+    compiled_template_cache.set(cache_key, (the_text, template))
+    return template
+
+
 def render_question_text(render_data, solution=False, no_links=False):
     """
     Render the question text and subparts as Django templates.
@@ -461,7 +662,6 @@ def render_question_text(render_data, solution=False, no_links=False):
     expr_context = render_data['expression_context']
 
     render_results = {'question': question, 'render_error_messages': [] }
-    template_string_base = "{% load question_tags mi_tags dynamictext humanize %}"
 
 
     # render solution or question, recording any error in rendering template
@@ -470,10 +670,11 @@ def render_question_text(render_data, solution=False, no_links=False):
     else:
         the_text = question.question_text
     if the_text:
-        template_string=template_string_base + the_text
         try:
+            template = return_compiled_template(
+                question, 'solution_text' if solution else 'question_text')
             render_results['rendered_text'] = \
-                mark_safe(Template(template_string).render(expr_context))
+                mark_safe(template.render(expr_context))
         except Exception as e:
             if isinstance(e,TemplateSyntaxError):
                 message = str(e)
@@ -503,17 +704,18 @@ def render_question_text(render_data, solution=False, no_links=False):
     render_results['subparts']=[]
     subparts = question.questionsubpart_set.all()
     for subpart in subparts:
-        template_string=template_string_base
         subpart_dict = {'letter': subpart.get_subpart_letter(), 'subpart': subpart }
         if solution:
             the_text = subpart.solution_text
         else:
             the_text = subpart.question_text
         if the_text:
-            template_string=template_string_base + the_text
             try:
+                template = return_compiled_template(
+                    subpart, 'solution_text' if solution else 'question_text',
+                    question=question)
                 subpart_dict['rendered_text'] = \
-                    mark_safe(Template(template_string).render(expr_context))
+                    mark_safe(template.render(expr_context))
             except Exception as e:
                 if solution:
                     subpart_dict['rendered_text'] = \
@@ -584,7 +786,6 @@ def add_help_data(render_data, render_results, subparts=None,
     """
     question = render_data['question']
 
-    template_string_base = "{% load question_tags mi_tags dynamictext humanize %}"
     expr_context = render_data['expression_context']
     hint_template_error=False
 
@@ -607,10 +808,10 @@ def add_help_data(render_data, render_results, subparts=None,
                 help_available=True
 
         if subpart.hint_text:
-            template_string = template_string_base + subpart.hint_text
             try:
-                subpart_dict['hint_text'] = \
-                    Template(template_string).render(expr_context)
+                template = return_compiled_template(subpart, 'hint_text',
+                                                    question=question)
+                subpart_dict['hint_text'] = template.render(expr_context)
             except Exception as e:
                 subpart_dict['hint_text'] = \
                     'Error in hint text template: %s' % e
@@ -644,10 +845,9 @@ def add_help_data(render_data, render_results, subparts=None,
             help_available=True
 
     if question.hint_text:
-        template_string = template_string_base + question.hint_text
         try:
-            render_results['hint_text'] = \
-                Template(template_string).render(expr_context)
+            template = return_compiled_template(question, 'hint_text')
+            render_results['hint_text'] = template.render(expr_context)
         except TemplateSyntaxError as e:
             render_results['hint_text'] = \
                 'Error in hint text template: %s' % e
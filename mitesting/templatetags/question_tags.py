@@ -1,12 +1,12 @@
 from django import template
 from django.template.base import (Node, NodeList, Template, Context, Library, Variable, TemplateSyntaxError, VariableDoesNotExist)
-from midocs.models import Page, PageNavigation, PageNavigationSub, IndexEntry, IndexType, Image, ImageType, Applet, Video, EquationTag, ExternalLink, PageCitation, Reference
+from midocs.models import Page, PageNavigation, PageNavigationSub, IndexEntry, IndexType, Image, ImageType, Video, EquationTag, ExternalLink, PageCitation, Reference
 from mitesting.models import Question, QuestionAnswerOption, Expression
 from mitesting.render_questions import render_question
 from mitesting.utils import get_new_seed
 from mitesting.forms import MultipleChoiceQuestionForm
 from django.core.urlresolvers import reverse, NoReverseMatch
-from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
 from django.template.base import kwarg_re
 import re
@@ -382,14 +382,14 @@ def process_assign_to_applet_object(applet_object_name, answer_field_name,
 
     # if applet is not an applet instance
     # try to load applet with that code
-    if not isinstance(applet, Applet):
-        # test if applet with applet_code exists
-        try:
-            applet=Applet.objects.get(code=applet)
-            # if applet does not exist
-            # return tag to applet code anyway
-        except ObjectDoesNotExist:
-            return ""
+    from midocs.applet_bundle import return_applet_bundle
+    try:
+        bundle = return_applet_bundle(applet)
+    except ObjectDoesNotExist:
+        # if applet does not exist
+        # return tag to applet code anyway
+        return ""
+    applet = bundle.applet
 
     # get applet_id_user optionally from kwargs or context
     applet_id_user = kwargs.get('applet_id', 
@@ -405,15 +405,13 @@ def process_assign_to_applet_object(applet_object_name, answer_field_name,
     # get applet_identifier optionally from context
     applet_identifier = context.get('_the_applet_identifier')
 
-    try:
-        applet_object=applet.appletobject_set.get \
-                       (change_from_javascript=True, name=applet_object_name)
-    except ObjectDoesNotExist:
+    applet_objects = bundle.return_objects(change_from_javascript=True,
+                                           name=applet_object_name)
+    if not applet_objects:
         return ""
-    except MultipleObjectsReturned:
+    if len(applet_objects) > 1:
         logger.warning("Received multiple applet objects with change_from_javascript=True, applet=%s, name=%s.  Choosing first" % (applet.code, applet_object_name))
-        applet_object=applet.appletobject_set.filter \
-            (change_from_javascript=True, name=applet_object_name).first()
+    applet_object = applet_objects[0]
         
     try:
         applet_data=context['_auxiliary_data_']['applet']
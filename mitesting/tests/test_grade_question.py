@@ -1668,17 +1668,54 @@ class TestQuestionGroups(TestCase):
             answer_results=answer_results)
 
 
-        # doesn't give maximum possible points in this case, as will choose the
-        # 50% credit over the 40% + the 30%
-        self.assertEqual(answer_dict['points_achieved_times_100'],150)
+        # gives maximum possible points, choosing the 40% + the 30%
+        # credit over the 50% credit
+        self.assertEqual(answer_dict['points_achieved_times_100'],170)
         self.assertEqual(answer_dict['points_answered'],3)
         self.assertTrue(answer_results['answers'][id1]['answer_correct'])
         self.assertEqual(answer_results['answers'][id1]['percent_correct'],100)
         self.assertFalse(answer_results['answers'][id2]['answer_correct'])
-        self.assertEqual(answer_results['answers'][id2]['percent_correct'],0)
+        self.assertEqual(answer_results['answers'][id2]['percent_correct'],40)
         self.assertFalse(answer_results['answers'][id3]['answer_correct'])
-        self.assertEqual(answer_results['answers'][id3]['percent_correct'],50)
+        self.assertEqual(answer_results['answers'][id3]['percent_correct'],30)
 
 
 
 # haven't tested grade_question function directly, but do via question_view
+
+
+class TestMatching(TestCase):
+
+    def test_maximum_bipartite_matching(self):
+        self.assertEqual(maximum_bipartite_matching([], 0), [])
+        self.assertEqual(maximum_bipartite_matching([[],[]], 2), [])
+
+        # greedy choice of (0,0) would leave row 1 unmatched
+        self.assertEqual(maximum_bipartite_matching([[0,1],[0]], 2),
+                         [(0,1),(1,0)])
+
+        adjacency = [[0,1,2],[0],[0,1],[3],[2,3]]
+        matches = maximum_bipartite_matching(adjacency, 4)
+        self.assertEqual(len(matches), 4)
+        self.assertEqual(len({match[0] for match in matches}), 4)
+        self.assertEqual(len({match[1] for match in matches}), 4)
+        for (i,j) in matches:
+            self.assertTrue(j in adjacency[i])
+
+        # all of ten interchangeable answers correct
+        adjacency = [list(range(10)) for i in range(10)]
+        matches = maximum_bipartite_matching(adjacency, 10)
+        self.assertEqual(sorted(match[1] for match in matches),
+                         list(range(10)))
+
+    def test_maximum_weight_matching(self):
+        self.assertEqual(maximum_weight_matching([]), [])
+        self.assertEqual(maximum_weight_matching([[50]]), [(0,0)])
+
+        # greedy choice of largest entry (0,0) gives only 90+0
+        self.assertEqual(maximum_weight_matching([[90,80],[60,0]]),
+                         [(0,1),(1,0)])
+
+        weights = [[50,0,25],[50,25,0],[0,75,50]]
+        matches = maximum_weight_matching(weights)
+        self.assertEqual(sum(weights[i][j] for (i,j) in matches), 150)
@@ -1728,3 +1728,96 @@ class MathObjectTests(SimpleTestCase):
         self.assertEqual(mobject.compare_with_expression(expr2)['fraction_equal'],1)
         self.assertEqual(mobject.compare_with_expression(expr3)['fraction_equal'],1)
         
+
+
+    def test_pair_identical_elements(self):
+        x = Symbol('x')
+        y = Symbol('y')
+
+        (remaining1, remaining2, n_pairs) = pair_identical_elements(
+            [x+1, y, 2*x, y], [y, 3*x, x+1, y, x])
+        self.assertEqual(n_pairs, 3)
+        self.assertEqual(remaining1, [2*x])
+        self.assertEqual(remaining2, [3*x, x])
+
+        (remaining1, remaining2, n_pairs) = pair_identical_elements(
+            [[1,2], x], [x, [1,2]])
+        self.assertEqual(n_pairs, 2)
+        self.assertEqual(remaining1, [])
+        self.assertEqual(remaining2, [])
+
+        # elements that are equal in normalized form are paired
+        # only if they are confirmed to be equal
+        from mitesting.sympy_customized import Interval
+        from sympy import Lt, Gt
+        elements1 = [Lt(x, y), Interval(1, 2, True, True), Gt(x, 2)]
+        elements2 = [Tuple(1, 2), Gt(y, x), Lt(x, 2)]
+        (remaining1, remaining2, n_pairs) = pair_identical_elements(
+            elements1, elements2)
+        self.assertEqual(n_pairs, 0)
+
+        def equal(expr1, expr2):
+            return check_equality(expr1, expr2)['fraction_equal'] == 1
+        (remaining1, remaining2, n_pairs) = pair_identical_elements(
+            elements1, elements2, equal=equal)
+        self.assertEqual(n_pairs, 2)
+        self.assertEqual(remaining1, [Gt(x, 2)])
+        self.assertEqual(remaining2, [Lt(x, 2)])
+
+    def test_large_unordered_tuples(self):
+        x = Symbol('x')
+        elements = [x**i+i for i in range(200)]
+        shuffled = list(elements)
+        random.shuffle(shuffled)
+
+        results = check_tuple_equality(Tuple(*elements), Tuple(*shuffled),
+                                       tuple_is_unordered=True)
+        self.assertEqual(results['fraction_equal'], 1)
+
+        shuffled[0] = -shuffled[0]
+        results = check_tuple_equality(Tuple(*elements), Tuple(*shuffled),
+                                       tuple_is_unordered=True)
+        self.assertEqual(results['fraction_equal'], 0)
+        results = check_tuple_equality(Tuple(*elements), Tuple(*shuffled),
+                                       tuple_is_unordered=True,
+                                       partial_matches=True)
+        self.assertEqual(results['fraction_equal'], 199/200)
+
+    def test_numerical_fingerprints_differ(self):
+        x = Symbol('x')
+        y = Symbol('y', real=True)
+        n = Symbol('n', integer=True)
+        from mitesting.user_commands import log, exp
+        from sympy import sqrt, Function
+
+        self.assertTrue(numerical_fingerprints_differ(x**2, x**3))
+        self.assertTrue(numerical_fingerprints_differ(x+y, x-y))
+        self.assertTrue(numerical_fingerprints_differ(sqrt(2)*x, 1.41*x))
+        self.assertTrue(numerical_fingerprints_differ(exp(x), 3))
+        self.assertFalse(numerical_fingerprints_differ(
+            (x+1)**2, x**2+2*x+1))
+        self.assertFalse(numerical_fingerprints_differ(
+            log(x*y), log(x)+log(y)))
+        self.assertFalse(numerical_fingerprints_differ(
+            0.5*x, x/2))
+        self.assertFalse(numerical_fingerprints_differ(
+            (-1)**(2*n), 1))
+        self.assertFalse(numerical_fingerprints_differ(
+            Function('f')(x), x))
+        self.assertFalse(numerical_fingerprints_differ(
+            Tuple(x,1), Tuple(x,2)))
+        self.assertFalse(numerical_fingerprints_differ(
+            Symbol('lambda'), 2))
+
+    def test_compare_with_numerical_precheck(self):
+        x = Symbol('x')
+        mobject = math_object((x+1)**2, normalize_on_compare=True)
+        results = mobject.compare_with_expression(x**2+2*x+1)
+        self.assertEqual(results['fraction_equal'], 1)
+        results = mobject.compare_with_expression(x**2+2*x-1)
+        self.assertEqual(results['fraction_equal'], 0)
+
+        mobject = math_object(3.14159*x, round_on_compare=3)
+        from sympy import pi
+        results = mobject.compare_with_expression(pi*x)
+        self.assertEqual(results['fraction_equal'], 1)
@@ -703,6 +703,137 @@ class TestSetupExpressionContextUserResponse(TestCase):
 
         
 
+class TestExpressionContextCache(TestCase):
+    def setUp(self):
+        random.seed()
+        qt = QuestionType.objects.create(name="question type")
+        self.q  = Question.objects.create(
+            name="fun question",
+            question_type = qt,
+            question_privacy = 2,
+            solution_privacy = 2,
+            )
+            
+    def new_expr(self, **kwargs):
+        return Expression.objects.create(question=self.q, **kwargs)
+
+    def test_reuse_random_outcomes_and_rng_state(self):
+        self.new_expr(name="n", expression="(1,1000)",
+                      expression_type = Expression.RANDOM_NUMBER)
+        self.new_expr(name="a", expression="n*x")
+
+        rng = random.Random()
+        random_outcomes = {}
+        results=setup_expression_context(self.q, rng=rng, seed=5,
+                                         random_outcomes=random_outcomes)
+        n = results['expression_context']['n']
+        saved_outcomes = dict(random_outcomes)
+        next_random = rng.random()
+
+        rng = random.Random()
+        random_outcomes = {}
+        results=setup_expression_context(self.q, rng=rng, seed=5,
+                                         random_outcomes=random_outcomes)
+        self.assertEqual(results['expression_context']['n'], n)
+        self.assertEqual(results['expression_context']['a'],
+                         n*Symbol('x', real=True))
+        self.assertEqual(random_outcomes, saved_outcomes)
+        self.assertEqual(rng.random(), next_random)
+
+    def test_post_user_responses_not_cached(self):
+        self.new_expr(name="a", expression="x")
+        ExpressionFromAnswer.objects.create(
+            question=self.q, name="b", answer_code="borig", answer_number=1)
+
+        rng = random.Random()
+        for response in ["y", "z"]:
+            user_responses=[{'identifier': 0, 'code': "borig",
+                             'response': response }]
+            results=setup_expression_context(self.q, rng=rng, seed=1,
+                                             user_responses=user_responses)
+            expression_context = results['expression_context']
+            self.assertEqual(expression_context['b'],
+                             Symbol(response, real=True))
+            self.assertEqual(expression_context['_sympy_local_dict_']['b'],
+                             Symbol(response, real=True))
+            self.assertEqual(expression_context['a'], Symbol('x', real=True))
+
+    def test_invalidate_on_save(self):
+        expr = self.new_expr(name="a", expression="x")
+        rng = random.Random()
+        results=setup_expression_context(self.q, rng=rng, seed=1)
+        self.assertEqual(results['expression_context']['a'],
+                         Symbol('x', real=True))
+
+        expr.expression = "y"
+        expr.save()
+        results=setup_expression_context(self.q, rng=rng, seed=1)
+        self.assertEqual(results['expression_context']['a'],
+                         Symbol('y', real=True))
+
+        self.new_expr(name="b", expression="a+1")
+        results=setup_expression_context(self.q, rng=rng, seed=1)
+        self.assertEqual(results['expression_context']['b'],
+                         Symbol('y', real=True)+1)
+
+        expr.delete()
+        results=setup_expression_context(self.q, rng=rng, seed=1)
+        self.assertFalse('a' in results['expression_context'])
+        
+        self.assertTrue(Question.objects.get(id=self.q.id).revision
+                        > self.q.revision)
+
+    def test_save_keeps_revision(self):
+        revision = self.q.revision
+        self.q.save()
+        self.assertTrue(self.q.revision > revision)
+        self.assertEqual(Question.objects.get(id=self.q.id).revision,
+                         self.q.revision)
+
+        # saving question with revision that is out of date
+        # must not write back old revision
+        revision = self.q.revision
+        self.new_expr(name="a", expression="x")
+        self.q.name = "new name"
+        self.q.save()
+        question = Question.objects.get(id=self.q.id)
+        self.assertEqual(question.name, "new name")
+        self.assertTrue(question.revision > revision+1)
+        self.assertEqual(question.revision, self.q.revision)
+
+    def test_constant_queries_with_retries(self):
+        from mitesting.caches import expression_context_cache, \
+            question_plan_cache
+        self.new_expr(name="n", expression="(1,100)",
+                      expression_type = Expression.RANDOM_NUMBER)
+        self.new_expr(name="n_large", expression="n > 95",
+                      expression_type = Expression.CONDITION)
+
+        expression_context_cache.clear()
+        question_plan_cache.clear()
+        rng = random.Random()
+        with self.assertNumQueries(4):
+            results=setup_expression_context(self.q, rng=rng, seed=1)
+        self.assertFalse(results['failed_conditions'])
+        self.assertTrue(results['expression_context']['n'] > 95)
+
+        expression_context_cache.clear()
+        with self.assertNumQueries(0):
+            results=setup_expression_context(self.q, rng=rng, seed=1)
+        self.assertTrue(results['expression_context']['n'] > 95)
+
+    def test_invalidate_on_allowed_commands(self):
+        self.new_expr(name="a", expression="sin(pi)")
+        rng = random.Random()
+        results=setup_expression_context(self.q, rng=rng, seed=1)
+        self.assertNotEqual(results['expression_context']['a'], 0)
+
+        scs = SympyCommandSet.objects.create(name="trig", commands="sin, pi")
+        self.q.allowed_sympy_commands.add(scs)
+        results=setup_expression_context(self.q, rng=rng, seed=1)
+        self.assertEqual(results['expression_context']['a'], 0)
+
+
 class TestAnswerCodes(TestCase):
     def setUp(self):
         random.seed()
@@ -870,6 +1001,38 @@ class TestRenderQuestionText(TestCase):
         self.assertEqual(render_results['question'], self.q)
         self.assertEqual(render_results['rendered_text'], "")
 
+    def test_compiled_template_cache(self):
+        from mitesting.render_questions import return_compiled_template
+        self.q.question_text="${{n}}$"
+        self.q.save()
+        subpart = self.q.questionsubpart_set.create(question_text="${{x}}$")
+
+        template = return_compiled_template(self.q, 'question_text')
+        self.assertIs(return_compiled_template(self.q, 'question_text'),
+                      template)
+        self.assertEqual(template.render(self.expr_context),
+                         "$%s$" % self.expr_context["n"])
+        template = return_compiled_template(subpart, 'question_text',
+                                            question=self.q)
+        self.assertIs(return_compiled_template(subpart, 'question_text',
+                                               question=self.q), template)
+        self.assertEqual(template.render(self.expr_context),
+                         "$%s$" % self.expr_context["x"])
+
+        # unsaved changes are not hidden by cache
+        self.q.question_text="${{fun_x}}$"
+        template = return_compiled_template(self.q, 'question_text')
+        self.assertEqual(template.render(self.expr_context),
+                         "$%s$" % self.expr_context["fun_x"])
+
+        subpart.question_text="${{f}}$"
+        subpart.save()
+        question = Question.objects.get(id=self.q.id)
+        template = return_compiled_template(subpart, 'question_text',
+                                            question=question)
+        self.assertEqual(template.render(self.expr_context),
+                         "$%s$" % self.expr_context["f"])
+
     def test_render_simple(self):
         self.q.question_text="${{f}}({{x}}) = {{fun_x}}$"
         self.q.solution_text="${{x}} = {{n}}$"
@@ -35,6 +35,19 @@ class TestDicts(SimpleTestCase):
         local_dict2['if']=iif
         self.assertEqual(local_dict, local_dict2)
 
+    def test_sympy_command_mapping_memoized(self):
+        mapping = return_sympy_command_mapping(["Abs, floor", "ceiling"])
+        mapping2 = return_sympy_command_mapping(["ceiling,floor", "Abs"])
+        self.assertIs(mapping, mapping2)
+        with self.assertRaises(TypeError):
+            mapping['x'] = Symbol('x')
+
+        local_dict = return_sympy_local_dict(["Abs, floor", "ceiling"])
+        self.assertEqual(local_dict, mapping)
+        local_dict['x'] = Symbol('x')
+        self.assertFalse('x' in mapping)
+        self.assertFalse('x' in return_sympy_local_dict(["Abs, floor, ceiling"]))
+
 
         
 
@@ -427,3 +440,43 @@ class TestParsedFunction(SimpleTestCase):
         self.assertFalse(fun(y))
         self.assertEqual(fun(x), Ne(x,y))
 
+
+
+class TestFindEqualityWithErrors(SimpleTestCase):
+
+    def test_errors(self):
+        x=Symbol('x')
+        y=Symbol('y')
+
+        results = find_equality_with_errors(x**2-3*x+y, x**2-3*x+y)
+        self.assertTrue(results["success"])
+        self.assertFalse(results["budget_exhausted"])
+
+        results = find_equality_with_errors(x**2-3*x+5, x**2+3*x+5)
+        self.assertTrue(results["success"])
+        self.assertEqual(results["sign_errors"], 1)
+        self.assertFalse(results["budget_exhausted"])
+
+        results = find_equality_with_errors(x**2-3*x+5, x**3+3*x+5)
+        self.assertFalse(results["success"])
+        self.assertFalse(results["budget_exhausted"])
+
+    def test_budget(self):
+        x=Symbol('x')
+        expr1 = sum((-1)**i*x**i for i in range(20))
+        expr2 = sum(x**i for i in range(20))
+
+        results = find_equality_with_errors(expr1, expr2)
+        self.assertTrue(results["success"])
+        self.assertFalse(results["budget_exhausted"])
+
+        results = find_equality_with_manipulations(
+            expr1, expr2, constant_factor_term_errors, max_nodes=5)
+        self.assertFalse(results["success"])
+        self.assertTrue(results["budget_exhausted"])
+
+        search = ManipulationSearch(max_nodes=2, max_time=0)
+        self.assertTrue(search.visit_node())
+        self.assertTrue(search.visit_node())
+        self.assertFalse(search.visit_node())
+        self.assertTrue(search.budget_exhausted)
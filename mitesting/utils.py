@@ -3,6 +3,8 @@ from mitesting.sympy_customized import parse_and_process, bottom_up, customized_
 from sympy import Tuple, Function, sympify, Symbol, ImmutableMatrix
 
 from sympy.parsing.sympy_tokenize import TokenError
+from functools import lru_cache
+from types import MappingProxyType
 import six
 import re
 
@@ -16,22 +18,44 @@ def get_new_seed(rng=None, seed=None):
 
     return str(rng.randint(0,1E8))
 
-def return_sympy_local_dict(allowed_sympy_commands=[]):
+def _create_command_registry():
     """
-    Make a whitelist of allowed commands sympy and customized commands.
-    Argument allowed_sympy_commands is an iterable containing
-    strings of comma separated commands names.
-    Returns a dictionary where keys are the command names and 
-    values are the corresponding function or sympy expression.
-    The local dictionary contains
-    1.  the allowed sympy_commands that match localized commands
-    2.  the allowed sympy_commands that match standard sympy commands.
-    Command names that don't match either customized or sympy commands
-    are ignored.
+    Create a dictionary of all commands that could be allowed
+    in a whitelist from return_sympy_local_dict.
+    The dictionary contains all standard sympy commands, 
+    overridden by any localized commands of the same name.
     """
-
     from mitesting.user_commands import return_localized_commands
-    localized_commands = return_localized_commands()
+
+    command_registry = {}
+    exec("from sympy import *", command_registry)
+    del command_registry['__builtins__']
+    command_registry.update(return_localized_commands())
+    return command_registry
+
+# created once per process, as executing "from sympy import *"
+# is expensive compared to the rest of setting up a question
+sympy_command_registry = MappingProxyType(_create_command_registry())
+
+
+@lru_cache(maxsize=256)
+def _return_sympy_command_mapping(allowed_commands):
+    command_mapping = {}
+    for command in allowed_commands:
+        try:
+            command_mapping[str(command)]=sympy_command_registry[command]
+        except KeyError:
+            pass
+    return MappingProxyType(command_mapping)
+
+
+def return_sympy_command_mapping(allowed_sympy_commands=[]):
+    """
+    Return read-only mapping of allowed commands for
+    return_sympy_local_dict.
+    Mappings are memoized by the set of allowed command names,
+    so the same mapping is shared by all callers.
+    """
 
     # create a set of allowed commands containing all comma-separated
     # strings from allowed_sympy_commands
@@ -40,26 +64,27 @@ def return_sympy_local_dict(allowed_sympy_commands=[]):
         allowed_commands=allowed_commands.union(
             [item.strip() for item in commandstring.split(",")])
 
-    # create a dictionary containing all sympy commands
-    all_sympy_commands = {}
-    exec("from sympy import *", all_sympy_commands)
+    return _return_sympy_command_mapping(frozenset(allowed_commands))
 
-    # create the dictionary
-    local_dict = {}
 
-    for command in allowed_commands:
-        try:
-            # attempt to match command with localized command
-            local_dict[str(command)]=localized_commands[command]
-        except KeyError:
-            try:
-                # if command isn't found in localized command
-                # then attempt to match with standard sympy command
-                local_dict[str(command)]=all_sympy_commands[command]
-            except KeyError:
-                pass
+def return_sympy_local_dict(allowed_sympy_commands=[]):
+    """
+    Make a whitelist of allowed commands sympy and customized commands.
+    Argument allowed_sympy_commands is an iterable containing
+    strings of comma separated commands names.
+    Returns a dictionary where keys are the command names and 
+    values are the corresponding function or sympy expression.
+    The local dictionary contains
+    1.  the allowed sympy_commands that match localized commands
+    2.  the allowed sympy_commands that match standard sympy commands.
+    Command names that don't match either customized or sympy commands
+    are ignored.
+
+    The dictionary is a new copy of the memoized mapping from
+    return_sympy_command_mapping, so it can be modified by the caller.
+    """
 
-    return local_dict
+    return dict(return_sympy_command_mapping(allowed_sympy_commands))
 
 
 
@@ -2092,8 +2117,55 @@ def constant_factor_term_errors(expr1, expr2, catch_sign_errors=True,
             'expr1': expr1, 'expr2': expr2}
 
 
+class ManipulationSearch(object):
+    """
+    State shared by all the recursive calls of a single
+    find_equality_with_manipulations search.
+
+    - memo: results already found for pairs (expr1, expr2) of subtrees
+    - max_nodes: maximum number of pairs of subtrees to visit
+    - deadline: time (from time.monotonic) after which the search stops
+    - n_nodes: number of pairs of subtrees visited so far
+    - budget_exhausted: set to True if the search was stopped early
+    """
+
+    def __init__(self, max_nodes=None, max_time=None):
+        from django.conf import settings
+        import time
+
+        if max_nodes is None:
+            max_nodes = getattr(
+                settings, 'MITESTING_MANIPULATION_SEARCH_MAX_NODES', 10000)
+        if max_time is None:
+            max_time = getattr(
+                settings, 'MITESTING_MANIPULATION_SEARCH_MAX_TIME', 5)
+
+        self.memo = {}
+        self.max_nodes = max_nodes
+        self.deadline = time.monotonic() + max_time if max_time else None
+        self.n_nodes = 0
+        self.budget_exhausted = False
+
+    def visit_node(self):
+        """
+        Count a visit to a pair of subtrees.
+        Return False if the node or time budget has been exhausted.
+        """
+        import time
+
+        if self.budget_exhausted:
+            return False
+        self.n_nodes += 1
+        if (self.max_nodes and self.n_nodes > self.max_nodes) or \
+           (self.deadline is not None and time.monotonic() > self.deadline):
+            self.budget_exhausted = True
+            return False
+        return True
+
+
 def find_equality_with_manipulations(expr1, expr2, F, 
-                                     arg_exclusions=[], **kwargs):
+                                     arg_exclusions=[], max_nodes=None,
+                                     max_time=None, **kwargs):
 
     """
     Attempts to determine that expr would be equal to expr_ref
@@ -2115,34 +2187,85 @@ def find_equality_with_manipulations(expr1, expr2, F,
     If an expression is an instace of that class, then the arguments 
     listed by the indices will not be manipulated.  
     Those arguments must match exactly for equality to be reached.
+
+    Results for each pair of subtrees are memoized, so that pairs
+    revisited while matching unordered arguments are compared only once.
+    The search visits at most max_nodes pairs of subtrees and runs
+    for at most max_time seconds.  If not specified, these are
+    determined by the settings MITESTING_MANIPULATION_SEARCH_MAX_NODES
+    (default 10000) and MITESTING_MANIPULATION_SEARCH_MAX_TIME 
+    (default 5).  A value of 0 means no limit.
+    If the budget is exhausted, the search fails.
     
     returns:
     - success: if found altered version of expr that matches expr_ref
     - num_applications: number of application of F applied
+    - budget_exhausted: True if search was stopped by node or time budget
+    """
+
+    search = ManipulationSearch(max_nodes=max_nodes, max_time=max_time)
+
+    results = _find_equality_with_manipulations(
+        expr1, expr2, F, arg_exclusions, search, kwargs)
+
+    if search.budget_exhausted:
+        results["success"] = False
+    results["budget_exhausted"] = search.budget_exhausted
+    return results
+
+
+def _find_equality_with_manipulations(expr1, expr2, F, arg_exclusions,
+                                      search, kwargs):
+    """
+    Recursive step of find_equality_with_manipulations,
+    memoized on (expr1, expr2) in search.memo.
+    Returns a new dictionary that the caller may modify.
     """
 
+    try:
+        key = (expr1, expr2)
+        memoized = search.memo.get(key)
+    except TypeError:
+        # unhashable expressions such as lists are not memoized
+        key = None
+        memoized = None
+
+    if memoized is not None:
+        return dict(memoized)
+
+    if not search.visit_node():
+        return {'success': False}
+
+    results = _find_equality_with_manipulations_sub(
+        expr1, expr2, F, arg_exclusions, search, kwargs)
+
+    # results found after budget exhausted may be incomplete
+    if key is not None and not search.budget_exhausted:
+        search.memo[key] = dict(results)
+
+    return results
+
+
+def _find_equality_with_manipulations_sub(expr1, expr2, F, arg_exclusions,
+                                          search, kwargs):
+
     # straight equality
     if expr1==expr2:
         return {'success': True,}
 
     # check for equality after single application of F
-    try:
-        results=F(expr1, expr2, **kwargs)
+    results=F(expr1, expr2, **kwargs)
 
-    except:
-        raise
-        results = {'success': False}
-    else:
-        try:
-            expr1 = results.pop("expr1")
-        except KeyError:
-            pass
-        try:
-            expr2 = results.pop("expr2")
-        except KeyError:
-            pass
-        if results["success"] == True:
-            return results
+    try:
+        expr1 = results.pop("expr1")
+    except KeyError:
+        pass
+    try:
+        expr2 = results.pop("expr2")
+    except KeyError:
+        pass
+    if results["success"] == True:
+        return results
 
     # if classes of expressions don't match, report failure
     if expr1.__class__ != expr2.__class__:
@@ -2158,10 +2281,9 @@ def find_equality_with_manipulations(expr1, expr2, F,
         if len(expr1) != len(expr2):
             return results
         
-        for i in range(len(expr)):
-            results_sub=find_equality_with_manipulations(
-                expr1[i], expr2[i], F,
-                arg_exclusions=arg_exclusions, **kwargs)
+        for i in range(len(expr1)):
+            results_sub=_find_equality_with_manipulations(
+                expr1[i], expr2[i], F, arg_exclusions, search, kwargs)
             if not results_sub.pop("success"):
                 return results
             for key in results_sub:
@@ -2177,9 +2299,8 @@ def find_equality_with_manipulations(expr1, expr2, F,
             return results
         
         for i in range(len(expr1)):
-            results_sub=find_equality_with_manipulations(
-                expr1[i], expr2[i], F,
-                arg_exclusions=arg_exclusions, **kwargs)
+            results_sub=_find_equality_with_manipulations(
+                expr1[i], expr2[i], F, arg_exclusions, search, kwargs)
             if not results_sub.pop("success"):
                 return results
             for key in results_sub:
@@ -2237,9 +2358,9 @@ def find_equality_with_manipulations(expr1, expr2, F,
     if order_matters:
         for i in range(len(expr1_args)):
             if i not in inds_to_exclude:
-                results_sub=find_equality_with_manipulations(
-                    expr1_args[i], expr2_args[i], F,
-                    arg_exclusions=arg_exclusions, **kwargs)
+                results_sub=_find_equality_with_manipulations(
+                    expr1_args[i], expr2_args[i], F, arg_exclusions,
+                    search, kwargs)
                 if not results_sub.pop("success"):
                     return results
                 for key in results_sub:
@@ -2260,15 +2381,16 @@ def find_equality_with_manipulations(expr1, expr2, F,
                 continue
             for (i2, e2) in enumerate(expr2_args):
                 if i2 not in indices_used:
-                    results_sub=find_equality_with_manipulations(
-                        e1, e2, F,
-                        arg_exclusions=arg_exclusions, **kwargs)
+                    results_sub=_find_equality_with_manipulations(
+                        e1, e2, F, arg_exclusions, search, kwargs)
                     if results_sub.pop("success"):
                         indices_used.add(i2)
                         n_matches +=1
                         for key in results_sub:
                             results[key] = results.get(key, 0)+results_sub[key]
                         break
+            if search.budget_exhausted:
+                return results
 
         if len(expr1_args)-len(inds_to_exclude)==n_matches:
             results["success"] = True